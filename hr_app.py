@@ -3,12 +3,36 @@ import json
 from datetime import datetime, timedelta, date
 import os
 import pandas as pd
+import numpy as np
 import plotly.express as px
 from fpdf import FPDF
 import base64
 from passlib.hash import pbkdf2_sha256 # For password hashing
 import requests # For making HTTP requests to external APIs (e.g., Gemini)
 import uuid # For generating unique IDs
+import hashlib # For content-addressing uploaded attachments
+import mimetypes # For serving attachments with their original content type
+import tempfile # For staging streamed uploads before they are committed to the blob store
+import threading # For coordinating background preview jobs and shared in-memory indexes
+import re # For tokenizing text for search
+import math
+import time
+import heapq
+import itertools
+import copy
+import contextlib
+import bisect
+import zipfile # For bundling appraisal reports
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError # Worker pool for attachment previews
+from PIL import Image # Installed with Streamlit; used to downscale attachment previews
+try:
+    import xlsxwriter # Optional: enables Excel exports of admin tables
+except ImportError:
+    xlsxwriter = None
+try:
+    import pymupdf # Optional: rasterises the first page of PDF attachments for previews
+except ImportError:
+    pymupdf = None
 
 # --- SET STREAMLIT PAGE CONFIG (MUST BE THE VERY FIRST STREAMLIT COMMAND) ---
 st.set_page_config(
@@ -26,16 +50,48 @@ OPEX_CAPEX_REQUESTS_FILE = os.path.join(DATA_DIR, "opex_capex_requests.json")
 PERFORMANCE_GOALS_FILE = os.path.join(DATA_DIR, "performance_goals.json")
 SELF_APPRAISALS_FILE = os.path.join(DATA_DIR, "self_appraisals.json")
 PAYROLL_FILE = os.path.join(DATA_DIR, "payroll.json")
+COMPENSATION_FILE = os.path.join(DATA_DIR, "compensation.json") # NEW: Monthly pay components per staff ID
 BENEFICIARIES_FILE = os.path.join(DATA_DIR, "beneficiaries.json")
 HR_POLICIES_FILE = os.path.join(DATA_DIR, "hr_policies.json")
-CHAT_MESSAGES_FILE = os.path.join(DATA_DIR, "chat_messages.json") # NEW: Chat messages file
+CHAT_MESSAGES_FILE = os.path.join(DATA_DIR, "chat_messages.json") # Legacy single-file chat log, migrated into CHAT_DIR
+CHAT_DIR = os.path.join(DATA_DIR, "chat") # NEW: One append-only message log per conversation
+CHAT_CONVERSATIONS_FILE = os.path.join(DATA_DIR, "chat_conversations.json") # Participants of each conversation log
+CHAT_READ_CURSORS_FILE = os.path.join(DATA_DIR, "chat_read_cursors.json") # Legacy read cursors of every reader, migrated into CHAT_READ_STATE_DIR
+CHAT_UNREAD_FILE = os.path.join(DATA_DIR, "chat_unread.json") # Legacy unread counts of every reader, migrated into CHAT_READ_STATE_DIR
+CHAT_READ_STATE_DIR = os.path.join(CHAT_DIR, "read_state") # NEW: One file per reader with their read cursors and unread counts
+CHAT_BROADCAST_LOG = os.path.join(CHAT_DIR, "broadcasts.jsonl") # NEW: Company-wide broadcasts, stored once each
+CHAT_POLL_SECONDS = 3 # How often an open chat checks for new messages in live mode
+CHAT_PAGE_SIZE = 50 # Messages shown when a chat opens, and loaded per "Load older messages"
+CHAT_SCAN_BLOCK_BYTES = 64 * 1024 # Chat logs are read backwards this many bytes at a time
 ATTENDANCE_RECORDS_FILE = os.path.join(DATA_DIR, "attendance_records.json") # NEW: Attendance records file
 DISCIPLINARY_RECORDS_FILE = os.path.join(DATA_DIR, "disciplinary_records.json") # NEW: Disciplinary records file
 DAILY_TASKS_FILE = os.path.join(DATA_DIR, "daily_tasks.json") # NEW: Daily tasks file
+ATTACHMENTS_FILE = os.path.join(DATA_DIR, "attachments.json") # NEW: Attachment metadata and blob reference counts
+BLOB_STORE_DIR = os.path.join(DATA_DIR, "blobs") # NEW: Content-addressed store for uploaded documents
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # Uploads are hashed and written 1 MB at a time
+PREVIEW_CACHE_DIR = os.path.join(DATA_DIR, "previews") # NEW: Cached attachment previews, keyed by blob hash
+PREVIEW_CACHE_MAX_BYTES = 100 * 1024 * 1024 # Least recently viewed previews are evicted beyond this size
+PREVIEW_MAX_DIMENSION = 1000 # Longest side of a preview image, in pixels
+PREVIEW_WORKERS = 4
+PREVIEW_WAIT_SECONDS = 5 # How long a page waits for a preview before showing a placeholder
+SEQUENCES_FILE = os.path.join(DATA_DIR, "sequences.json") # NEW: Next free request number per document type
+SEQUENCE_BLOCK_SIZE = 5 # Request numbers reserved from SEQUENCES_FILE at a time
+# Files that accept record-level patches (see patch_records) and the ID field their records are keyed by
+RECORD_ID_FIELDS = {PERFORMANCE_GOALS_FILE: 'goal_id', SELF_APPRAISALS_FILE: 'appraisal_id'}
+RECORD_JOURNAL_COMPACT_BYTES = 1024 * 1024 # Patch journals are folded back into their file beyond this size
+APPRAISAL_REPORTS_DIR = os.path.join(DATA_DIR, "appraisal_reports") # NEW: Rendered appraisal report PDFs, one per appraisal
+APPRAISAL_REPORTS_FILE = os.path.join(DATA_DIR, "appraisal_reports.json") # Content hash each report PDF was rendered from
+PAYSLIP_PDFS_DIR = os.path.join(DATA_DIR, "payslip_pdfs") # NEW: Rendered payslip PDFs, one per payslip
+PAYSLIP_PDFS_FILE = os.path.join(DATA_DIR, "payslip_pdfs.json") # Content hash each payslip PDF was rendered from
 
 
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+os.makedirs(PREVIEW_CACHE_DIR, exist_ok=True)
+os.makedirs(APPRAISAL_REPORTS_DIR, exist_ok=True)
+os.makedirs(PAYSLIP_PDFS_DIR, exist_ok=True)
+os.makedirs(CHAT_DIR, exist_ok=True)
 
 ICON_BASE_DIR = "Project_Resources" # Assuming you create this folder and put images inside
 if not os.path.exists(ICON_BASE_DIR):
@@ -115,7 +171,10 @@ def load_data(filename, default_value=None):
                 # Specific handling for leave/opex requests to ensure requester_staff_id and request_id
                 elif filename in [LEAVE_REQUESTS_FILE, OPEX_CAPEX_REQUESTS_FILE]:
                     for req in data:
-                        req.setdefault('request_id', str(uuid.uuid4())) # Ensure request_id exists
+                        # Ensure request_id exists; older records only carry a numeric req_id, so reuse it to keep the ID stable between loads
+                        req.setdefault('request_id', str(req['req_id']) if req.get('req_id') is not None else str(uuid.uuid4()))
+                        req['request_id'] = str(req['request_id']) # Some older IDs were stored as integers
+                        req.setdefault('request_number', None) # Human-readable REQ-/LEAVE- number, see backfill_request_numbers()
                         req.setdefault('requester_staff_id', 'N/A')
                         req.setdefault('requester_name', 'N/A')
                         req.setdefault('requester_department', 'N/A')
@@ -136,6 +195,7 @@ def load_data(filename, default_value=None):
                         req.setdefault('vendor_account_no', 'N/A')
                         req.setdefault('vendor_bank', 'N/A')
                         req.setdefault('document_path', None)
+                        req.setdefault('attachment_id', None) # Reference into the attachment store
                         req.setdefault('submission_date', datetime.now().isoformat())
                         req.setdefault('current_approver_role', 'N/A') # Crucial for KeyError fix
                         req.setdefault('current_approval_stage', 0)
@@ -147,8 +207,15 @@ def load_data(filename, default_value=None):
                             req.setdefault('request_date', datetime.now().isoformat())
                 # Specific handling for performance_goals to ensure all expected keys are present
                 elif filename == PERFORMANCE_GOALS_FILE:
+                    seen_goal_ids = {goal['goal_id'] for goal in data if 'goal_id' in goal}
                     for goal in data:
-                        goal.setdefault('goal_id', str(uuid.uuid4()))
+                        if 'goal_id' not in goal:
+                            # Records saved without an ID get one derived from their content, so it is the same on every load
+                            goal_id = str(uuid.uuid5(uuid.NAMESPACE_OID, json.dumps(goal, sort_keys=True, cls=DateEncoder)))
+                            while goal_id in seen_goal_ids: # Identical records
+                                goal_id = str(uuid.uuid5(uuid.NAMESPACE_OID, goal_id))
+                            goal['goal_id'] = goal_id
+                            seen_goal_ids.add(goal_id)
                         goal.setdefault('staff_id', 'N/A')
                         goal.setdefault('goal_description', 'No description provided')
                         goal.setdefault('collaborating_department', 'N/A')
@@ -164,8 +231,14 @@ def load_data(filename, default_value=None):
                         goal.setdefault('line_manager_rating', None)
                 # Specific handling for self_appraisals to ensure all expected keys are present
                 elif filename == SELF_APPRAISALS_FILE:
+                    seen_appraisal_ids = {appraisal['appraisal_id'] for appraisal in data if 'appraisal_id' in appraisal}
                     for appraisal in data:
-                        appraisal.setdefault('appraisal_id', str(uuid.uuid4()))
+                        if 'appraisal_id' not in appraisal:
+                            appraisal_id = str(uuid.uuid5(uuid.NAMESPACE_OID, json.dumps(appraisal, sort_keys=True, cls=DateEncoder)))
+                            while appraisal_id in seen_appraisal_ids: # Identical records
+                                appraisal_id = str(uuid.uuid5(uuid.NAMESPACE_OID, appraisal_id))
+                            appraisal['appraisal_id'] = appraisal_id
+                            seen_appraisal_ids.add(appraisal_id)
                         appraisal.setdefault('staff_id', 'N/A')
                         appraisal.setdefault('appraisal_period', str(datetime.now().year))
                         appraisal.setdefault('employee_data', {})
@@ -193,20 +266,24 @@ def load_data(filename, default_value=None):
                         msg.setdefault('read', False)
                 # Specific handling for payroll
                 elif filename == PAYROLL_FILE:
+                    seen_payslip_ids = {payslip['payslip_id'] for payslip in data if 'payslip_id' in payslip}
                     for payslip in data:
-                        payslip.setdefault('payslip_id', str(uuid.uuid4()))
+                        if 'payslip_id' not in payslip:
+                            # Derived from the row itself so a legacy payslip keeps the same ID on every load;
+                            # rendered payslip PDFs are cached by this ID
+                            payslip_id = str(uuid.uuid5(uuid.NAMESPACE_URL, "payslip:" + json.dumps(payslip, sort_keys=True, cls=DateEncoder)))
+                            while payslip_id in seen_payslip_ids: # Identical rows
+                                payslip_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"payslip:{payslip_id}"))
+                            payslip['payslip_id'] = payslip_id
+                            seen_payslip_ids.add(payslip_id)
                         payslip.setdefault('staff_id', 'N/A')
                         payslip.setdefault('pay_period', 'N/A')
-                        # Convert to float to prevent ValueError in formatting
-                        # Remove commas before converting to float
-                        gross_pay_str = str(payslip.get('gross_pay', 0.0)).replace(',', '')
-                        deductions_str = str(payslip.get('deductions', 0.0)).replace(',', '')
-                        net_pay_str = str(payslip.get('net_pay', 0.0)).replace(',', '')
-
-                        payslip['gross_pay'] = float(gross_pay_str)
-                        payslip['deductions'] = float(deductions_str)
-                        payslip['net_pay'] = float(net_pay_str)
-                        payslip.setdefault('pay_date', datetime.now().isoformat().split('T')[0])
+                        # Hand-entered payslips hold strings such as "600,000.00"; payroll runs store numbers,
+                        # so only the legacy strings need parsing
+                        for amount_field in ['gross_pay', 'deductions', 'net_pay']:
+                            if not isinstance(payslip.get(amount_field), (int, float)):
+                                payslip[amount_field] = float(str(payslip.get(amount_field) or 0.0).replace(',', ''))
+                        payslip.setdefault('pay_date', 'N/A') # Not today's date: the payroll cube files payslips by it
                 # Specific handling for HR policies
                 elif filename == HR_POLICIES_FILE:
                     # Ensure each policy is a dictionary, not a string
@@ -288,6 +365,8 @@ def load_data(filename, default_value=None):
                         task.setdefault('status', 'Not Started') # Default status
                         task.setdefault('created_by_staff_id', 'N/A')
                         task.setdefault('created_date', datetime.now().isoformat())
+                if filename in RECORD_ID_FIELDS:
+                    apply_record_journal(data, filename)
                 return data
         return default_value
     except json.JSONDecodeError:
@@ -297,27 +376,578 @@ def load_data(filename, default_value=None):
         return default_value
 
 def save_data(data, filename):
-    with open(filename, "w") as file:
+    # Write to a temporary file and swap it in, so a crash mid-write never leaves a truncated file
+    # and a batch of changes lands all at once. Returns (version replaced, version written) for
+    # update_derived_view().
+    previous_version = get_file_version(filename)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(filename) or ".", prefix=".saving-", suffix=".json", delete=False) as file:
         json.dump(data, file, indent=4, cls=DateEncoder)
+    if os.path.exists(filename):
+        os.chmod(file.name, os.stat(filename).st_mode & 0o777) # Keep the original file permissions
+    saved_stat = os.stat(file.name) # A rename keeps the modification time and size
+    os.replace(file.name, filename)
+    if filename in RECORD_ID_FIELDS and os.path.exists(get_record_journal_path(filename)):
+        os.remove(get_record_journal_path(filename)) # The full save already contains every journaled patch
+    return previous_version, f"{saved_stat.st_mtime_ns}-{saved_stat.st_size}"
+
+# --- Derived Index Cache ---
+# In-memory indexes derived from a data file (search index, registries, aggregates) are shared across
+# sessions and tagged with the version of the file they were built from. Readers rebuild a view only when
+# the file was changed by someone else; our own writes patch the view in place via update_derived_view().
+# Because views are patched in place, anything that reads a view's contents must do so inside
+# derived_views_locked() and must not keep references to its inner objects past that block.
+def get_file_version(filename):
+    # Cheap change marker: a rewrite always changes the modification time and usually the size
+    try:
+        file_stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    version = f"{file_stat.st_mtime_ns}-{file_stat.st_size}"
+    if filename in RECORD_ID_FIELDS and os.path.exists(get_record_journal_path(filename)):
+        version += f"-{os.path.getsize(get_record_journal_path(filename))}" # Appended patches change the data too
+    return version
+
+@st.cache_resource
+def get_derived_views():
+    return {}, threading.RLock() # Re-entrant so a locked reader can still fetch (or rebuild) other views
+
+def derived_views_locked():
+    return get_derived_views()[1]
+
+def get_derived_view(name, source_file, build_fn, load_fn=load_data):
+    views, views_lock = get_derived_views()
+    source_version = get_file_version(source_file)
+    with views_lock:
+        view = views.get(name)
+        if view is None or view['source_version'] != source_version:
+            view = {"source_version": source_version, "data": build_fn(load_fn(source_file))}
+            views[name] = view
+        return view['data']
+
+def update_derived_view(name, source_file, update_fn, file_write):
+    # Call right after writing source_file, with the (version replaced, version written) pair from
+    # save_data(). The view is patched only if it was built from the version our write replaced and
+    # nobody has written since; otherwise it is dropped and the next reader rebuilds it from the file.
+    previous_version, saved_version = file_write
+    views, views_lock = get_derived_views()
+    with views_lock:
+        view = views.get(name)
+        if view is None or view['source_version'] == saved_version:
+            return # Not built yet, or a reader already rebuilt it from our write
+        if view['source_version'] != previous_version or get_file_version(source_file) != saved_version:
+            del views[name]
+            return
+        update_fn(view['data'])
+        view['source_version'] = saved_version
+
+# --- Record Patch API ---
+# Field-level updates to individual records by ID. A patch is appended as one line to the file's journal
+# (<file>.patches.jsonl) instead of rewriting the whole file, so its cost does not grow with the number of
+# records. load_data() replays the journal over the file, and any full save_data() of the file supersedes
+# it. Once a journal outgrows RECORD_JOURNAL_COMPACT_BYTES it is folded back into the file. Each file's
+# parsed records are kept as a derived view with an {id: position} index to check IDs and stay current.
+def get_record_journal_path(filename):
+    return filename + ".patches.jsonl"
+
+def apply_record_journal(records, filename):
+    journal_path = get_record_journal_path(filename)
+    if not os.path.exists(journal_path):
+        return
+    id_field = RECORD_ID_FIELDS[filename]
+    positions = {str(rec.get(id_field)): position for position, rec in enumerate(records)}
+    with open(journal_path, "r") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue # A line torn by a crash mid-append
+            position = positions.get(str(entry.get('id')))
+            if position is not None:
+                records[position].update(entry.get('fields', {}))
+
+@st.cache_resource
+def get_record_patch_lock():
+    return threading.Lock()
+
+def get_record_table(filename):
+    id_field = RECORD_ID_FIELDS[filename]
+    def build_record_table(records):
+        return {"records": records, "positions": {str(rec.get(id_field)): position for position, rec in enumerate(records)}}
+    return get_derived_view(f"records:{filename}", filename, build_record_table)
+
+def patch_records(filename, patches):
+    # patches: {record_id: {field: new_value}}. Returns the IDs that were not found (and not patched).
+    # Returns (IDs that were not found and not patched, (version replaced, version written) of the file)
+    missing_ids = []
+    with get_record_patch_lock(), derived_views_locked():
+        table = get_record_table(filename)
+        journal_lines = []
+        for record_id, fields in patches.items():
+            position = table['positions'].get(str(record_id))
+            if position is None:
+                missing_ids.append(record_id)
+                continue
+            fields = copy.deepcopy(fields) # The table is shared between sessions; never alias the caller's objects
+            table['records'][position].update(fields)
+            journal_lines.append(json.dumps({"id": str(record_id), "fields": fields}, cls=DateEncoder) + "\n")
+        file_write = (get_file_version(filename),) * 2
+        if journal_lines:
+            journal_path = get_record_journal_path(filename)
+            with open(journal_path, "a") as journal:
+                journal.write("".join(journal_lines))
+            file_write = (file_write[0], get_file_version(filename))
+            if os.path.getsize(journal_path) > RECORD_JOURNAL_COMPACT_BYTES:
+                file_write = (file_write[0], save_data(table['records'], filename)[1]) # Also clears the journal
+            update_derived_view(f"records:{filename}", filename, lambda table: None, file_write)
+    return missing_ids, file_write
+
+# --- Request Numbering ---
+# Human-readable request numbers (REQ-0051, LEAVE-0009) come from a per-document-type sequence in
+# SEQUENCES_FILE. Each process reserves a block of numbers under a short file lock and then hands them
+# out from an in-memory counter, so concurrent submitters never share a number. Numbers reserved by a
+# process that restarts are skipped, which leaves small gaps.
+DOCUMENT_NUMBER_FORMATS = {"opex_capex": "REQ-{:04d}", "leave": "LEAVE-{:04d}"}
+LEGACY_REQUEST_NUMBER_PATTERN = re.compile(r"^(?:[A-Za-z]+[-_])?(\d{1,6})$") # 8, OC-0023, OPEXCAPEX_0028, REQ-0049
+DATA_LOCK_TIMEOUT_SECONDS = 10
+DATA_LOCK_STALE_SECONDS = 30 # A lock file older than this was left behind by a crashed process
+
+@contextlib.contextmanager
+def data_file_lock(filename, lock_name):
+    # Cross-process lock for a read-modify-write of filename. O_EXCL creation is atomic on every
+    # platform, so only one process can hold the lock file.
+    lock_path = filename + ".lock"
+    deadline = time.monotonic() + DATA_LOCK_TIMEOUT_SECONDS
+    while True:
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > DATA_LOCK_STALE_SECONDS:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for the {lock_name} lock.")
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(lock_fd)
+        os.remove(lock_path)
+
+def sequence_file_lock():
+    return data_file_lock(SEQUENCES_FILE, "request number")
+
+def reserve_sequence_block(doc_type, block_size, minimum_next=1):
+    # Returns the reserved range [start, end) and advances the stored sequence past it
+    with sequence_file_lock():
+        sequences = load_data(SEQUENCES_FILE, default_value={})
+        entry = sequences.setdefault(doc_type, {"next": 1})
+        start = max(entry['next'], minimum_next)
+        entry['next'] = start + block_size
+        save_data(sequences, SEQUENCES_FILE)
+    return start, start + block_size
+
+@st.cache_resource
+def get_sequence_blocks():
+    # {doc_type: {"counter": itertools.count, "end": int}} shared by every session in this process
+    return {}, threading.Lock()
+
+def allocate_document_number(doc_type):
+    blocks, refill_lock = get_sequence_blocks()
+    while True:
+        block = blocks.get(doc_type)
+        if block is not None:
+            number = next(block['counter']) # Atomic under the GIL, so the common path takes no lock
+            if number < block['end']:
+                return DOCUMENT_NUMBER_FORMATS[doc_type].format(number)
+        with refill_lock:
+            if blocks.get(doc_type) is block: # Another session may have refilled while we waited
+                start, end = reserve_sequence_block(doc_type, SEQUENCE_BLOCK_SIZE)
+                blocks[doc_type] = {"counter": itertools.count(start), "end": end}
+
+def parse_request_number(value):
+    match = LEGACY_REQUEST_NUMBER_PATTERN.match(str(value or "").strip())
+    return int(match.group(1)) if match else None
+
+def backfill_request_numbers(filename, doc_type):
+    # Gives every historical request a request_number. Numbers already embedded in legacy IDs are kept;
+    # the rest are numbered in submission order after the highest one. Also seeds the sequence, so new
+    # numbers always follow the existing ones. Runs once per document type: the request file and the
+    # sequence file stay locked from the check to the backfilled flag, so concurrent starts number once.
+    with data_file_lock(filename, f"{doc_type} requests"), sequence_file_lock():
+        sequences = load_data(SEQUENCES_FILE, default_value={})
+        entry = sequences.setdefault(doc_type, {"next": 1})
+        if entry.get('backfilled'):
+            return
+        records = load_data(filename)
+        used_numbers = set()
+        unnumbered = []
+        for rec in records:
+            number = parse_request_number(rec.get('request_number') or rec.get('request_id'))
+            if number is None or number in used_numbers:
+                unnumbered.append(rec)
+            else:
+                used_numbers.add(number)
+                rec['request_number'] = DOCUMENT_NUMBER_FORMATS[doc_type].format(number)
+        start = max(entry['next'], max(used_numbers, default=0) + 1)
+        unnumbered.sort(key=lambda rec: str(rec.get('submission_date') or rec.get('request_date') or ""))
+        for number, rec in enumerate(unnumbered, start):
+            rec['request_number'] = DOCUMENT_NUMBER_FORMATS[doc_type].format(number)
+        if records:
+            save_data(records, filename)
+        entry['next'] = start + len(unnumbered)
+        entry['backfilled'] = True
+        save_data(sequences, SEQUENCES_FILE)
+
+# --- Content-Addressed Attachment Store ---
+# Uploaded documents are stored once per unique content under hr_data/blobs/<hash[:2]>/<hash>.
+# attachments.json keeps the per-upload metadata (original name, owner) and a reference count per blob,
+# so identical uploads share one file. Releasing an upload only updates the metadata; blob files are
+# removed solely by the clean-up sweep. Uploads, releases and the sweep update attachments.json under
+# attachment_store_lock(). Blobs are written (or touched, if the content already exists) before they are
+# registered, so the sweep leaves files younger than BLOB_GC_GRACE_SECONDS alone rather than deleting an
+# upload that is about to be registered.
+BLOB_GC_GRACE_SECONDS = 60 * 60
+
+def attachment_store_lock():
+    return data_file_lock(ATTACHMENTS_FILE, "attachment store")
+
+def load_attachment_store():
+    store = load_data(ATTACHMENTS_FILE, {"blobs": {}, "attachments": {}})
+    store.setdefault('blobs', {})
+    store.setdefault('attachments', {})
+    return store
+
+def get_blob_path(blob_hash):
+    return os.path.join(BLOB_STORE_DIR, blob_hash[:2], blob_hash)
+
+def write_blob(file_obj):
+    # Stream the file into a temporary file while hashing it chunk by chunk, so large scans
+    # are never held in memory in full. The temporary file is then either promoted to its
+    # content-addressed path or discarded if an identical blob already exists.
+    hasher = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=BLOB_STORE_DIR, prefix=".upload-", delete=False) as tmp_file:
+        tmp_path = tmp_file.name
+        for chunk in iter(lambda: file_obj.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            tmp_file.write(chunk)
+            size += len(chunk)
+    blob_hash = hasher.hexdigest()
+    blob_path = get_blob_path(blob_hash)
+    try:
+        os.utime(blob_path) # Duplicate content: restart its grace period so a sweep cannot remove it before it is registered
+        os.remove(tmp_path)
+    except FileNotFoundError: # New content, or the old copy was swept in the meantime
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(tmp_path, blob_path)
+    return blob_hash, size
+
+def hash_file_object(file_obj):
+    # Content hash of an upload without writing it to the blob store; leaves the file at its start
+    file_obj.seek(0)
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: file_obj.read(UPLOAD_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+    file_obj.seek(0)
+    return hasher.hexdigest()
+
+def add_attachment(store, blob_hash, size, original_name, owner_staff_id=None, category=None):
+    blob_entry = store['blobs'].setdefault(blob_hash, {"size": size, "ref_count": 0, "created_date": datetime.now().isoformat()})
+    blob_entry['ref_count'] += 1
+    attachment = {
+        "attachment_id": str(uuid.uuid4()),
+        "blob_hash": blob_hash,
+        "original_name": original_name,
+        "owner_staff_id": owner_staff_id,
+        "category": category,
+        "size": size,
+        "content_type": mimetypes.guess_type(original_name)[0] or "application/octet-stream",
+        "uploaded_date": datetime.now().isoformat()
+    }
+    store['attachments'][attachment['attachment_id']] = attachment
+    return attachment
 
-def save_uploaded_file(uploaded_file, destination_folder="uploaded_documents"):
+def save_uploaded_file(uploaded_file, destination_folder="uploaded_documents", owner_staff_id=None):
+    # Returns the attachment record (with the blob 'path') or None if nothing was uploaded.
+    # destination_folder is kept as the attachment category for reporting.
     if uploaded_file is not None:
-        if not os.path.exists(destination_folder):
-            os.makedirs(destination_folder)
-
-        file_path = os.path.join(destination_folder, uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        return file_path
+        uploaded_file.seek(0)
+        blob_hash, size = write_blob(uploaded_file)
+        with attachment_store_lock():
+            store = load_attachment_store()
+            attachment = add_attachment(store, blob_hash, size, uploaded_file.name, owner_staff_id, destination_folder)
+            save_data(store, ATTACHMENTS_FILE)
+        return dict(attachment, path=get_blob_path(blob_hash))
     return None
 
+def release_attachment(attachment_id):
+    # Drop one reference to a blob. The file itself stays until garbage_collect_blobs() finds it unreferenced
+    # and past its grace period, so an identical upload being registered at the same time keeps its blob.
+    with attachment_store_lock():
+        store = load_attachment_store()
+        attachment = store['attachments'].pop(attachment_id, None)
+        if attachment is None:
+            return False
+        blob_entry = store['blobs'].get(attachment['blob_hash'])
+        if blob_entry is not None:
+            blob_entry['ref_count'] -= 1
+            if blob_entry['ref_count'] <= 0:
+                del store['blobs'][attachment['blob_hash']]
+        save_data(store, ATTACHMENTS_FILE)
+    return True
+
+def get_referenced_attachment_ids():
+    return {
+        req['attachment_id']
+        for filename in [LEAVE_REQUESTS_FILE, OPEX_CAPEX_REQUESTS_FILE]
+        for req in load_data(filename) if req.get('attachment_id')
+    }
+
+def garbage_collect_blobs():
+    # Full sweep: drop attachment records no request points at (abandoned or failed submissions),
+    # recompute reference counts from the remaining records and remove blob files and abandoned
+    # temporary uploads that nothing references. Anything newer than BLOB_GC_GRACE_SECONDS may belong
+    # to an upload in progress and is kept. Returns (attachments released, bytes freed).
+    grace_cutoff = time.time() - BLOB_GC_GRACE_SECONDS
+    referenced_ids = get_referenced_attachment_ids()
+    with attachment_store_lock():
+        store = load_attachment_store()
+        released_ids = [
+            attachment_id for attachment_id, attachment in store['attachments'].items()
+            if attachment_id not in referenced_ids and datetime.fromisoformat(attachment['uploaded_date']).timestamp() < grace_cutoff
+        ]
+        for attachment_id in released_ids:
+            del store['attachments'][attachment_id]
+        ref_counts = {}
+        for attachment in store['attachments'].values():
+            ref_counts[attachment['blob_hash']] = ref_counts.get(attachment['blob_hash'], 0) + 1
+        for blob_hash in list(store['blobs'].keys()):
+            if blob_hash in ref_counts:
+                store['blobs'][blob_hash]['ref_count'] = ref_counts[blob_hash]
+            else:
+                del store['blobs'][blob_hash]
+        freed_bytes = 0
+        for root, _, files in os.walk(BLOB_STORE_DIR):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                if file_name in store['blobs'] or os.path.getmtime(file_path) >= grace_cutoff:
+                    continue
+                freed_bytes += os.path.getsize(file_path)
+                os.remove(file_path)
+        save_data(store, ATTACHMENTS_FILE)
+    return len(released_ids), freed_bytes
+
+def document_storage_page():
+    st.header("Document Storage")
+    store = load_attachment_store()
+    referenced_ids = get_referenced_attachment_ids()
+    col_blobs, col_size, col_unreferenced = st.columns(3)
+    col_blobs.metric("Stored Documents", len(store['blobs']))
+    col_size.metric("Storage Used (MB)", f"{sum(blob.get('size', 0) for blob in store['blobs'].values()) / (1024 * 1024):,.2f}")
+    col_unreferenced.metric("Uploads Not Linked to a Request", sum(1 for attachment_id in store['attachments'] if attachment_id not in referenced_ids))
+    st.write(f"Cleaning up removes uploads that no request refers to and stored files that no upload refers to. "
+             f"Anything from the last {BLOB_GC_GRACE_SECONDS // 60} minutes is kept, as it may belong to a submission in progress.")
+    if st.button("Clean Up Unused Documents"):
+        released_count, freed_bytes = garbage_collect_blobs()
+        st.success(f"Removed {released_count} unlinked upload(s) and freed {freed_bytes / (1024 * 1024):,.2f} MB.")
+
+def normalize_legacy_path(path):
+    # Older records were saved on Windows with backslash separators
+    return path.replace('\\', os.sep).replace('/', os.sep) if path else path
+
+def migrate_legacy_documents():
+    # One-time import of documents saved by the old filename-based uploader. Every file referenced
+    # by a leave or OPEX/CAPEX request is copied into the blob store (identical copies collapse into
+    # one blob) and the request is re-pointed at its attachment. The legacy files are left where they
+    # are and can be archived once the migration has been checked. Runs under the request and
+    # attachment store locks, so processes starting together import each document once.
+    with leave_requests_lock(), opex_capex_requests_lock(), attachment_store_lock():
+        store = load_attachment_store()
+        if store.get('legacy_migrated'):
+            return
+        imported = {} # legacy path -> (blob_hash, size)
+        for filename, category in [(LEAVE_REQUESTS_FILE, "leave_documents"), (OPEX_CAPEX_REQUESTS_FILE, "opex_capex_documents")]:
+            requests_data = load_data(filename)
+            changed = False
+            for req in requests_data:
+                legacy_path = normalize_legacy_path(req.get('document_path'))
+                if req.get('attachment_id') or not legacy_path:
+                    continue
+                if legacy_path not in imported:
+                    if not os.path.exists(legacy_path):
+                        continue
+                    with open(legacy_path, "rb") as legacy_file:
+                        imported[legacy_path] = write_blob(legacy_file)
+                blob_hash, size = imported[legacy_path]
+                attachment = add_attachment(store, blob_hash, size, os.path.basename(legacy_path), req.get('requester_staff_id'), category)
+                req['attachment_id'] = attachment['attachment_id']
+                req['document_path'] = get_blob_path(blob_hash)
+                changed = True
+            if changed:
+                save_data(requests_data, filename)
+        store['legacy_migrated'] = True
+        save_data(store, ATTACHMENTS_FILE)
+
+def get_request_document(request_data):
+    # Returns (path, download file name) for a request's supporting document, or (None, None)
+    attachment_id = request_data.get('attachment_id')
+    if attachment_id:
+        attachment = load_attachment_store()['attachments'].get(attachment_id)
+        if attachment:
+            blob_path = get_blob_path(attachment['blob_hash'])
+            if os.path.exists(blob_path):
+                return blob_path, attachment['original_name']
+    legacy_path = normalize_legacy_path(request_data.get('document_path'))
+    if legacy_path and os.path.exists(legacy_path):
+        return legacy_path, os.path.basename(legacy_path)
+    return None, None
+
+# --- Attachment Previews ---
+# Approvers see a downscaled image (or the first page of a PDF) inline instead of downloading the
+# full scan. Previews are rendered on a shared worker pool and cached on disk by blob hash, so each
+# unique document is rendered once no matter how many requests reference it.
+@st.cache_resource
+def get_preview_executor():
+    return ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="attachment-preview")
+
+@st.cache_resource
+def get_preview_jobs():
+    # In-flight preview jobs by blob hash, shared across sessions so a document is never rendered twice at once
+    return {}, threading.Lock()
+
+def get_preview_path(blob_hash):
+    return os.path.join(PREVIEW_CACHE_DIR, f"{blob_hash}.jpg")
+
+def render_preview(blob_hash, content_type):
+    # Runs on a worker thread
+    preview_path = get_preview_path(blob_hash)
+    if os.path.exists(preview_path):
+        return preview_path
+    blob_path = get_blob_path(blob_hash)
+    if content_type == "application/pdf":
+        if pymupdf is None:
+            return None
+        with pymupdf.open(blob_path) as pdf_document:
+            first_page = pdf_document[0]
+            zoom = PREVIEW_MAX_DIMENSION / max(first_page.rect.width, first_page.rect.height)
+            pixmap = first_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    elif content_type.startswith("image/"):
+        image = Image.open(blob_path)
+        image.draft("RGB", (PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION)) # Lets JPEG decode at a reduced scale
+        image.thumbnail((PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION))
+        image = image.convert("RGB")
+    else:
+        return None
+    # Write to a temporary file first so readers never see a half-written preview
+    with tempfile.NamedTemporaryFile(dir=PREVIEW_CACHE_DIR, prefix=".preview-", delete=False) as tmp_file:
+        image.save(tmp_file, "JPEG", quality=80, optimize=True)
+    os.replace(tmp_file.name, preview_path)
+    evict_preview_cache()
+    return preview_path
+
+def evict_preview_cache():
+    # Keep the cache under PREVIEW_CACHE_MAX_BYTES by deleting the least recently viewed previews
+    entries = []
+    total_bytes = 0
+    for entry in os.scandir(PREVIEW_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".jpg"):
+            entry_stat = entry.stat()
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+            total_bytes += entry_stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total_bytes <= PREVIEW_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+        except FileNotFoundError:
+            pass # Already evicted by another worker
+
+def request_attachment_preview(attachment):
+    # Returns a Future resolving to the preview path (or None if the file type has no preview)
+    blob_hash = attachment['blob_hash']
+    preview_path = get_preview_path(blob_hash)
+    if os.path.exists(preview_path):
+        os.utime(preview_path) # Mark as recently viewed for eviction
+        cached = Future()
+        cached.set_result(preview_path)
+        return cached
+    jobs, jobs_lock = get_preview_jobs()
+    with jobs_lock:
+        future = jobs.get(blob_hash)
+        if future is None:
+            future = get_preview_executor().submit(render_preview, blob_hash, attachment.get('content_type', ''))
+            jobs[blob_hash] = future
+            future.add_done_callback(lambda _: jobs.pop(blob_hash, None))
+    return future
+
+def prefetch_attachment_previews(requests_data):
+    # Queue previews for every request on an approver's list so opening one is a cache hit
+    attachments = load_attachment_store()['attachments']
+    for req in requests_data:
+        attachment = attachments.get(req.get('attachment_id'))
+        if attachment:
+            request_attachment_preview(attachment)
+
+def display_attachment_preview(request_data):
+    attachment = load_attachment_store()['attachments'].get(request_data.get('attachment_id'))
+    if not attachment:
+        return
+    try:
+        preview_path = request_attachment_preview(attachment).result(timeout=PREVIEW_WAIT_SECONDS)
+    except FutureTimeoutError:
+        st.info("Preview is still being generated. It will appear when you next open this request.")
+        return
+    except Exception as e:
+        st.caption(f"Preview unavailable for {attachment['original_name']}: {e}")
+        return
+    if preview_path:
+        st.image(preview_path, caption=f"Preview: {attachment['original_name']}")
+    else:
+        st.caption(f"No inline preview available for {attachment['original_name']}.")
+
+# --- Shared PDF Layout ---
+# Every generated document uses the same page frame: a centred title on each page and a page-numbered footer.
+def pdf_text(value):
+    # FPDF's core fonts are Latin-1 only; anything else is replaced rather than failing the whole document
+    return str(value).encode('latin-1', 'replace').decode('latin-1')
+
+class ReportPDF(FPDF):
+    def __init__(self, title):
+        super().__init__()
+        self.report_title = title
+        self.set_auto_page_break(True, margin=15)
+
+    def header(self):
+        self.set_font("Arial", "B", 16)
+        self.cell(0, 10, pdf_text(self.report_title), 0, 1, "C")
+        self.ln(10)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font("Arial", "I", 8)
+        self.cell(0, 10, f"Polaris Digitech HR Portal - Page {self.page_no()}", 0, 0, "C")
+
+    def section_heading(self, text):
+        self.set_x(self.l_margin)
+        self.set_font("Arial", "B", 12)
+        self.cell(0, 10, pdf_text(text), 0, 1)
+        self.set_font("Arial", "", 10)
+
+    def labelled_text(self, label, value, line_height=7):
+        self.set_x(self.l_margin)
+        self.multi_cell(0, line_height, pdf_text(f"{label}: {value}"), 0, 'L')
+
 # --- PDF Generation Function (New) ---
 def generate_opex_capex_pdf(request_data):
-    pdf = FPDF()
+    pdf = ReportPDF("OPEX/CAPEX Requisition Summary")
     pdf.add_page()
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(200, 10, "OPEX/CAPEX Requisition Summary", 0, 1, "C")
-    pdf.ln(10)
 
     # Set font for content
     pdf.set_font("Arial", "", 10)
@@ -358,6 +988,8 @@ def generate_opex_capex_pdf(request_data):
     vendor_bank = get_data('vendor_bank')
 
     # Print main details
+    pdf.write(line_height, f"Request Number: {get_data('request_number') or get_data('request_id')}")
+    pdf.ln(line_height)
     pdf.write(line_height, f"Requester: {requester_name} ({requester_department})")
     pdf.ln(line_height)
     pdf.write(line_height, f"Request Type: {request_type}")
@@ -407,7 +1039,7 @@ def generate_opex_capex_pdf(request_data):
         pdf.multi_cell(0, line_height, "No approval history recorded.", 0, 'L')
 
     # Save the PDF
-    pdf_filename = f"OPEX_CAPEX_Request_{request_data['request_id']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    pdf_filename = f"OPEX_CAPEX_Request_{request_data.get('request_number') or request_data['request_id']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
     pdf_path = os.path.join("opex_capex_pdfs", pdf_filename)
     pdf.output(pdf_path)
     return pdf_path
@@ -761,10 +1393,20 @@ def setup_initial_data():
         save_data(initial_payroll_data, PAYROLL_FILE)
     # Ensure other files are initialized as empty lists if they don't exist
     for filename in [LEAVE_REQUESTS_FILE, OPEX_CAPEX_REQUESTS_FILE, PERFORMANCE_GOALS_FILE,
-                     SELF_APPRAISALS_FILE, BENEFICIARIES_FILE, CHAT_MESSAGES_FILE,
+                     SELF_APPRAISALS_FILE, BENEFICIARIES_FILE,
                      ATTENDANCE_RECORDS_FILE, DISCIPLINARY_RECORDS_FILE, DAILY_TASKS_FILE]:
         if not os.path.exists(filename) or os.path.getsize(filename) == 0:
             save_data([], filename) # Save empty list to initialize
+    if not os.path.exists(ATTACHMENTS_FILE) or os.path.getsize(ATTACHMENTS_FILE) == 0:
+        save_data({"blobs": {}, "attachments": {}}, ATTACHMENTS_FILE)
+    # Move documents from the old filename-based upload folders into the blob store (runs once)
+    migrate_legacy_documents()
+    # Give historical requests REQ-/LEAVE- numbers and seed the number sequences (runs once)
+    backfill_request_numbers(OPEX_CAPEX_REQUESTS_FILE, "opex_capex")
+    backfill_request_numbers(LEAVE_REQUESTS_FILE, "leave")
+    # Split the old single chat file into per-conversation logs (runs once)
+    migrate_legacy_chat_messages()
+    migrate_chat_read_state()
 
 
 # --- Authentication Functions ---
@@ -954,6 +1596,151 @@ def display_dashboard():
             st.session_state.current_page = "view_company_policy"
             st.rerun()
 
+# --- Paginated Tables ---
+# Admin list views filter, sort and page on the server and only hand the visible page to st.dataframe,
+# so the payload sent to the browser stays the same size however large the collection grows.
+PAGINATED_TABLE_PAGE_SIZES = [25, 50, 100, 250]
+
+def project_records(records, columns):
+    # columns maps a display label to a record field or a callable(record); only these columns are materialized
+    return pd.DataFrame.from_records(
+        [{label: (field(rec) if callable(field) else rec.get(field)) for label, field in columns.items()} for rec in records],
+        columns=list(columns.keys())
+    )
+
+def sort_table_column(column, descending):
+    try:
+        return column.sort_values(ascending=not descending, na_position='last', kind='stable')
+    except TypeError:
+        # Mixed value types (e.g. legacy integer and string IDs) sort by their text
+        return column.sort_values(ascending=not descending, na_position='last', kind='stable', key=lambda values: values.astype(str))
+
+def paginated_table(key, df, default_sort=None, filter_columns=()):
+    if df.empty:
+        st.info("No records to display.")
+        return
+
+    col_filter, col_sort, col_order, col_size = st.columns([3, 2, 1, 1])
+    with col_filter:
+        text_filter = st.text_input("Filter rows", key=f"{key}_filter")
+    with col_sort:
+        sort_options = list(df.columns)
+        sort_column = st.selectbox("Sort by", sort_options, index=sort_options.index(default_sort) if default_sort in sort_options else 0, key=f"{key}_sort")
+    with col_order:
+        sort_order = st.selectbox("Order", ["Descending", "Ascending"], key=f"{key}_order")
+    with col_size:
+        page_size = st.selectbox("Rows per page", PAGINATED_TABLE_PAGE_SIZES, key=f"{key}_page_size")
+
+    facet_selections = {}
+    if filter_columns:
+        facet_cols = st.columns(len(filter_columns))
+        for facet_col, column in zip(facet_cols, filter_columns):
+            with facet_col:
+                values = sorted(str(value) for value in df[column].dropna().unique())
+                facet_selections[column] = st.multiselect(column, values, key=f"{key}_facet_{column}")
+    visible_columns = st.multiselect("Columns", list(df.columns), default=list(df.columns), key=f"{key}_columns") or list(df.columns)
+
+    view = df
+    for column, selected in facet_selections.items():
+        if selected:
+            view = view[view[column].astype(str).isin(selected)]
+    if text_filter:
+        mask = pd.Series(False, index=view.index)
+        for column in visible_columns:
+            mask |= view[column].astype(str).str.contains(text_filter, case=False, regex=False, na=False)
+        view = view[mask]
+
+    total_rows = len(view)
+    page_count = max(1, math.ceil(total_rows / page_size))
+    # Go back to the first page whenever the filters or sort order change, and keep the page in range
+    page_key = f"{key}_page"
+    signature = (text_filter, sort_column, sort_order, page_size, tuple((column, tuple(selected)) for column, selected in facet_selections.items()))
+    if st.session_state.get(f"{key}_signature") != signature:
+        st.session_state[f"{key}_signature"] = signature
+        st.session_state[page_key] = 1
+    st.session_state[page_key] = min(max(1, int(st.session_state.get(page_key, 1))), page_count)
+    page = st.session_state[page_key]
+
+    # Sort just the sort column and pick the page's row labels; only those rows and visible columns are serialized
+    start = (page - 1) * page_size
+    page_index = sort_table_column(view[sort_column], sort_order == "Descending").index[start:start + page_size]
+    st.dataframe(view.loc[page_index, visible_columns], use_container_width=True, hide_index=True)
+
+    col_caption, col_page = st.columns([3, 1])
+    with col_caption:
+        if total_rows:
+            st.caption(f"Rows {start + 1}-{start + len(page_index)} of {total_rows} (page {page} of {page_count})")
+        else:
+            st.caption("No rows match the current filters.")
+    with col_page:
+        st.number_input("Page", min_value=1, max_value=page_count, step=1, key=page_key)
+
+    # Exports cover every filtered row (not just this page) in the chosen sort order, built only when clicked
+    export_table_buttons(key, lambda: view.loc[sort_table_column(view[sort_column], sort_order == "Descending").index, visible_columns], key.removesuffix("_table"))
+
+# --- Table Exports ---
+# Exports are handed to st.download_button as callables, so nothing is generated unless the button is
+# clicked. Rows are then written chunk by chunk into a temporary file on disk rather than an in-memory
+# buffer, which keeps memory bounded while long histories are exported.
+EXPORT_CHUNK_ROWS = 5000
+
+def iter_frame_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+def new_export_file():
+    # Unbuffered so st.download_button accepts it as a raw file; each write is already a whole chunk
+    return tempfile.TemporaryFile(mode="w+b", buffering=0)
+
+def write_csv_export(df):
+    export_file = new_export_file()
+    export_file.write(df.iloc[:0].to_csv(index=False).encode("utf-8")) # Header row, even when no rows match
+    for chunk in iter_frame_chunks(df):
+        export_file.write(chunk.to_csv(index=False, header=False).encode("utf-8"))
+    export_file.seek(0)
+    return export_file
+
+def excel_cell_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)) or value is pd.NaT:
+        return None
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value) # Dates, timestamps and anything else are written as text
+
+def write_xlsx_export(df, sheet_name="Export"):
+    export_file = new_export_file()
+    # constant_memory flushes each row to disk as soon as the next one starts
+    workbook = xlsxwriter.Workbook(export_file, {"constant_memory": True})
+    worksheet = workbook.add_worksheet(sheet_name[:31])
+    header_format = workbook.add_format({"bold": True})
+    worksheet.write_row(0, 0, [str(column) for column in df.columns], header_format)
+    row_number = 1
+    for chunk in iter_frame_chunks(df):
+        for values in chunk.itertuples(index=False, name=None):
+            worksheet.write_row(row_number, 0, [excel_cell_value(value) for value in values])
+            row_number += 1
+    workbook.close()
+    export_file.seek(0)
+    return export_file
+
+def export_table_buttons(key, get_frame, file_stem):
+    # get_frame returns the filtered DataFrame to export; it is only called when a download is requested
+    file_stem = f"{file_stem}_{datetime.now().strftime('%Y%m%d')}"
+    col_csv, col_xlsx = st.columns(2)
+    with col_csv:
+        st.download_button(
+            "Export CSV", data=lambda: write_csv_export(get_frame()), file_name=f"{file_stem}.csv",
+            mime="text/csv", on_click="ignore", key=f"{key}_export_csv"
+        )
+    with col_xlsx:
+        if xlsxwriter is not None:
+            st.download_button(
+                "Export Excel", data=lambda: write_xlsx_export(get_frame(), file_stem), file_name=f"{file_stem}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", on_click="ignore", key=f"{key}_export_xlsx"
+            )
+        else:
+            st.caption("Install xlsxwriter to enable Excel exports.")
+
 
 # --- User Management (Admin Only) ---
 def admin_manage_users():
@@ -1126,9 +1913,16 @@ def request_leave():
                 st.error("End Date cannot be before Start Date.")
             else:
                 duration_days = (end_date - start_date).days + 1
-                doc_path = save_uploaded_file(supporting_document, "leave_documents")
+                attachment = save_uploaded_file(supporting_document, "leave_documents", current_user_staff_id)
+                try:
+                    request_number = allocate_document_number("leave")
+                except TimeoutError:
+                    if attachment:
+                        release_attachment(attachment['attachment_id']) # The request was never created
+                    raise
                 new_request = {
-                    "request_id": str(uuid.uuid4()),
+                    "request_id": request_number,
+                    "request_number": request_number,
                     "requester_staff_id": current_user_staff_id,
                     "requester_name": st.session_state.current_user['profile']['name'],
                     "leave_type": leave_type,
@@ -1136,12 +1930,15 @@ def request_leave():
                     "end_date": end_date.isoformat(),
                     "duration_days": duration_days,
                     "reason": reason,
-                    "document_path": doc_path,
+                    "document_path": attachment['path'] if attachment else None,
+                    "attachment_id": attachment['attachment_id'] if attachment else None,
                     "status": "Pending", # Initial status
                     "request_date": datetime.now().isoformat()
                 }
-                leave_requests.append(new_request)
-                save_data(leave_requests, LEAVE_REQUESTS_FILE)
+                with leave_requests_lock():
+                    leave_requests = load_data(LEAVE_REQUESTS_FILE) # Keep decisions saved since the page loaded
+                    leave_requests.append(new_request)
+                    save_data(leave_requests, LEAVE_REQUESTS_FILE)
                 st.success("Leave request submitted successfully! Awaiting HR approval.")
                 st.rerun()
 
@@ -1161,17 +1958,39 @@ def request_leave():
     else:
         st.info("You have not submitted any leave requests yet.")
 
+# New requests and legacy records name some fields differently, so those columns fall back across both.
+# load_data() fills the new fields with placeholders ('N/A', 0 days, a load-time request_date) on legacy
+# records, so the legacy field wins wherever it is present.
+LEAVE_REQUESTS_TABLE_COLUMNS = {
+    "Request No.": lambda req: req.get('request_number') or req.get('request_id'),
+    "Staff ID": lambda req: req.get('staff_id') or req.get('requester_staff_id'),
+    "Requester": lambda req: req.get('staff_name') or req.get('requester_name'),
+    "Leave Type": 'leave_type',
+    "Start Date": 'start_date',
+    "End Date": 'end_date',
+    "Days": lambda req: req.get('num_days') or req.get('duration_days'),
+    "Status": 'status',
+    "Reviewed By": 'reviewed_by',
+    "Submitted": lambda req: str(req.get('submission_date') or req.get('request_date') or "")[:19]
+}
+
 def admin_manage_leave():
     st.header("Manage Leave Requests (HR)")
     leave_requests = load_data(LEAVE_REQUESTS_FILE)
+    reviewer_name = st.session_state.current_user['profile']['name']
 
     if not leave_requests:
         st.info("No leave requests submitted yet.")
         return
 
     st.subheader("All Leave Requests")
+    paginated_table(
+        "leave_requests_table",
+        project_records(leave_requests, LEAVE_REQUESTS_TABLE_COLUMNS),
+        default_sort="Submitted",
+        filter_columns=("Status", "Leave Type")
+    )
     df_leave_requests = pd.DataFrame(leave_requests)
-    st.dataframe(df_leave_requests)
 
     st.subheader("Leave Request Statistics")
     if not df_leave_requests.empty:
@@ -1202,6 +2021,7 @@ def admin_manage_leave():
     st.subheader("Approve/Reject Leave Requests")
     pending_requests = [req for req in leave_requests if req['status'] == 'Pending']
     if pending_requests:
+        prefetch_attachment_previews(pending_requests)
         request_to_review = st.selectbox(
             "Select a pending request to review:",
             [""] + [f"{req['requester_name']} ({req['leave_type']} from {req['start_date']} to {req['end_date']})"
@@ -1216,13 +2036,15 @@ def admin_manage_leave():
             st.write(f"**Leave Type:** {selected_request['leave_type']}")
             st.write(f"**Dates:** {selected_request['start_date']} to {selected_request['end_date']} ({selected_request.get('duration_days', 'N/A')} days)") # Use .get with default
             st.write(f"**Reason:** {selected_request['reason']}")
-            if selected_request['document_path'] and os.path.exists(selected_request['document_path']):
-                with open(selected_request['document_path'], "rb") as file:
+            display_attachment_preview(selected_request)
+            document_path, document_name = get_request_document(selected_request)
+            if document_path:
+                with open(document_path, "rb") as file:
                     btn = st.download_button(
                         label="Download Supporting Document",
                         data=file,
-                        file_name=os.path.basename(selected_request['document_path']),
-                        mime="application/octet-stream"
+                        file_name=document_name,
+                        mime=mimetypes.guess_type(document_name)[0] or "application/octet-stream"
                     )
             else:
                 st.info("No supporting document provided.")
@@ -1230,18 +2052,732 @@ def admin_manage_leave():
             col_approve, col_reject = st.columns(2)
             with col_approve:
                 if st.button("Approve Request"):
-                    selected_request['status'] = 'Approved'
-                    save_data(leave_requests, LEAVE_REQUESTS_FILE)
-                    st.success("Leave request approved!")
-                    st.rerun()
+                    applied, message = apply_leave_decisions([selected_request['request_id']], 'Approved', reviewer_name)[selected_request['request_id']]
+                    if applied:
+                        st.success("Leave request approved!")
+                        st.rerun()
+                    st.error(f"Leave request was not approved. {message}")
             with col_reject:
                 if st.button("Reject Request"):
-                    selected_request['status'] = 'Rejected'
-                    save_data(leave_requests, LEAVE_REQUESTS_FILE)
-                    st.warning("Leave request rejected.")
-                    st.rerun()
+                    applied, message = apply_leave_decisions([selected_request['request_id']], 'Rejected', reviewer_name)[selected_request['request_id']]
+                    if applied:
+                        st.warning("Leave request rejected.")
+                        st.rerun()
+                    st.error(f"Leave request was not rejected. {message}")
+
+        bulk_leave_decisions(pending_requests, reviewer_name)
     else:
         st.info("No pending leave requests to review.")
+    show_bulk_decision_results("bulk_leave_results")
+
+def leave_requests_lock():
+    return data_file_lock(LEAVE_REQUESTS_FILE, "leave requests")
+
+def apply_leave_decision(leave_request, decision, reviewer_name, comment=""):
+    # Returns (applied, message); a request already decided elsewhere is reported, not overwritten
+    if leave_request.get('status') != 'Pending':
+        return False, f"Skipped: already {leave_request.get('status')}."
+    leave_request['status'] = decision
+    leave_request['reviewed_by'] = reviewer_name
+    leave_request['review_date'] = datetime.now().isoformat()
+    leave_request['review_comment'] = comment
+    return True, f"{decision}."
+
+def apply_leave_decisions(request_ids, decision, reviewer_name, comment=""):
+    # Applies the decision against freshly loaded data under the store lock and writes once for the batch.
+    # Returns {request_id: (applied, message)}.
+    outcomes = {}
+    with leave_requests_lock():
+        leave_requests = load_data(LEAVE_REQUESTS_FILE)
+        requests_by_id = {req['request_id']: req for req in leave_requests}
+        for request_id in request_ids:
+            leave_request = requests_by_id.get(request_id)
+            if leave_request is None:
+                outcomes[request_id] = (False, "Skipped: request no longer exists.")
+            else:
+                outcomes[request_id] = apply_leave_decision(leave_request, decision, reviewer_name, comment)
+        if any(applied for applied, message in outcomes.values()):
+            save_data(leave_requests, LEAVE_REQUESTS_FILE)
+    return outcomes
+
+def bulk_leave_decisions(pending_requests, reviewer_name):
+    st.subheader("Bulk Approve/Reject")
+    labels = {req['request_id']: f"{req['request_id']} - {req['requester_name']} ({req['leave_type']} from {req['start_date']} to {req['end_date']})" for req in pending_requests}
+    with st.form("bulk_leave_form"):
+        selected_ids = st.multiselect("Select pending requests:", list(labels.keys()), format_func=labels.get)
+        bulk_comment = st.text_area("Comment (applied to every selected request):")
+        col_approve, col_reject = st.columns(2)
+        with col_approve:
+            approve_selected = st.form_submit_button("Approve Selected")
+        with col_reject:
+            reject_selected = st.form_submit_button("Reject Selected")
+
+    if (approve_selected or reject_selected) and selected_ids:
+        decision = 'Approved' if approve_selected else 'Rejected'
+        outcomes = apply_leave_decisions(selected_ids, decision, reviewer_name, bulk_comment)
+        st.session_state.bulk_leave_results = [{"Request": labels[request_id], "Result": message} for request_id, (applied, message) in outcomes.items()]
+        st.rerun()
+    elif (approve_selected or reject_selected):
+        st.error("Select at least one request.")
+
+def show_bulk_decision_results(results_key):
+    # Results are kept in session state across the st.rerun() that follows a bulk decision
+    results = st.session_state.pop(results_key, None)
+    if results:
+        applied_count = sum(1 for result in results if not result['Result'].startswith("Skipped"))
+        st.success(f"Bulk decision applied to {applied_count} of {len(results)} selected request(s).")
+        st.dataframe(pd.DataFrame(results), use_container_width=True, hide_index=True)
+
+# --- Full-Text Search Index ---
+# A positional inverted index: postings map each term to {doc_id: [positions]}, so a lookup only touches
+# the documents that contain the query terms. The sorted vocabulary supports prefix matching with bisect,
+# facets give constant-time candidate sets for exact-match filters, and results are ranked with BM25.
+SEARCH_STOP_WORDS = {"a", "an", "and", "the", "of", "for", "to", "in", "on", "at", "by", "with", "is", "it", "or", "as", "be", "from"}
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_PREFIX_EXPANSION_LIMIT = 50 # Maximum vocabulary terms a single prefix may expand to
+SEARCH_PREFIX_WEIGHT = 0.8 # Prefix-only matches score slightly below exact term matches
+
+def tokenize_text(text):
+    return re.findall(r"[a-z0-9]+", str(text or "").lower())
+
+def new_search_index(facet_fields=()):
+    return {
+        "postings": {},
+        "vocabulary": [],
+        "docs": {},
+        "total_length": 0,
+        "facets": {field: {} for field in facet_fields}
+    }
+
+def remove_search_document(index, doc_id):
+    doc = index['docs'].pop(doc_id, None)
+    if doc is None:
+        return
+    index['total_length'] -= doc['length']
+    for term in doc['terms']:
+        term_postings = index['postings'].get(term)
+        if term_postings is None:
+            continue
+        term_postings.pop(doc_id, None)
+        if not term_postings:
+            del index['postings'][term]
+            position = bisect.bisect_left(index['vocabulary'], term)
+            if position < len(index['vocabulary']) and index['vocabulary'][position] == term:
+                index['vocabulary'].pop(position)
+    for field, values in index['facets'].items():
+        doc_ids = values.get(doc['fields'].get(field))
+        if doc_ids is not None:
+            doc_ids.discard(doc_id)
+
+def index_search_document(index, doc_id, text, fields=None):
+    # Adds or replaces a document; fields holds filterable/sortable values stored alongside it
+    remove_search_document(index, doc_id)
+    fields = fields or {}
+    positions = {}
+    length = 0
+    for position, token in enumerate(tokenize_text(text)):
+        length += 1
+        if token in SEARCH_STOP_WORDS:
+            continue # Stop words keep their position so phrase offsets stay correct
+        positions.setdefault(token, []).append(position)
+    for term, term_positions in positions.items():
+        term_postings = index['postings'].get(term)
+        if term_postings is None:
+            term_postings = index['postings'][term] = {}
+            bisect.insort(index['vocabulary'], term)
+        term_postings[doc_id] = term_positions
+    index['docs'][doc_id] = {"length": length, "terms": list(positions), "fields": fields}
+    index['total_length'] += length
+    for field, values in index['facets'].items():
+        values.setdefault(fields.get(field), set()).add(doc_id)
+
+def expand_search_term(index, token):
+    # Returns [(term, weight)] for the exact term and vocabulary terms that start with it
+    vocabulary = index['vocabulary']
+    start = bisect.bisect_left(vocabulary, token)
+    expansions = []
+    for term in vocabulary[start:start + SEARCH_PREFIX_EXPANSION_LIMIT]:
+        if not term.startswith(token):
+            break
+        expansions.append((term, 1.0 if term == token else SEARCH_PREFIX_WEIGHT))
+    return expansions
+
+def parse_search_query(query):
+    # Quoted text becomes a phrase; every other word is a prefix-matched term
+    phrases = [tokenize_text(phrase) for phrase in re.findall(r'"([^"]+)"', query)]
+    words = [token for token in tokenize_text(re.sub(r'"[^"]*"', " ", query)) if token not in SEARCH_STOP_WORDS]
+    return [phrase for phrase in phrases if phrase], words
+
+def match_search_phrase(index, phrase_tokens):
+    # Returns {doc_id: phrase frequency} for documents containing the tokens consecutively
+    tokens = [(offset, token) for offset, token in enumerate(phrase_tokens) if token not in SEARCH_STOP_WORDS]
+    if not tokens:
+        return {}
+    tokens.sort(key=lambda item: len(index['postings'].get(item[1], {})))
+    first_offset, first_token = tokens[0]
+    matches = {}
+    for doc_id, first_positions in index['postings'].get(first_token, {}).items():
+        starts = {position - first_offset for position in first_positions}
+        for offset, token in tokens[1:]:
+            token_positions = index['postings'].get(token, {}).get(doc_id)
+            if not token_positions:
+                starts = set()
+                break
+            starts &= {position - offset for position in token_positions}
+            if not starts:
+                break
+        if starts:
+            matches[doc_id] = len(starts)
+    return matches
+
+def bm25_term_score(index, term_frequency, document_frequency, doc_length):
+    doc_count = len(index['docs'])
+    average_length = (index['total_length'] / doc_count) if doc_count else 1.0
+    idf = math.log(1 + (doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+    normalizer = term_frequency + BM25_K1 * (1 - BM25_B + BM25_B * doc_length / (average_length or 1.0))
+    return idf * term_frequency * (BM25_K1 + 1) / normalizer
+
+def search_index(index, query="", k=20, facet_filters=None, range_filters=None, candidate_ids=None, sort_field=None):
+    # facet_filters: {field: [allowed values]}; range_filters: {field: (min or None, max or None)}.
+    # candidate_ids optionally restricts the search (e.g. to documents a user may see).
+    # Every query word and phrase must match. Returns [(score, doc_id)] best first; queries without
+    # text are ordered by sort_field (newest first) instead of relevance.
+    phrases, words = parse_search_query(query or "")
+    candidates = None if candidate_ids is None else set(candidate_ids)
+    for field, allowed_values in (facet_filters or {}).items():
+        field_values = index['facets'][field]
+        allowed_ids = set().union(*(field_values.get(value, set()) for value in allowed_values)) if allowed_values else set()
+        candidates = allowed_ids if candidates is None else candidates & allowed_ids
+
+    scores = {}
+    for word in words:
+        word_scores = {}
+        for term, weight in expand_search_term(index, word):
+            term_postings = index['postings'][term]
+            for doc_id, positions in term_postings.items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                term_score = weight * bm25_term_score(index, len(positions), len(term_postings), index['docs'][doc_id]['length'])
+                word_scores[doc_id] = max(word_scores.get(doc_id, 0.0), term_score)
+        candidates = set(word_scores)
+        scores = {doc_id: scores.get(doc_id, 0.0) + word_scores[doc_id] for doc_id in candidates}
+    for phrase in phrases:
+        phrase_matches = match_search_phrase(index, phrase)
+        candidates = set(phrase_matches) if candidates is None else candidates & set(phrase_matches)
+        phrase_df = len(phrase_matches)
+        scores = {
+            doc_id: scores.get(doc_id, 0.0) + len(phrase) * bm25_term_score(index, phrase_matches[doc_id], phrase_df, index['docs'][doc_id]['length'])
+            for doc_id in candidates
+        }
+
+    if candidates is None:
+        candidates = index['docs'].keys()
+    for field, (minimum, maximum) in (range_filters or {}).items():
+        candidates = [
+            doc_id for doc_id in candidates
+            if index['docs'][doc_id]['fields'].get(field) is not None
+            and (minimum is None or index['docs'][doc_id]['fields'][field] >= minimum)
+            and (maximum is None or index['docs'][doc_id]['fields'][field] <= maximum)
+        ]
+    if words or phrases:
+        return heapq.nlargest(k, ((scores[doc_id], doc_id) for doc_id in candidates))
+    return [(0.0, doc_id) for doc_id in heapq.nlargest(
+        k, candidates, key=lambda doc_id: (index['docs'][doc_id]['fields'].get(sort_field) or "") if sort_field else doc_id
+    )]
+
+# --- OPEX/CAPEX Search ---
+OPEX_CAPEX_SEARCH_FIELDS = ['request_id', 'request_number', 'item_description', 'justification', 'vendor_name']
+
+def safe_float(value, default=0.0):
+    # Amounts in older records may be None or strings such as "600,000.00"
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return default
+
+def index_opex_capex_request(index, req):
+    index_search_document(
+        index,
+        req['request_id'],
+        " ".join(str(req.get(field) or "") for field in OPEX_CAPEX_SEARCH_FIELDS),
+        {
+            "final_status": req.get('final_status'),
+            "expense_line": req.get('expense_line'),
+            "total_amount": safe_float(req.get('total_amount')),
+            "submission_date": str(req.get('submission_date') or "")[:10]
+        }
+    )
+
+def build_opex_capex_search_index(opex_capex_requests):
+    index = new_search_index(facet_fields=("final_status", "expense_line"))
+    for req in opex_capex_requests:
+        index_opex_capex_request(index, req)
+    return index
+
+def get_opex_capex_search_index():
+    return get_derived_view("opex_capex_search", OPEX_CAPEX_REQUESTS_FILE, build_opex_capex_search_index)
+
+def opex_capex_search_panel(opex_capex_requests):
+    with derived_views_locked():
+        expense_line_options = sorted(value for value in get_opex_capex_search_index()['facets']['expense_line'] if value)
+    with st.form("opex_capex_search_form"):
+        search_query = st.text_input("Search description, justification, vendor or request ID", help='Words match by prefix; use "quotes" for an exact phrase.')
+        col_status, col_line = st.columns(2)
+        with col_status:
+            status_filter = st.multiselect("Status", ["Pending", "Approved", "Rejected"])
+        with col_line:
+            expense_line_filter = st.multiselect("Expense Line", expense_line_options)
+        col_min, col_max = st.columns(2)
+        with col_min:
+            min_amount = st.number_input("Minimum Amount (NGN)", min_value=0.0, value=0.0, format="%.2f")
+        with col_max:
+            max_amount = st.number_input("Maximum Amount (NGN, 0 = no limit)", min_value=0.0, value=0.0, format="%.2f")
+        col_from, col_to, col_k = st.columns(3)
+        with col_from:
+            date_from = st.date_input("Submitted From", value=None)
+        with col_to:
+            date_to = st.date_input("Submitted To", value=None)
+        with col_k:
+            top_k = st.number_input("Max Results", min_value=1, max_value=10000, value=1000)
+        st.form_submit_button("Search")
+
+    facet_filters = {}
+    if status_filter:
+        facet_filters['final_status'] = status_filter
+    if expense_line_filter:
+        facet_filters['expense_line'] = expense_line_filter
+    range_filters = {}
+    if min_amount > 0 or max_amount > 0:
+        range_filters['total_amount'] = (min_amount if min_amount > 0 else None, max_amount if max_amount > 0 else None)
+    if date_from or date_to:
+        range_filters['submission_date'] = (date_from.isoformat() if date_from else None, date_to.isoformat() if date_to else None)
+
+    with derived_views_locked():
+        results = search_index(get_opex_capex_search_index(), search_query, k=int(top_k), facet_filters=facet_filters, range_filters=range_filters, sort_field="submission_date")
+    if not results:
+        st.info("No requests match your search.")
+        return
+    requests_by_id = {req['request_id']: req for req in opex_capex_requests}
+    rows = []
+    for score, request_id in results:
+        req = requests_by_id.get(request_id)
+        if req is None:
+            continue
+        rows.append({
+            "Request No.": req.get('request_number') or request_id,
+            "Requester": req.get('requester_name'),
+            "Item Description": req.get('item_description'),
+            "Vendor": req.get('vendor_name'),
+            "Expense Line": req.get('expense_line'),
+            "Total Amount (NGN)": safe_float(req.get('total_amount')),
+            "Status": req.get('final_status'),
+            "Submitted": str(req.get('submission_date') or "")[:10],
+            "Relevance": round(score, 3) if search_query else None
+        })
+    # Ranked results and plain browsing keep separate table state, since only ranked results have a Relevance column
+    df_results = pd.DataFrame(rows)
+    if search_query:
+        paginated_table("opex_capex_ranked_results_table", df_results, default_sort="Relevance")
+    else:
+        paginated_table("opex_capex_results_table", df_results.drop(columns=["Relevance"]), default_sort="Submitted")
+
+# --- Vendor Registry ---
+# Vendor details are typed free-hand on every requisition, so the registry groups requests by a normalized
+# vendor name and keeps the spellings and bank accounts seen for each vendor along with spend rollups.
+# A character trigram index over the normalized names serves fuzzy autocomplete and duplicate detection
+# without comparing against every vendor. Each request's contribution is recorded so re-indexing a
+# request (e.g. when it is approved) replaces its share of the rollups instead of adding it twice.
+VENDOR_NGRAM_SIZE = 3
+VENDOR_SUGGESTION_THRESHOLD = 0.5 # Minimum share of the typed text's trigrams found in a suggested vendor
+VENDOR_DUPLICATE_THRESHOLD = 0.7 # Minimum trigram similarity for two vendors to be flagged as duplicates
+VENDOR_NAME_NOISE_WORDS = {"ltd", "limited", "plc", "nig", "nigeria", "ent", "enterprise", "enterprises", "co", "company", "inc", "the"}
+
+def normalize_vendor_name(name):
+    return " ".join(token for token in tokenize_text(name) if token not in VENDOR_NAME_NOISE_WORDS)
+
+def vendor_ngrams(normalized_name):
+    padded = f" {normalized_name} "
+    return {padded[i:i + VENDOR_NGRAM_SIZE] for i in range(len(padded) - VENDOR_NGRAM_SIZE + 1)}
+
+def new_vendor_registry():
+    return {"vendors": {}, "ngrams": {}, "request_vendor": {}}
+
+def remove_request_from_vendor_registry(registry, request_id):
+    contribution = registry['request_vendor'].pop(request_id, None)
+    if contribution is None:
+        return
+    vendor_key = contribution['vendor_key']
+    vendor = registry['vendors'][vendor_key]
+    vendor['request_count'] -= 1
+    vendor['total_requested'] -= contribution['amount']
+    if contribution['status'] == 'Approved':
+        vendor['approved_spend'] -= contribution['amount']
+    elif contribution['status'] == 'Pending':
+        vendor['pending_amount'] -= contribution['amount']
+    for counter_name, value in [('name_variants', contribution['vendor_name']), ('accounts', contribution['account'])]:
+        if value is None:
+            continue
+        vendor[counter_name][value] -= 1
+        if vendor[counter_name][value] <= 0:
+            del vendor[counter_name][value]
+    if vendor['request_count'] <= 0:
+        del registry['vendors'][vendor_key]
+        for gram in vendor_ngrams(vendor_key):
+            keys = registry['ngrams'].get(gram)
+            if keys is not None:
+                keys.discard(vendor_key)
+                if not keys:
+                    del registry['ngrams'][gram]
+
+def add_request_to_vendor_registry(registry, req):
+    request_id = req['request_id']
+    remove_request_from_vendor_registry(registry, request_id)
+    vendor_name = " ".join(str(req.get('vendor_name') or "").split())
+    vendor_key = normalize_vendor_name(vendor_name)
+    if not vendor_key or vendor_name == 'N/A':
+        return
+    vendor = registry['vendors'].get(vendor_key)
+    if vendor is None:
+        grams = vendor_ngrams(vendor_key)
+        vendor = registry['vendors'][vendor_key] = {
+            "vendor_key": vendor_key,
+            "ngram_count": len(grams),
+            "name_variants": {},
+            "accounts": {},
+            "request_count": 0,
+            "total_requested": 0.0,
+            "approved_spend": 0.0,
+            "pending_amount": 0.0
+        }
+        for gram in grams:
+            registry['ngrams'].setdefault(gram, set()).add(vendor_key)
+    account = None
+    if req.get('vendor_account_no') and req.get('vendor_account_no') != 'N/A':
+        account = (str(req.get('vendor_account_name') or "").strip(), str(req['vendor_account_no']).strip(), str(req.get('vendor_bank') or "").strip())
+    amount = safe_float(req.get('total_amount'))
+    status = req.get('final_status')
+    vendor['request_count'] += 1
+    vendor['total_requested'] += amount
+    if status == 'Approved':
+        vendor['approved_spend'] += amount
+    elif status == 'Pending':
+        vendor['pending_amount'] += amount
+    vendor['name_variants'][vendor_name] = vendor['name_variants'].get(vendor_name, 0) + 1
+    if account is not None:
+        vendor['accounts'][account] = vendor['accounts'].get(account, 0) + 1
+    registry['request_vendor'][request_id] = {"vendor_key": vendor_key, "vendor_name": vendor_name, "account": account, "amount": amount, "status": status}
+
+def build_vendor_registry(opex_capex_requests):
+    registry = new_vendor_registry()
+    for req in opex_capex_requests:
+        add_request_to_vendor_registry(registry, req)
+    return registry
+
+def get_vendor_registry():
+    return get_derived_view("vendor_registry", OPEX_CAPEX_REQUESTS_FILE, build_vendor_registry)
+
+def get_vendor_display_name(vendor):
+    # The most frequently used spelling
+    return max(vendor['name_variants'].items(), key=lambda item: item[1])[0] if vendor['name_variants'] else vendor['vendor_key']
+
+def get_vendor_primary_account(vendor):
+    return max(vendor['accounts'].items(), key=lambda item: item[1])[0] if vendor['accounts'] else None
+
+def match_vendors(registry, name, k=5, threshold=VENDOR_SUGGESTION_THRESHOLD, partial=True):
+    # Scores vendors sharing a trigram with the query. partial=True measures how much of the typed text
+    # the vendor name contains (for autocomplete); partial=False is the symmetric Dice similarity.
+    normalized_name = normalize_vendor_name(name)
+    if not normalized_name:
+        return []
+    grams = vendor_ngrams(normalized_name)
+    shared_counts = {}
+    for gram in grams:
+        for vendor_key in registry['ngrams'].get(gram, ()):
+            shared_counts[vendor_key] = shared_counts.get(vendor_key, 0) + 1
+    if partial:
+        scored = ((shared / len(grams), vendor_key) for vendor_key, shared in shared_counts.items())
+    else:
+        scored = (
+            (2 * shared / (len(grams) + registry['vendors'][vendor_key]['ngram_count']), vendor_key)
+            for vendor_key, shared in shared_counts.items()
+        )
+    return heapq.nlargest(k, (item for item in scored if item[0] >= threshold))
+
+def find_duplicate_vendors(registry, threshold=VENDOR_DUPLICATE_THRESHOLD):
+    # Batch job: union vendors whose names are near-identical or that share a bank account at the same bank
+    parent = {vendor_key: vendor_key for vendor_key in registry['vendors']}
+
+    def find(vendor_key):
+        while parent[vendor_key] != vendor_key:
+            parent[vendor_key] = parent[parent[vendor_key]]
+            vendor_key = parent[vendor_key]
+        return vendor_key
+
+    def union(first_key, second_key):
+        first_root, second_root = find(first_key), find(second_key)
+        if first_root != second_root:
+            parent[second_root] = first_root
+
+    vendors_by_account = {}
+    for vendor_key, vendor in registry['vendors'].items():
+        for score, other_key in match_vendors(registry, vendor_key, k=20, threshold=threshold, partial=False):
+            if other_key != vendor_key:
+                union(vendor_key, other_key)
+        for _, account_no, bank in vendor['accounts']:
+            if account_no:
+                vendors_by_account.setdefault((account_no, normalize_vendor_name(bank)), []).append(vendor_key)
+    for vendor_keys in vendors_by_account.values():
+        for other_key in vendor_keys[1:]:
+            union(vendor_keys[0], other_key)
+
+    clusters = {}
+    for vendor_key in registry['vendors']:
+        clusters.setdefault(find(vendor_key), []).append(vendor_key)
+    duplicate_clusters = []
+    for members in clusters.values():
+        if len(members) < 2:
+            continue
+        members.sort(key=lambda vendor_key: registry['vendors'][vendor_key]['request_count'], reverse=True)
+        duplicate_clusters.append({
+            "Suggested Name": get_vendor_display_name(registry['vendors'][members[0]]),
+            "Variants": ", ".join(variant for vendor_key in members for variant in registry['vendors'][vendor_key]['name_variants']),
+            "Requests": sum(registry['vendors'][vendor_key]['request_count'] for vendor_key in members),
+            "Approved Spend (NGN)": sum(registry['vendors'][vendor_key]['approved_spend'] for vendor_key in members)
+        })
+    return duplicate_clusters
+
+@st.cache_data(show_spinner="Scanning vendors for duplicates...")
+def get_duplicate_vendor_clusters(source_version):
+    # Cached per version of the requests file so the batch job reruns only after new requisitions
+    with derived_views_locked():
+        return find_duplicate_vendors(get_vendor_registry())
+
+def vendor_autocomplete():
+    # Rendered above the requisition form (forms do not rerun while typing); the chosen vendor's
+    # details are returned to pre-fill the form's vendor fields
+    vendor_query = st.text_input("Find an existing vendor (optional)", key="vendor_lookup_query", help="Type part of a vendor name to reuse its registered details.")
+    if not vendor_query:
+        return {}
+    options = {}
+    with derived_views_locked():
+        registry = get_vendor_registry()
+        for _, vendor_key in match_vendors(registry, vendor_query):
+            vendor = registry['vendors'][vendor_key]
+            account = get_vendor_primary_account(vendor)
+            label = f"{get_vendor_display_name(vendor)} ({vendor['request_count']} request(s))"
+            if account:
+                label += f" - {account[2]} {account[1]}"
+            account = account or ("", "", "")
+            options[label] = {"vendor_name": get_vendor_display_name(vendor), "vendor_account_name": account[0], "vendor_account_no": account[1], "vendor_bank": account[2]}
+    if not options:
+        st.caption("No similar vendors found. Enter the new vendor's details below.")
+        return {}
+    selected_label = st.selectbox("Matching vendors:", [""] + list(options.keys()), key="vendor_lookup_choice")
+    if not selected_label:
+        return {}
+    return options[selected_label]
+
+def vendor_registry_page():
+    st.header("Vendor Registry")
+    rows = []
+    with derived_views_locked():
+        for vendor in get_vendor_registry()['vendors'].values():
+            account = get_vendor_primary_account(vendor)
+            rows.append({
+                "Vendor": get_vendor_display_name(vendor),
+                "Spellings Seen": len(vendor['name_variants']),
+                "Bank": account[2] if account else "N/A",
+                "Account Number": account[1] if account else "N/A",
+                "Requests": vendor['request_count'],
+                "Total Requested (NGN)": vendor['total_requested'],
+                "Approved Spend (NGN)": vendor['approved_spend'],
+                "Pending (NGN)": vendor['pending_amount']
+            })
+    if not rows:
+        st.info("No vendors have been used on requisitions yet.")
+        return
+
+    st.subheader("Vendor Spend")
+    df_vendors = pd.DataFrame(rows).sort_values(by="Approved Spend (NGN)", ascending=False)
+    st.dataframe(df_vendors, use_container_width=True, hide_index=True)
+    fig_spend = px.bar(df_vendors.head(15), x='Vendor', y='Approved Spend (NGN)',
+                       title='Top Vendors by Approved Spend',
+                       color='Vendor',
+                       template='plotly_white')
+    st.plotly_chart(fig_spend, use_container_width=True)
+
+    st.subheader("Possible Duplicate Vendors")
+    st.write("Vendors with near-identical names or a shared bank account number are grouped below.")
+    duplicate_clusters = get_duplicate_vendor_clusters(get_file_version(OPEX_CAPEX_REQUESTS_FILE))
+    if duplicate_clusters:
+        st.dataframe(pd.DataFrame(duplicate_clusters), use_container_width=True, hide_index=True)
+    else:
+        st.info("No duplicate vendors detected.")
+
+    st.subheader("Possible Duplicate Requisitions")
+    st.write(f"Live requisitions with the same vendor, amount and expense line, or the same supporting document, submitted within {DUPLICATE_REQUISITION_WINDOW_DAYS} days of each other.")
+    duplicate_requisitions = get_duplicate_requisition_audit(get_file_version(OPEX_CAPEX_REQUESTS_FILE))
+    if duplicate_requisitions:
+        st.dataframe(pd.DataFrame(duplicate_requisitions), use_container_width=True, hide_index=True)
+    else:
+        st.info("No duplicate requisitions detected.")
+
+# --- Duplicate Requisition Detection ---
+# Every live (not rejected) requisition is filed in a hash index under its normalized quote signature
+# (vendor, amount, expense line) and under the content hash of its supporting document. A new submission
+# is checked with a handful of dictionary lookups; matches count only within a time window.
+DUPLICATE_REQUISITION_WINDOW_DAYS = 30
+DUPLICATE_MATCH_LABELS = {"quote": "same vendor, amount and expense line", "document": "same supporting document"}
+
+def requisition_signatures(vendor_name, total_amount, expense_line, blob_hash):
+    signatures = []
+    vendor_key = normalize_vendor_name(vendor_name)
+    amount_kobo = int(round(safe_float(total_amount) * 100))
+    if vendor_key and str(vendor_name).strip() != 'N/A' and amount_kobo > 0:
+        signatures.append(("quote", vendor_key, amount_kobo, expense_line or ""))
+    if blob_hash:
+        signatures.append(("document", blob_hash))
+    return signatures
+
+def get_request_blob_hash(attachments, req):
+    attachment = attachments.get(req.get('attachment_id'))
+    return attachment['blob_hash'] if attachment else None
+
+def new_duplicate_requisition_index():
+    # buckets: {signature: {request_id: submitted_at}}; request_signatures: {request_id: [signature, ...]}
+    return {"buckets": {}, "request_signatures": {}}
+
+def remove_request_from_duplicate_index(index, request_id):
+    for signature in index['request_signatures'].pop(request_id, []):
+        bucket = index['buckets'].get(signature)
+        if bucket is not None:
+            bucket.pop(request_id, None)
+            if not bucket:
+                del index['buckets'][signature]
+
+def add_request_to_duplicate_index(index, req, blob_hash):
+    request_id = req['request_id']
+    remove_request_from_duplicate_index(index, request_id)
+    if req.get('final_status') == 'Rejected': # A rejected request may legitimately be resubmitted
+        return
+    submitted_at = pd.to_datetime(req.get('submission_date'), format='ISO8601', errors='coerce')
+    if pd.isna(submitted_at):
+        return
+    signatures = requisition_signatures(req.get('vendor_name'), req.get('total_amount'), req.get('expense_line'), blob_hash)
+    index['request_signatures'][request_id] = signatures
+    for signature in signatures:
+        index['buckets'].setdefault(signature, {})[request_id] = submitted_at
+
+def build_duplicate_requisition_index(opex_capex_requests):
+    index = new_duplicate_requisition_index()
+    attachments = load_attachment_store()['attachments']
+    for req in opex_capex_requests:
+        add_request_to_duplicate_index(index, req, get_request_blob_hash(attachments, req))
+    return index
+
+def get_duplicate_requisition_index():
+    return get_derived_view("opex_capex_duplicates", OPEX_CAPEX_REQUESTS_FILE, build_duplicate_requisition_index)
+
+def find_duplicate_requisitions(index, signatures, submitted_at, exclude_request_id=None):
+    # Returns {request_id: [match kind, ...]} for live requests filed under the same signatures within the window
+    window = pd.Timedelta(days=DUPLICATE_REQUISITION_WINDOW_DAYS)
+    matches = {}
+    for signature in signatures:
+        for request_id, other_submitted_at in index['buckets'].get(signature, {}).items():
+            if request_id != exclude_request_id and abs(other_submitted_at - submitted_at) <= window:
+                matches.setdefault(request_id, []).append(signature[0])
+    return matches
+
+def describe_duplicate_matches(matches, requests_by_id):
+    lines = []
+    for request_id, kinds in matches.items():
+        req = requests_by_id.get(request_id, {})
+        lines.append(
+            f"- **{request_id}** by {req.get('requester_name', 'N/A')} on {str(req.get('submission_date') or 'N/A')[:10]} "
+            f"({req.get('final_status', 'N/A')}): {' and '.join(DUPLICATE_MATCH_LABELS[kind] for kind in kinds)}"
+        )
+    return "\n".join(lines)
+
+def audit_duplicate_requisitions(index, opex_capex_requests):
+    # Batch scan: within each bucket, pair every request with the earlier requests submitted inside the window
+    window = pd.Timedelta(days=DUPLICATE_REQUISITION_WINDOW_DAYS)
+    pairs = {}
+    for signature, bucket in index['buckets'].items():
+        if len(bucket) < 2:
+            continue
+        entries = sorted(bucket.items(), key=lambda entry: entry[1])
+        window_start = 0
+        for position, (request_id, submitted_at) in enumerate(entries):
+            while submitted_at - entries[window_start][1] > window:
+                window_start += 1
+            for earlier_id, earlier_submitted_at in entries[window_start:position]:
+                pair = pairs.setdefault((request_id, earlier_id), {"kinds": [], "days_apart": (submitted_at - earlier_submitted_at).total_seconds() / 86400})
+                pair['kinds'].append(signature[0])
+    requests_by_id = {req['request_id']: req for req in opex_capex_requests}
+    rows = []
+    for (request_id, earlier_id), pair in pairs.items():
+        req = requests_by_id.get(request_id, {})
+        earlier_req = requests_by_id.get(earlier_id, {})
+        rows.append({
+            "Request ID": request_id,
+            "Possible Duplicate Of": earlier_id,
+            "Match": " and ".join(DUPLICATE_MATCH_LABELS[kind] for kind in pair['kinds']),
+            "Days Apart": round(pair['days_apart'], 1),
+            "Vendor": req.get('vendor_name'),
+            "Total Amount (NGN)": safe_float(req.get('total_amount')),
+            "Requester": req.get('requester_name'),
+            "Status": req.get('final_status'),
+            "Earlier Request Status": earlier_req.get('final_status')
+        })
+    return sorted(rows, key=lambda row: (len(row['Match']), -row['Days Apart']), reverse=True)
+
+@st.cache_data(show_spinner="Auditing requisitions for duplicates...")
+def get_duplicate_requisition_audit(source_version):
+    # Cached per version of the requests file so the batch audit reruns only after requisitions change
+    opex_capex_requests = load_data(OPEX_CAPEX_REQUESTS_FILE)
+    with derived_views_locked():
+        return audit_duplicate_requisitions(get_duplicate_requisition_index(), opex_capex_requests)
+
+def show_request_duplicate_warning(req, opex_capex_requests):
+    # Shown to approvers while reviewing a request
+    request_id = req['request_id']
+    submitted_at = pd.to_datetime(req.get('submission_date'), format='ISO8601', errors='coerce')
+    if pd.isna(submitted_at):
+        return
+    with derived_views_locked():
+        index = get_duplicate_requisition_index()
+        if request_id not in index['request_signatures']:
+            return
+        matches = find_duplicate_requisitions(index, index['request_signatures'][request_id], submitted_at, exclude_request_id=request_id)
+    if matches:
+        requests_by_id = {other['request_id']: other for other in opex_capex_requests}
+        st.warning(f"This request may duplicate {len(matches)} other request(s) submitted within {DUPLICATE_REQUISITION_WINDOW_DAYS} days:\n\n" + describe_duplicate_matches(matches, requests_by_id))
+
+# --- OPEX/CAPEX Derived Views ---
+def on_opex_capex_requests_saved(file_write, changed_requests):
+    # Keep derived OPEX/CAPEX views in step with a save_data(OPEX_CAPEX_REQUESTS_FILE) that changed these requests
+    def reindex(index):
+        for req in changed_requests:
+            index_opex_capex_request(index, req)
+
+    def register_vendors(registry):
+        for req in changed_requests:
+            add_request_to_vendor_registry(registry, req)
+
+    def record_spend(burn):
+        for req in changed_requests:
+            add_request_to_budget_burn(burn, req)
+
+    def file_signatures(index):
+        attachments = load_attachment_store()['attachments'] if any(req.get('attachment_id') for req in changed_requests) else {}
+        for req in changed_requests:
+            add_request_to_duplicate_index(index, req, get_request_blob_hash(attachments, req))
+
+    update_derived_view("opex_capex_search", OPEX_CAPEX_REQUESTS_FILE, reindex, file_write)
+    update_derived_view("vendor_registry", OPEX_CAPEX_REQUESTS_FILE, register_vendors, file_write)
+    update_derived_view("budget_burn", OPEX_CAPEX_REQUESTS_FILE, record_spend, file_write)
+    update_derived_view("opex_capex_duplicates", OPEX_CAPEX_REQUESTS_FILE, file_signatures, file_write)
 
 # --- OPEX/CAPEX Management (Staff & Admin/Approvers) ---
 def request_opex_capex():
@@ -1253,6 +2789,7 @@ def request_opex_capex():
     users = load_data(USERS_FILE) # Needed to find approvers
 
     st.subheader("Submit New Requisition")
+    vendor_prefill = vendor_autocomplete()
     with st.form("opex_capex_form"):
         request_type = st.selectbox("Request Type", ["OPEX (Operational Expenditure)", "CAPEX (Capital Expenditure)"])
         item_description = st.text_area("Item Description/Purpose")
@@ -1260,11 +2797,12 @@ def request_opex_capex():
         material_cost = st.number_input("Material Cost (NGN)", min_value=0.0, format="%.2f")
         labor_cost = st.number_input("Labor Cost (NGN)", min_value=0.0, format="%.2f")
         justification = st.text_area("Justification")
-        vendor_name = st.text_input("Vendor Name")
-        vendor_account_name = st.text_input("Vendor Account Name")
-        vendor_account_no = st.text_input("Vendor Account Number")
-        vendor_bank = st.text_input("Vendor Bank")
+        vendor_name = st.text_input("Vendor Name", value=vendor_prefill.get('vendor_name', ''))
+        vendor_account_name = st.text_input("Vendor Account Name", value=vendor_prefill.get('vendor_account_name', ''))
+        vendor_account_no = st.text_input("Vendor Account Number", value=vendor_prefill.get('vendor_account_no', ''))
+        vendor_bank = st.text_input("Vendor Bank", value=vendor_prefill.get('vendor_bank', ''))
         supporting_document = st.file_uploader("Upload Supporting Document (e.g., Invoice, Quote)", type=["pdf", "jpg", "png"])
+        confirm_duplicate = st.checkbox("Submit even if this looks like a duplicate of a recent request")
 
         submitted = st.form_submit_button("Submit Requisition")
 
@@ -1286,10 +2824,30 @@ def request_opex_capex():
                 st.error(f"Error: Could not find an approver for the first stage ({first_approver_role}). Please contact HR.")
                 return
 
-            doc_path = save_uploaded_file(supporting_document, "opex_capex_documents")
+            # Check the duplicate index before anything is written
+            signatures = requisition_signatures(vendor_name, total_amount, expense_line, hash_file_object(supporting_document) if supporting_document else None)
+            with derived_views_locked():
+                duplicate_matches = find_duplicate_requisitions(get_duplicate_requisition_index(), signatures, pd.Timestamp.now())
+            if duplicate_matches and not confirm_duplicate:
+                requests_by_id = {req['request_id']: req for req in opex_capex_requests}
+                st.warning(
+                    f"This looks like a duplicate of {len(duplicate_matches)} request(s) submitted in the last {DUPLICATE_REQUISITION_WINDOW_DAYS} days:\n\n"
+                    + describe_duplicate_matches(duplicate_matches, requests_by_id)
+                    + "\n\nIf this is a genuinely new requisition, tick the confirmation box and submit again."
+                )
+                return
 
+            attachment = save_uploaded_file(supporting_document, "opex_capex_documents", current_user_staff_id)
+
+            try:
+                request_number = allocate_document_number("opex_capex")
+            except TimeoutError:
+                if attachment:
+                    release_attachment(attachment['attachment_id']) # The request was never created
+                raise
             new_request = {
-                "request_id": str(uuid.uuid4()),
+                "request_id": request_number,
+                "request_number": request_number,
                 "requester_staff_id": current_user_staff_id,
                 "requester_name": current_user_name,
                 "requester_department": current_user_department,
@@ -1309,15 +2867,19 @@ def request_opex_capex():
                 "vendor_account_name": vendor_account_name,
                 "vendor_account_no": vendor_account_no,
                 "vendor_bank": vendor_bank,
-                "document_path": doc_path,
+                "document_path": attachment['path'] if attachment else None,
+                "attachment_id": attachment['attachment_id'] if attachment else None,
                 "submission_date": datetime.now().isoformat(),
                 "current_approver_role": first_approver_role, # Role of the next person to approve
                 "current_approval_stage": 0, # Index in APPROVAL_CHAIN
                 "final_status": "Pending",
                 "approval_history": []
             }
-            opex_capex_requests.append(new_request)
-            save_data(opex_capex_requests, OPEX_CAPEX_REQUESTS_FILE)
+            with opex_capex_requests_lock():
+                opex_capex_requests = load_data(OPEX_CAPEX_REQUESTS_FILE) # Keep decisions saved since the page loaded
+                opex_capex_requests.append(new_request)
+                file_write = save_data(opex_capex_requests, OPEX_CAPEX_REQUESTS_FILE)
+                on_opex_capex_requests_saved(file_write, [new_request])
             st.success(f"OPEX/CAPEX request submitted successfully! Awaiting approval from {first_approver_name} ({first_approver_role}).")
             st.rerun()
 
@@ -1391,10 +2953,12 @@ def admin_manage_opex_capex_approvals():
 
     if not pending_for_this_approver:
         st.info("No OPEX/CAPEX requests currently pending your approval.")
+        show_bulk_decision_results("bulk_opex_capex_results") # A batch may just have cleared the queue
         return
 
     df_pending = pd.DataFrame(pending_for_this_approver)
     st.dataframe(df_pending[['request_id', 'requester_name', 'request_type', 'item_description', 'total_amount', 'submission_date']])
+    prefetch_attachment_previews(pending_for_this_approver)
 
     request_to_review_id = st.selectbox(
         "Select Request ID to Review:",
@@ -1438,14 +3002,18 @@ def admin_manage_opex_capex_approvals():
             st.info("No approval history for this request.")
 
 
-        # Download supporting document
-        if selected_request['document_path'] and os.path.exists(selected_request['document_path']):
-            with open(selected_request['document_path'], "rb") as file:
+        show_request_duplicate_warning(selected_request, opex_capex_requests)
+
+        # Preview and download supporting document
+        display_attachment_preview(selected_request)
+        document_path, document_name = get_request_document(selected_request)
+        if document_path:
+            with open(document_path, "rb") as file:
                 btn = st.download_button(
                     label="Download Supporting Document",
                     data=file,
-                    file_name=os.path.basename(selected_request['document_path']),
-                    mime="application/octet-stream"
+                    file_name=document_name,
+                    mime=mimetypes.guess_type(document_name)[0] or "application/octet-stream"
                 )
         else:
             st.info("No supporting document provided for this request.")
@@ -1455,50 +3023,390 @@ def admin_manage_opex_capex_approvals():
         col_approve, col_reject = st.columns(2)
         with col_approve:
             if st.button("Approve"):
-                selected_request['approval_history'].append({
-                    "approver_role": current_approver_role_in_chain,
-                    "approver_name": current_user_name,
-                    "date": datetime.now().isoformat(),
-                    "status": "Approved",
-                    "comment": comment
-                })
-                # Move to next stage or finalize
-                next_stage_index = selected_request['current_approval_stage'] + 1
-                if next_stage_index < len(APPROVAL_CHAIN):
-                    next_approver_info = APPROVAL_CHAIN[next_stage_index]
-                    selected_request['current_approver_role'] = next_approver_info['role_name']
-                    selected_request['current_approval_stage'] = next_stage_index
-                    st.success(f"Request {request_to_review_id} approved. Moving to {next_approver_info['role_name']} for review.")
-                else:
-                    selected_request['final_status'] = 'Approved'
-                    selected_request['current_approver_role'] = 'Final Approval'
-                    st.success(f"Request {request_to_review_id} fully approved!")
-
-                save_data(opex_capex_requests, OPEX_CAPEX_REQUESTS_FILE)
-                st.rerun()
+                applied, message = apply_opex_capex_decisions([selected_request['request_id']], current_approver_role_in_chain, current_user_name, 'Approved', comment)[selected_request['request_id']]
+                if applied:
+                    st.success(f"Request {request_to_review_id}: {message}")
+                    st.rerun()
+                st.error(f"Request {request_to_review_id} was not approved. {message}")
 
         with col_reject:
             if st.button("Reject"):
-                selected_request['approval_history'].append({
-                    "approver_role": current_approver_role_in_chain,
-                    "approver_name": current_user_name,
-                    "date": datetime.now().isoformat(),
-                    "status": "Rejected",
-                    "comment": comment
-                })
-                selected_request['final_status'] = 'Rejected'
-                selected_request['current_approver_role'] = 'Rejected'
-                save_data(opex_capex_requests, OPEX_CAPEX_REQUESTS_FILE)
-                st.warning(f"Request {request_to_review_id} rejected.")
-                st.rerun()
+                applied, message = apply_opex_capex_decisions([selected_request['request_id']], current_approver_role_in_chain, current_user_name, 'Rejected', comment)[selected_request['request_id']]
+                if applied:
+                    st.warning(f"Request {request_to_review_id}: {message}")
+                    st.rerun()
+                st.error(f"Request {request_to_review_id} was not rejected. {message}")
+
+    bulk_opex_capex_decisions(pending_for_this_approver, current_approver_role_in_chain, current_user_name)
+    show_bulk_decision_results("bulk_opex_capex_results")
 
     st.subheader("All OPEX/CAPEX Requests")
     if opex_capex_requests:
-        df_all_requests = pd.DataFrame(opex_capex_requests)
-        st.dataframe(df_all_requests)
+        opex_capex_search_panel(opex_capex_requests)
     else:
         st.info("No OPEX/CAPEX requests have been submitted yet.")
 
+def opex_capex_requests_lock():
+    return data_file_lock(OPEX_CAPEX_REQUESTS_FILE, "OPEX/CAPEX requests")
+
+def apply_opex_capex_decision(req, approver_role, approver_name, decision, comment):
+    # Records one approver's decision and advances the request along APPROVAL_CHAIN.
+    # Returns (applied, message); requests no longer waiting on this approver are skipped.
+    if req.get('final_status') != 'Pending' or req.get('current_approver_role') != approver_role:
+        return False, f"Skipped: no longer pending with {approver_role} (now {req.get('final_status')}, {req.get('current_approver_role')})."
+    req['approval_history'].append({
+        "approver_role": approver_role,
+        "approver_name": approver_name,
+        "date": datetime.now().isoformat(),
+        "status": decision,
+        "comment": comment
+    })
+    if decision == 'Rejected':
+        req['final_status'] = 'Rejected'
+        req['current_approver_role'] = 'Rejected'
+        return True, "Rejected."
+    # Move to next stage or finalize
+    next_stage_index = int(req.get('current_approval_stage') or 0) + 1
+    if next_stage_index < len(APPROVAL_CHAIN):
+        next_approver_info = APPROVAL_CHAIN[next_stage_index]
+        req['current_approver_role'] = next_approver_info['role_name']
+        req['current_approval_stage'] = next_stage_index
+        return True, f"Approved. Moving to {next_approver_info['role_name']} for review."
+    req['final_status'] = 'Approved'
+    req['current_approver_role'] = 'Final Approval'
+    return True, "Fully approved!"
+
+def apply_opex_capex_decisions(request_ids, approver_role, approver_name, decision, comment):
+    # Applies the decision against freshly loaded data under the store lock and writes once for the batch.
+    # Returns {request_id: (applied, message)}.
+    outcomes = {}
+    changed_requests = []
+    with opex_capex_requests_lock():
+        opex_capex_requests = load_data(OPEX_CAPEX_REQUESTS_FILE)
+        requests_by_id = {req['request_id']: req for req in opex_capex_requests}
+        for request_id in request_ids:
+            req = requests_by_id.get(request_id)
+            if req is None:
+                outcomes[request_id] = (False, "Skipped: request no longer exists.")
+                continue
+            outcomes[request_id] = apply_opex_capex_decision(req, approver_role, approver_name, decision, comment)
+            if outcomes[request_id][0]:
+                changed_requests.append(req)
+        if changed_requests:
+            file_write = save_data(opex_capex_requests, OPEX_CAPEX_REQUESTS_FILE)
+            on_opex_capex_requests_saved(file_write, changed_requests)
+    return outcomes
+
+def bulk_opex_capex_decisions(pending_for_this_approver, approver_role, approver_name):
+    st.subheader("Bulk Approve/Reject")
+    labels = {
+        req['request_id']: f"{req['request_id']} - {req.get('requester_name')} - {req.get('item_description')} (NGN {safe_float(req.get('total_amount')):,.2f})"
+        for req in pending_for_this_approver
+    }
+    with st.form("bulk_opex_capex_form"):
+        selected_ids = st.multiselect("Select pending requests:", list(labels.keys()), format_func=labels.get)
+        bulk_comment = st.text_area("Comment (applied to every selected request):")
+        col_approve, col_reject = st.columns(2)
+        with col_approve:
+            approve_selected = st.form_submit_button("Approve Selected")
+        with col_reject:
+            reject_selected = st.form_submit_button("Reject Selected")
+
+    if (approve_selected or reject_selected) and selected_ids:
+        decision = 'Approved' if approve_selected else 'Rejected'
+        outcomes = apply_opex_capex_decisions(selected_ids, approver_role, approver_name, decision, bulk_comment)
+        st.session_state.bulk_opex_capex_results = [{"Request": labels[request_id], "Result": message} for request_id, (applied, message) in outcomes.items()]
+        st.rerun()
+    elif (approve_selected or reject_selected):
+        st.error("Select at least one request.")
+
+# --- Budget Burn-Rate Forecasting ---
+# Approved spend is aggregated per (expense line, month) and kept as a derived view of the requests file,
+# patched as approvals arrive. The forecast fits a linear trend to the year's monthly spend and walks it
+# forward to find when each line's annual budget in EXPENSE_LINES_BUDGET runs out.
+BUDGET_FORECAST_HORIZON_MONTHS = 36
+BUDGET_TREND_MIN_MONTHS = 3 # Fewer months than this use the average monthly spend instead of a trend
+
+def get_opex_capex_approval_date(req):
+    # Spend lands in the month of the final approval, falling back to the submission date for legacy records
+    history_dates = [entry.get('date') for entry in req.get('approval_history') or [] if entry.get('date')]
+    return max(history_dates) if history_dates else req.get('submission_date')
+
+def new_budget_burn():
+    # monthly: {(expense_line, "YYYY-MM"): amount}; request_spend: {request_id: (expense_line, month, amount)}
+    return {"monthly": {}, "request_spend": {}}
+
+def add_request_to_budget_burn(burn, req):
+    # Replaces the request's previous contribution, so reapplying the same request is harmless
+    previous = burn['request_spend'].pop(req['request_id'], None)
+    if previous is not None:
+        expense_line, month, amount = previous
+        burn['monthly'][(expense_line, month)] -= amount
+        if abs(burn['monthly'][(expense_line, month)]) < 0.005:
+            del burn['monthly'][(expense_line, month)]
+    if req.get('final_status') != 'Approved' or not req.get('expense_line'):
+        return
+    approved_at = pd.to_datetime(get_opex_capex_approval_date(req), format='ISO8601', errors='coerce')
+    if pd.isna(approved_at):
+        return
+    contribution = (req['expense_line'], approved_at.strftime('%Y-%m'), safe_float(req.get('total_amount')))
+    burn['request_spend'][req['request_id']] = contribution
+    burn['monthly'][contribution[:2]] = burn['monthly'].get(contribution[:2], 0.0) + contribution[2]
+
+def build_budget_burn(opex_capex_requests):
+    burn = new_budget_burn()
+    df_approved = pd.DataFrame(
+        [req for req in opex_capex_requests if req.get('final_status') == 'Approved' and req.get('expense_line')],
+        columns=['request_id', 'expense_line', 'total_amount', 'submission_date', 'approval_history']
+    )
+    if df_approved.empty:
+        return burn
+    df_approved['approved_at'] = pd.to_datetime(
+        [get_opex_capex_approval_date(req) for req in df_approved[['approval_history', 'submission_date']].to_dict('records')],
+        format='ISO8601', errors='coerce'
+    )
+    df_approved = df_approved.dropna(subset=['approved_at'])
+    df_approved['month'] = df_approved['approved_at'].dt.strftime('%Y-%m')
+    df_approved['amount'] = pd.to_numeric(df_approved['total_amount'].astype(str).str.replace(',', ''), errors='coerce').fillna(0.0)
+    burn['monthly'] = df_approved.groupby(['expense_line', 'month'])['amount'].sum().to_dict()
+    burn['request_spend'] = {
+        request_id: (expense_line, month, amount)
+        for request_id, expense_line, month, amount in df_approved[['request_id', 'expense_line', 'month', 'amount']].itertuples(index=False)
+    }
+    return burn
+
+def get_budget_burn():
+    return get_derived_view("budget_burn", OPEX_CAPEX_REQUESTS_FILE, build_budget_burn)
+
+def month_fraction_date(year, month_number, fraction):
+    # month_number counts on from January of year (13 = January of the next year)
+    month_start = date(year + (month_number - 1) // 12, (month_number - 1) % 12 + 1, 1)
+    next_month_start = date(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
+    return month_start + timedelta(days=int(min(max(fraction, 0.0), 1.0) * ((next_month_start - month_start).days - 1)))
+
+def forecast_budget_exhaustion(monthly_spend, budget, year, months_elapsed):
+    # monthly_spend: approved spend for months 1..months_elapsed of the year (missing months are zero)
+    actual = monthly_spend.to_numpy(dtype=float)
+    spent = float(actual.sum())
+    if months_elapsed >= BUDGET_TREND_MIN_MONTHS:
+        slope, intercept = np.polyfit(np.arange(1, months_elapsed + 1), actual, 1)
+    else:
+        slope, intercept = 0.0, spent / months_elapsed
+
+    exhaustion_date = None
+    if budget > 0 and spent >= budget:
+        # Already exhausted: find the month in which the cumulative spend crossed the budget
+        cumulative_actual = actual.cumsum()
+        crossing_index = int(np.argmax(cumulative_actual >= budget))
+        spent_before = cumulative_actual[crossing_index] - actual[crossing_index]
+        exhaustion_date = month_fraction_date(year, crossing_index + 1, (budget - spent_before) / actual[crossing_index])
+
+    cumulative = spent
+    projected_year_end = spent
+    for month_number in range(months_elapsed + 1, months_elapsed + BUDGET_FORECAST_HORIZON_MONTHS + 1):
+        if exhaustion_date is not None and month_number > 12:
+            break
+        projected = max(intercept + slope * month_number, 0.0)
+        if exhaustion_date is None and budget > 0 and projected > 0 and cumulative + projected >= budget:
+            exhaustion_date = month_fraction_date(year, month_number, (budget - cumulative) / projected)
+        cumulative += projected
+        if month_number <= 12:
+            projected_year_end = cumulative
+
+    if budget > 0 and spent >= budget:
+        status = "Exhausted"
+    elif exhaustion_date is not None and exhaustion_date.year == year:
+        status = "Will Overrun"
+    else:
+        status = "On Track"
+    return {
+        "spent": spent,
+        "average_burn": spent / months_elapsed,
+        "next_month_burn": max(intercept + slope * (months_elapsed + 1), 0.0),
+        "projected_year_end": projected_year_end,
+        "exhaustion_date": exhaustion_date,
+        "status": status
+    }
+
+@st.cache_data(show_spinner="Forecasting budget burn...")
+def compute_budget_burn_forecast(source_version, year, as_of):
+    # source_version is the cache key; the aggregates come from the incrementally maintained budget_burn view
+    with derived_views_locked():
+        monthly_spend = [(expense_line, month, amount) for (expense_line, month), amount in get_budget_burn()['monthly'].items()]
+    df_monthly = pd.DataFrame(monthly_spend, columns=['expense_line', 'month', 'amount'])
+    df_monthly = df_monthly[df_monthly['month'].str.startswith(str(year))]
+    months_elapsed = as_of.month if as_of.year == year else 12
+    year_months = [f"{year}-{month:02d}" for month in range(1, months_elapsed + 1)]
+    # Expense line x month matrix, zero-filled so every line has the same months
+    spend_matrix = df_monthly.pivot_table(index='expense_line', columns='month', values='amount', aggfunc='sum')
+    spend_matrix = spend_matrix.reindex(index=list(EXPENSE_LINES_BUDGET.keys()), columns=year_months, fill_value=0.0).fillna(0.0)
+
+    rows = []
+    for expense_line, budget in EXPENSE_LINES_BUDGET.items():
+        forecast = forecast_budget_exhaustion(spend_matrix.loc[expense_line], budget, year, months_elapsed)
+        rows.append({
+            "Expense Line": expense_line,
+            "Annual Budget (NGN)": budget,
+            "Spent (NGN)": round(forecast['spent'], 2),
+            "% Used": round(forecast['spent'] / budget * 100, 1) if budget else None,
+            "Avg Monthly Burn (NGN)": round(forecast['average_burn'], 2),
+            "Trend Next Month (NGN)": round(forecast['next_month_burn'], 2),
+            "Projected Year-End (NGN)": round(forecast['projected_year_end'], 2),
+            "Projected Exhaustion": forecast['exhaustion_date'].isoformat() if forecast['exhaustion_date'] else "Beyond horizon",
+            "Status": forecast['status']
+        })
+    df_spend = spend_matrix.reset_index().melt(id_vars='expense_line', var_name='month', value_name='amount')
+    return pd.DataFrame(rows), df_spend
+
+def budget_burn_forecast_page():
+    st.header("Budget Burn-Rate Forecast")
+    today = datetime.now().date()
+    with derived_views_locked():
+        years = sorted({int(month[:4]) for (expense_line, month) in get_budget_burn()['monthly']} | {today.year}, reverse=True)
+    selected_year = st.selectbox("Budget Year:", years)
+    as_of = today if selected_year == today.year else date(selected_year, 12, 31)
+    df_forecast, df_spend = compute_budget_burn_forecast(get_file_version(OPEX_CAPEX_REQUESTS_FILE), selected_year, as_of)
+
+    col_budget, col_spent, col_risk = st.columns(3)
+    col_budget.metric("Total Annual Budget", f"NGN {df_forecast['Annual Budget (NGN)'].sum():,.2f}")
+    col_spent.metric("Approved Spend", f"NGN {df_forecast['Spent (NGN)'].sum():,.2f}")
+    col_risk.metric("Lines at Risk", int(df_forecast['Status'].isin(['Exhausted', 'Will Overrun']).sum()))
+    st.caption(f"Forecast as of {as_of.isoformat()}, using approved requests and a linear trend over the year's monthly spend.")
+    st.dataframe(df_forecast, use_container_width=True, hide_index=True)
+
+    st.subheader("Monthly Approved Spend")
+    if df_spend['amount'].sum() > 0:
+        fig_spend = px.bar(df_spend[df_spend['amount'] > 0], x='month', y='amount', color='expense_line',
+                           title=f'Approved Spend by Expense Line ({selected_year})',
+                           labels={'month': 'Month', 'amount': 'Amount (NGN)', 'expense_line': 'Expense Line'},
+                           template='plotly_white')
+        st.plotly_chart(fig_spend, use_container_width=True)
+    else:
+        st.info(f"No approved spend recorded for {selected_year}.")
+
+    selected_line = st.selectbox("Cumulative spend for expense line:", list(EXPENSE_LINES_BUDGET.keys()))
+    df_line = df_spend[df_spend['expense_line'] == selected_line].sort_values('month')
+    if not df_line.empty:
+        df_line = df_line.assign(cumulative=df_line['amount'].cumsum())
+        fig_line = px.line(df_line, x='month', y='cumulative', markers=True,
+                           title=f'Cumulative Spend vs Budget: {selected_line}',
+                           labels={'month': 'Month', 'cumulative': 'Cumulative Spend (NGN)'},
+                           template='plotly_white')
+        fig_line.add_hline(y=EXPENSE_LINES_BUDGET[selected_line], line_dash='dash', annotation_text='Annual Budget')
+        st.plotly_chart(fig_line, use_container_width=True)
+
+# --- Approval SLA Analytics ---
+# Every approval_history entry across all requests is flattened into one columnar table, and stage
+# durations, cycle times and percentiles are computed with vectorized pandas operations. The report is
+# cached per version of the requests file, so opening it again is free until a request changes.
+APPROVAL_SLA_PERCENTILES = [0.5, 0.75, 0.9]
+
+def flatten_approval_history(opex_capex_requests):
+    # One row per approval decision
+    history_columns = ['request_id', 'submission_date', 'final_status', 'approver_role', 'approver_name', 'status', 'date']
+    if not any(req.get('approval_history') for req in opex_capex_requests):
+        return pd.DataFrame(columns=history_columns)
+    df_history = pd.json_normalize(
+        opex_capex_requests, record_path='approval_history',
+        meta=['request_id', 'submission_date', 'final_status'], errors='ignore'
+    )
+    return df_history.reindex(columns=history_columns)
+
+def compute_stage_durations(df_history):
+    df_stages = df_history.copy()
+    df_stages['decided_at'] = pd.to_datetime(df_stages['date'], format='ISO8601', errors='coerce')
+    df_stages['submitted_at'] = pd.to_datetime(df_stages['submission_date'], format='ISO8601', errors='coerce')
+    df_stages = df_stages.dropna(subset=['decided_at', 'submitted_at']).sort_values(['request_id', 'decided_at'], kind='stable')
+    # A stage starts when the previous approver decided, or at submission for the first approver
+    df_stages['stage_started_at'] = df_stages.groupby('request_id')['decided_at'].shift(1).fillna(df_stages['submitted_at'])
+    df_stages['hours_in_stage'] = ((df_stages['decided_at'] - df_stages['stage_started_at']).dt.total_seconds() / 3600).clip(lower=0)
+    df_stages['month'] = df_stages['decided_at'].dt.to_period('M').astype(str)
+    return df_stages
+
+def summarize_hours(grouped_hours):
+    summary = grouped_hours.agg(['count', 'mean'])
+    summary.columns = ['Decisions', 'Mean Hours']
+    percentiles = grouped_hours.quantile(APPROVAL_SLA_PERCENTILES).unstack()
+    percentiles.columns = [f"P{int(p * 100)} Hours" for p in percentiles.columns]
+    return summary.join(percentiles).round(2).reset_index()
+
+@st.cache_data(show_spinner="Computing approval turnaround...")
+def compute_approval_sla_report(source_version):
+    # source_version is the cache key; the data is re-read only when the requests file changes
+    opex_capex_requests = load_data(OPEX_CAPEX_REQUESTS_FILE)
+    df_stages = compute_stage_durations(flatten_approval_history(opex_capex_requests))
+    if df_stages.empty:
+        return df_stages[['request_id', 'approver_role', 'month', 'hours_in_stage']], pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    by_role_month = summarize_hours(df_stages.groupby(['approver_role', 'month'])['hours_in_stage'])
+    by_role_month.columns = ['Approver Role', 'Month'] + list(by_role_month.columns[2:])
+
+    # End-to-end cycle time for requests that reached a final decision
+    df_cycles = df_stages[df_stages['final_status'].isin(['Approved', 'Rejected'])].groupby('request_id').agg(
+        final_status=('final_status', 'first'), submitted_at=('submitted_at', 'first'), completed_at=('decided_at', 'max')
+    )
+    df_cycles['cycle_hours'] = (df_cycles['completed_at'] - df_cycles['submitted_at']).dt.total_seconds() / 3600
+    df_cycles['month'] = df_cycles['completed_at'].dt.to_period('M').astype(str)
+    cycle_by_month = summarize_hours(df_cycles.groupby(['month', 'final_status'])['cycle_hours'])
+    cycle_by_month.columns = ['Month', 'Final Status', 'Requests'] + list(cycle_by_month.columns[3:])
+
+    # How long currently pending requests have been waiting with their current approver
+    df_requests = pd.DataFrame(opex_capex_requests, columns=['request_id', 'submission_date', 'final_status', 'current_approver_role'])
+    df_pending = df_requests[df_requests['final_status'] == 'Pending'].copy()
+    if df_pending.empty:
+        return df_stages[['request_id', 'approver_role', 'month', 'hours_in_stage']], by_role_month, cycle_by_month, pd.DataFrame()
+    # Requests nobody has decided on yet have no history rows and wait from submission
+    last_decision = df_stages.groupby('request_id')['decided_at'].max().to_dict()
+    df_pending['waiting_since'] = pd.to_datetime(df_pending['request_id'].map(last_decision)).fillna(
+        pd.to_datetime(df_pending['submission_date'], format='ISO8601', errors='coerce')
+    )
+    df_pending['waiting_hours'] = (pd.Timestamp.now() - df_pending['waiting_since']).dt.total_seconds() / 3600
+    df_pending = df_pending.dropna(subset=['waiting_hours'])
+    if df_pending.empty:
+        return df_stages[['request_id', 'approver_role', 'month', 'hours_in_stage']], by_role_month, cycle_by_month, pd.DataFrame()
+    pending_by_role = summarize_hours(df_pending.groupby('current_approver_role')['waiting_hours'])
+    pending_by_role.columns = ['Waiting With', 'Pending Requests', 'Mean Hours Waiting'] + [column.replace('Hours', 'Hours Waiting') for column in pending_by_role.columns[3:]]
+
+    return df_stages[['request_id', 'approver_role', 'month', 'hours_in_stage']], by_role_month, cycle_by_month, pending_by_role
+
+def approval_sla_analytics_page():
+    st.header("Approval SLA Analytics")
+    df_stages, by_role_month, cycle_by_month, pending_by_role = compute_approval_sla_report(get_file_version(OPEX_CAPEX_REQUESTS_FILE))
+    if df_stages.empty:
+        st.info("No approval decisions have been recorded yet.")
+        return
+
+    months = sorted(df_stages['month'].unique())
+    selected_months = st.multiselect("Filter by Month:", months, default=months)
+    df_stages = df_stages[df_stages['month'].isin(selected_months)]
+    by_role_month = by_role_month[by_role_month['Month'].isin(selected_months)]
+    cycle_by_month = cycle_by_month[cycle_by_month['Month'].isin(selected_months)]
+
+    st.subheader("Time in Stage by Approver Role")
+    col_decisions, col_median = st.columns(2)
+    col_decisions.metric("Decisions", len(df_stages))
+    col_median.metric("Median Hours per Stage", f"{df_stages['hours_in_stage'].median():.1f}" if not df_stages.empty else "N/A")
+    st.dataframe(by_role_month, use_container_width=True, hide_index=True)
+    if not df_stages.empty:
+        fig_stage = px.box(df_stages, x='approver_role', y='hours_in_stage',
+                           title='Hours Spent With Each Approver',
+                           labels={'approver_role': 'Approver Role', 'hours_in_stage': 'Hours in Stage'},
+                           category_orders={'approver_role': [role['role_name'] for role in APPROVAL_CHAIN]},
+                           template='plotly_white')
+        st.plotly_chart(fig_stage, use_container_width=True)
+
+    st.subheader("End-to-End Cycle Time")
+    if not cycle_by_month.empty:
+        st.dataframe(cycle_by_month, use_container_width=True, hide_index=True)
+    else:
+        st.info("No requests reached a final decision in the selected months.")
+
+    st.subheader("Currently Waiting")
+    if not pending_by_role.empty:
+        st.dataframe(pending_by_role, use_container_width=True, hide_index=True)
+    else:
+        st.info("No requests are currently pending.")
+
 # --- Performance Goals (Staff & Admin) ---
 def manage_performance_goals():
     st.header("Manage Performance Goals")
@@ -1540,7 +3448,8 @@ def manage_performance_goals():
                     "line_manager_rating": None # Initialize for appraisal
                 }
                 performance_goals.append(new_goal)
-                save_data(performance_goals, PERFORMANCE_GOALS_FILE)
+                file_write = save_data(performance_goals, PERFORMANCE_GOALS_FILE)
+                on_performance_goals_saved(file_write, [new_goal])
                 st.success("Performance goal set successfully!")
                 st.rerun()
 
@@ -1601,18 +3510,126 @@ def manage_performance_goals():
                         performance_goals[goal_index]['end_date'] = updated_end_date.isoformat()
                         performance_goals[goal_index]['duration'] = f"{duration} days"
                         performance_goals[goal_index]['weighting_percent'] = updated_weighting_percent
-                        save_data(performance_goals, PERFORMANCE_GOALS_FILE)
+                        file_write = save_data(performance_goals, PERFORMANCE_GOALS_FILE)
+                        on_performance_goals_saved(file_write, [performance_goals[goal_index]])
                         st.success("Goal updated successfully!")
                         st.rerun()
 
                 if delete_submitted:
                     del performance_goals[goal_index]
-                    save_data(performance_goals, PERFORMANCE_GOALS_FILE)
+                    file_write = save_data(performance_goals, PERFORMANCE_GOALS_FILE)
+                    on_performance_goals_saved(file_write, removed_goal_ids=[selected_goal_id])
                     st.success("Goal deleted successfully!")
                     st.rerun()
     else:
         st.info("You have not set any performance goals yet.")
 
+# --- Performance Goal Cube ---
+# Goals are pre-aggregated per (department, grade, period, status) cell with goal counts and rating sums,
+# joined to the owner's profile once. The cube is a derived view of the goals file, patched per goal on
+# every goal write, and rebuilt when user profiles change. Charts and filters read cells, never goals.
+GOAL_CUBE_DIMENSIONS = ['Department', 'Grade', 'Period', 'Status']
+
+def get_goal_period(goal):
+    return str(goal.get('start_date') or goal.get('set_date') or 'N/A')[:4]
+
+def remove_goal_from_cube(cube, goal_id):
+    contribution = cube['goal_cell'].pop(goal_id, None)
+    if contribution is None:
+        return
+    cell_key, self_rating, manager_rating = contribution
+    cell = cube['cells'][cell_key]
+    cell['goals'] -= 1
+    if not np.isnan(self_rating):
+        cell['self_sum'] -= self_rating
+        cell['self_count'] -= 1
+    if not np.isnan(manager_rating):
+        cell['manager_sum'] -= manager_rating
+        cell['manager_count'] -= 1
+    if cell['goals'] <= 0:
+        del cube['cells'][cell_key]
+
+def add_goal_to_cube(cube, goal):
+    # Replaces the goal's previous contribution, so reapplying the same goal is harmless
+    goal_id = goal['goal_id']
+    remove_goal_from_cube(cube, goal_id)
+    department, grade = cube['profiles'].get(goal.get('staff_id'), ('N/A', 'N/A'))
+    cell_key = (department, grade, get_goal_period(goal), goal.get('status') or 'N/A')
+    self_rating = rating_value(goal.get('self_rating'))
+    manager_rating = rating_value(goal.get('line_manager_rating'))
+    cell = cube['cells'].setdefault(cell_key, {"goals": 0, "self_sum": 0.0, "self_count": 0, "manager_sum": 0.0, "manager_count": 0})
+    cell['goals'] += 1
+    if not np.isnan(self_rating):
+        cell['self_sum'] += self_rating
+        cell['self_count'] += 1
+    if not np.isnan(manager_rating):
+        cell['manager_sum'] += manager_rating
+        cell['manager_count'] += 1
+    cube['goal_cell'][goal_id] = (cell_key, self_rating, manager_rating)
+
+def build_performance_goal_cube(performance_goals):
+    users = load_data(USERS_FILE)
+    cube = {
+        "users_version": get_file_version(USERS_FILE),
+        "profiles": {user['profile']['staff_id']: (user['profile']['department'], user['profile']['grade_level']) for user in users},
+        "cells": {},
+        "goal_cell": {}
+    }
+    if not performance_goals:
+        return cube
+    df_goals = pd.DataFrame(performance_goals, columns=['goal_id', 'staff_id', 'status', 'start_date', 'set_date', 'self_rating', 'line_manager_rating'])
+    df_goals['Department'] = df_goals['staff_id'].map(lambda staff_id: cube['profiles'].get(staff_id, ('N/A', 'N/A'))[0])
+    df_goals['Grade'] = df_goals['staff_id'].map(lambda staff_id: cube['profiles'].get(staff_id, ('N/A', 'N/A'))[1])
+    df_goals['Period'] = df_goals['start_date'].fillna(df_goals['set_date']).fillna('N/A').astype(str).str[:4]
+    df_goals['Status'] = df_goals['status'].fillna('N/A')
+    df_goals['self'] = df_goals['self_rating'].map(rating_value)
+    df_goals['manager'] = df_goals['line_manager_rating'].map(rating_value)
+    df_cells = df_goals.groupby(GOAL_CUBE_DIMENSIONS).agg(
+        goals=('goal_id', 'size'), self_sum=('self', 'sum'), self_count=('self', 'count'),
+        manager_sum=('manager', 'sum'), manager_count=('manager', 'count')
+    )
+    cube['cells'] = {cell_key: dict(values) for cell_key, values in zip(df_cells.index, df_cells.to_dict('records'))}
+    cube['goal_cell'] = {
+        goal_id: ((department, grade, period, status), self_rating, manager_rating)
+        for goal_id, department, grade, period, status, self_rating, manager_rating
+        in df_goals[['goal_id'] + GOAL_CUBE_DIMENSIONS + ['self', 'manager']].itertuples(index=False)
+    }
+    return cube
+
+def get_performance_goal_cube():
+    cube = get_derived_view("performance_goal_cube", PERFORMANCE_GOALS_FILE, build_performance_goal_cube)
+    if cube['users_version'] != get_file_version(USERS_FILE):
+        # Departments or grades changed: drop the cube so it is rebuilt against the new profiles
+        views, views_lock = get_derived_views()
+        with views_lock:
+            views.pop("performance_goal_cube", None)
+        cube = get_derived_view("performance_goal_cube", PERFORMANCE_GOALS_FILE, build_performance_goal_cube)
+    return cube
+
+def on_performance_goals_saved(file_write, changed_goals=(), removed_goal_ids=()):
+    # Keep the goal cube in step with a save of PERFORMANCE_GOALS_FILE that changed or deleted these goals
+    def apply_changes(cube):
+        for goal_id in removed_goal_ids:
+            remove_goal_from_cube(cube, goal_id)
+        for goal in changed_goals:
+            add_goal_to_cube(cube, goal)
+    update_derived_view("performance_goal_cube", PERFORMANCE_GOALS_FILE, apply_changes, file_write)
+
+def goal_cube_frame(cube):
+    # One row per cell, with the four dimensions as columns
+    df_cells = pd.DataFrame(
+        [dict(zip(GOAL_CUBE_DIMENSIONS, cell_key), **cell) for cell_key, cell in cube['cells'].items()],
+        columns=GOAL_CUBE_DIMENSIONS + ['goals', 'self_sum', 'self_count', 'manager_sum', 'manager_count']
+    )
+    return df_cells
+
+def rollup_goal_cube(df_cells, dimensions):
+    df_rollup = df_cells.groupby(dimensions)[['goals', 'self_sum', 'self_count', 'manager_sum', 'manager_count']].sum().reset_index()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df_rollup['Average Self-Rating'] = (df_rollup['self_sum'] / df_rollup['self_count'].replace(0, np.nan)).round(2)
+        df_rollup["Average Line Manager's Rating"] = (df_rollup['manager_sum'] / df_rollup['manager_count'].replace(0, np.nan)).round(2)
+    return df_rollup.rename(columns={'goals': 'Goals'})
+
 def admin_view_performance_goals():
     st.header("View All Performance Goals (Admin/HR)")
     performance_goals = load_data(PERFORMANCE_GOALS_FILE)
@@ -1623,33 +3640,41 @@ def admin_view_performance_goals():
         st.info("No performance goals have been set yet.")
         return
 
-    df_goals = pd.DataFrame(performance_goals)
-    df_goals['Employee Name'] = df_goals['staff_id'].map(staff_id_to_name)
+    with derived_views_locked():
+        cube = get_performance_goal_cube()
+        df_cells = goal_cube_frame(cube)
+        goal_profiles = dict(cube['profiles'])
+
+    st.subheader("Filter Goals")
+    col_department, col_grade, col_period = st.columns(3)
+    with col_department:
+        selected_departments = st.multiselect("Filter by Department:", sorted(df_cells['Department'].unique()))
+    with col_grade:
+        selected_grades = st.multiselect("Filter by Grade:", sorted(df_cells['Grade'].unique()))
+    with col_period:
+        selected_periods = st.multiselect("Filter by Period:", sorted(df_cells['Period'].unique(), reverse=True))
+    for column, selected in [('Department', selected_departments), ('Grade', selected_grades), ('Period', selected_periods)]:
+        if selected:
+            df_cells = df_cells[df_cells[column].isin(selected)]
 
     st.subheader("Performance Goal Statistics")
-    if not df_goals.empty:
+    if not df_cells.empty:
         # Pie chart for Goal Status Distribution
-        status_counts = df_goals['status'].value_counts().reset_index()
-        status_counts.columns = ['Status', 'Count']
-        fig_status = px.pie(status_counts, values='Count', names='Status',
-                            title='Overall Goal Status Distribution',
+        status_counts = rollup_goal_cube(df_cells, ['Status'])
+        fig_status = px.pie(status_counts, values='Goals', names='Status',
+                            title='Goal Status Distribution',
                             hole=.3)
         st.plotly_chart(fig_status, use_container_width=True)
 
+        df_by_department = rollup_goal_cube(df_cells, ['Department'])
+        st.dataframe(df_by_department[['Department', 'Goals', 'Average Self-Rating', "Average Line Manager's Rating"]], use_container_width=True, hide_index=True)
+
         # Bar chart for Average Self-Rating by Department
-        df_goals_with_dept = df_goals.copy()
-        # Fix: Safely get department, handling cases where get_user_profile might return None
-        df_goals_with_dept['Department'] = df_goals_with_dept['staff_id'].apply(
-            lambda x: get_user_profile(x).get('department', 'N/A') if get_user_profile(x) else 'N/A'
-        )
-        
-        # Filter out rows where self_rating is None before calculating mean
-        df_rated_goals = df_goals_with_dept.dropna(subset=['self_rating'])
-        if not df_rated_goals.empty:
-            avg_self_rating = df_rated_goals.groupby('Department')['self_rating'].mean().reset_index()
-            fig_self_rating = px.bar(avg_self_rating, x='Department', y='self_rating',
+        df_self_rated = df_by_department.dropna(subset=['Average Self-Rating'])
+        if not df_self_rated.empty:
+            fig_self_rating = px.bar(df_self_rated, x='Department', y='Average Self-Rating',
                                     title='Average Self-Rating by Department',
-                                    labels={'self_rating': 'Average Rating (1-5)'},
+                                    labels={'Average Self-Rating': 'Average Rating (1-5)'},
                                     color='Department',
                                     template='plotly_white')
             st.plotly_chart(fig_self_rating, use_container_width=True)
@@ -1657,46 +3682,53 @@ def admin_view_performance_goals():
             st.info("No self-ratings available to display average self-rating by department.")
 
         # Bar chart for Average Line Manager's Rating by Department
-        df_lm_rated_goals = df_goals_with_dept.dropna(subset=['line_manager_rating'])
-        if not df_lm_rated_goals.empty:
-            avg_lm_rating = df_lm_rated_goals.groupby('Department')['line_manager_rating'].mean().reset_index()
-            fig_lm_rating = px.bar(avg_lm_rating, x='Department', y='line_manager_rating',
+        df_manager_rated = df_by_department.dropna(subset=["Average Line Manager's Rating"])
+        if not df_manager_rated.empty:
+            fig_lm_rating = px.bar(df_manager_rated, x='Department', y="Average Line Manager's Rating",
                                    title='Average Line Manager\'s Rating by Department',
-                                   labels={'line_manager_rating': 'Average Rating (1-5)'},
+                                   labels={"Average Line Manager's Rating": 'Average Rating (1-5)'},
                                    color='Department',
                                    template='plotly_white')
             st.plotly_chart(fig_lm_rating, use_container_width=True)
         else:
             st.info("No line manager ratings available to display average line manager's rating by department.")
+
+        # Stacked bar for goal status within each department
+        df_department_status = rollup_goal_cube(df_cells, ['Department', 'Status'])
+        fig_department_status = px.bar(df_department_status, x='Department', y='Goals', color='Status',
+                                       title='Goal Status by Department',
+                                       template='plotly_white')
+        st.plotly_chart(fig_department_status, use_container_width=True)
     else:
         st.info("No performance goal data to generate statistics.")
 
-
     st.subheader("All Performance Goals Table")
-    # Reorder columns for display
-    display_columns = [
-        "Employee Name", "goal_description", "collaborating_department", "status",
-        "employee_remark_update", "start_date", "end_date", "duration", "weighting_percent",
-        "self_rating", "line_manager_rating"
-    ]
-    df_goals_display = df_goals[display_columns].copy()
-    df_goals_display.columns = [
-        "Employee Name", "Goals", "Collaborating Department", "Status",
-        "Employee Remark/Update", "Start Date", "End Date", "Duration", "Weighting (%)",
-        "Self Rating", "Line Manager's Rating"
-    ]
-    st.dataframe(df_goals_display, use_container_width=True)
-
-    st.subheader("Filter Goals")
-    all_departments = sorted(list(set(user['profile']['department'] for user in users if 'profile' in user and 'department' in user['profile'])))
-    selected_department = st.selectbox("Filter by Department:", ["All"] + all_departments)
-
-    if selected_department != "All":
-        filtered_staff_ids = [user['profile']['staff_id'] for user in users if user.get('profile', {}).get('department') == selected_department]
-        df_filtered_goals = df_goals_display[df_goals_display['Employee Name'].isin([staff_id_to_name.get(sid) for sid in filtered_staff_ids])]
-        st.dataframe(df_filtered_goals, use_container_width=True)
-    else:
-        st.dataframe(df_goals_display, use_container_width=True)
+    # Only goals in the filtered departments, grades and periods are projected into the table
+    def goal_in_filters(goal):
+        department, grade = goal_profiles.get(goal.get('staff_id'), ('N/A', 'N/A'))
+        return ((not selected_departments or department in selected_departments)
+                and (not selected_grades or grade in selected_grades)
+                and (not selected_periods or get_goal_period(goal) in selected_periods))
+    goal_columns = {
+        "Employee Name": lambda goal: staff_id_to_name.get(goal.get('staff_id')),
+        "Department": lambda goal: goal_profiles.get(goal.get('staff_id'), ('N/A', 'N/A'))[0],
+        "Goals": 'goal_description',
+        "Collaborating Department": 'collaborating_department',
+        "Status": 'status',
+        "Employee Remark/Update": 'employee_remark_update',
+        "Start Date": 'start_date',
+        "End Date": 'end_date',
+        "Duration": 'duration',
+        "Weighting (%)": 'weighting_percent',
+        "Self Rating": 'self_rating',
+        "Line Manager's Rating": 'line_manager_rating'
+    }
+    paginated_table(
+        "performance_goals_table",
+        project_records([goal for goal in performance_goals if goal_in_filters(goal)], goal_columns),
+        default_sort="Start Date",
+        filter_columns=("Status", "Department")
+    )
 
 # --- Self-Appraisal (Staff & Admin/Manager) ---
 def submit_self_appraisal():
@@ -1915,14 +3947,17 @@ def submit_self_appraisal():
 
     if st.button("Save Self-Appraisal"):
         # Update the original performance_goals list with the self-ratings from appraisal
+        changed_goals = []
         for app_goal in user_appraisal['section_a_goals']:
             for i, p_goal in enumerate(performance_goals):
                 if p_goal.get('goal_id') == app_goal.get('goal_id'):
                     performance_goals[i]['self_rating'] = app_goal['self_rating']
                     performance_goals[i]['employee_remark_update'] = app_goal['employee_remark_update'] # Also update remark
                     performance_goals[i]['status'] = app_goal['status'] # Also update status
+                    changed_goals.append(performance_goals[i])
                     break
-        save_data(performance_goals, PERFORMANCE_GOALS_FILE) # Save updated goals
+        file_write = save_data(performance_goals, PERFORMANCE_GOALS_FILE) # Save updated goals
+        on_performance_goals_saved(file_write, changed_goals)
 
         # Find the index of the current appraisal in the list to update it
         try:
@@ -2079,48 +4114,867 @@ def admin_manage_appraisals():
         )
         st.markdown("---")
 
+        # Live score for the ratings currently set on this page
+        live_score = score_appraisals([selected_appraisal]).iloc[0]
+        col_self_score, col_manager_score, col_final_score = st.columns(3)
+        col_self_score.metric("Self Score", f"{live_score['Self Score (%)']:.1f}%" if pd.notna(live_score['Self Score (%)']) else "Not Rated")
+        col_manager_score.metric("Manager Score", f"{live_score['Manager Score (%)']:.1f}%" if pd.notna(live_score['Manager Score (%)']) else "Not Rated")
+        col_final_score.metric("Final Score", f"{live_score['Final Score (%)']:.1f}%" if pd.notna(live_score['Final Score (%)']) else "Not Rated", help=live_score['Rating Description'])
+
         if st.button("Save Appraisal Review"):
-            # Update the original performance_goals list with the line_manager_ratings from appraisal
-            performance_goals_data = load_data(PERFORMANCE_GOALS_FILE) # Reload to ensure latest
-            for app_goal in selected_appraisal['section_a_goals']:
-                for i, p_goal in enumerate(performance_goals_data):
-                    if p_goal.get('goal_id') == app_goal.get('goal_id'):
-                        performance_goals_data[i]['line_manager_rating'] = app_goal['line_manager_rating']
-                        break
-            save_data(performance_goals_data, PERFORMANCE_GOALS_FILE) # Save updated goals
-
-            # Find the index of the current appraisal in the list to update it
-            try:
-                idx = next(i for i, app in enumerate(appraisals) if app['appraisal_id'] == selected_appraisal['appraisal_id'])
-                appraisals[idx] = selected_appraisal
-            except StopIteration:
-                # This case should ideally not happen if selected_appraisal was found
+            # Copy the line manager's ratings onto the matching performance goals
+            goal_patches = {
+                app_goal['goal_id']: {'line_manager_rating': app_goal['line_manager_rating']}
+                for app_goal in selected_appraisal['section_a_goals'] if app_goal.get('goal_id')
+            }
+            missing_goal_ids, file_write = patch_records(PERFORMANCE_GOALS_FILE, goal_patches)
+            with derived_views_locked():
+                goal_table = get_record_table(PERFORMANCE_GOALS_FILE)
+                on_performance_goals_saved(file_write, [
+                    copy.deepcopy(goal_table['records'][goal_table['positions'][str(goal_id)]]) for goal_id in goal_patches if goal_id not in missing_goal_ids
+                ])
+
+            missing_ids, file_write = patch_records(SELF_APPRAISALS_FILE, {
+                selected_appraisal['appraisal_id']: {
+                    field: selected_appraisal[field]
+                    for field in ['section_a_goals', 'section_b_qualitative', 'training_recommendation', 'hr_remark', 'md_remark']
+                }
+            })
+            if missing_ids:
                 st.error("Error: Could not find appraisal to update. Please refresh.")
                 return
 
-            save_data(appraisals, SELF_APPRAISALS_FILE)
             st.success("Appraisal review saved successfully!")
             st.rerun()
 
+# --- Appraisal Scoring ---
+# Every appraisal is flattened into NumPy arrays (one row per Section A goal, one row per appraisal for the
+# three Section B items) and scored for the whole company in one pass. Ratings of 1-5 become percentages
+# (rating / 5); Section A is the weighting-weighted average scaled to 70 and Section B the plain average
+# scaled to 30. The final score uses the line manager's rating for each item, falling back to the self
+# rating where the manager has not rated it yet.
+APPRAISAL_SECTION_A_WEIGHT = 70
+APPRAISAL_SECTION_B_WEIGHT = 30
+APPRAISAL_SECTION_B_ITEMS = ['leadership_team_development', 'coordinate_optimize_resources', 'interpersonal']
+# Percentage bands from the Key Status & Ratings guide: 0-39% = 1 ... 80-99% = 4, 100% and above = 5
+APPRAISAL_RATING_BANDS = [40, 60, 80, 100]
+APPRAISAL_RATING_DESCRIPTIONS = {5: "Exceeds Expectation", 4: "Meet Expectations", 3: "Average", 2: "Requires Improvement", 1: "Unsatisfactory"}
+
+def rating_value(value):
+    # Ratings are 1-5; None, 0 (an untouched slider) and anything unparseable count as not rated
+    try:
+        rating = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return rating if 1 <= rating <= 5 else np.nan
+
+def weighted_section_score(owner_index, weights, ratings, appraisal_count, section_weight):
+    # Weighted mean of rating/5 per appraisal over the rated items only, scaled to the section weight
+    rated = ~np.isnan(ratings)
+    rated_weights = np.where(rated, weights, 0.0)
+    weighted_sum = np.bincount(owner_index, weights=rated_weights * np.nan_to_num(ratings) / 5, minlength=appraisal_count)
+    weight_total = np.bincount(owner_index, weights=rated_weights, minlength=appraisal_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight_total > 0, weighted_sum / weight_total * section_weight, np.nan)
+
+def score_appraisals(appraisals, staff_id_to_department=None):
+    staff_id_to_department = staff_id_to_department or {}
+    appraisal_count = len(appraisals)
+
+    # Section A: one entry per goal, tagged with the index of its appraisal
+    goal_owner, goal_weight, goal_self, goal_manager = [], [], [], []
+    # Section B: fixed-width matrices, one row per appraisal
+    b_self = np.full((appraisal_count, len(APPRAISAL_SECTION_B_ITEMS)), np.nan)
+    b_manager = np.full((appraisal_count, len(APPRAISAL_SECTION_B_ITEMS)), np.nan)
+    for position, appraisal in enumerate(appraisals):
+        for goal in appraisal.get('section_a_goals') or []:
+            goal_owner.append(position)
+            goal_weight.append(safe_float(goal.get('weighting_percent')))
+            goal_self.append(rating_value(goal.get('self_rating')))
+            goal_manager.append(rating_value(goal.get('line_manager_rating')))
+        qualitative = appraisal.get('section_b_qualitative') or {}
+        for item_position, item in enumerate(APPRAISAL_SECTION_B_ITEMS):
+            b_self[position, item_position] = rating_value((qualitative.get(item) or {}).get('self_rating'))
+            b_manager[position, item_position] = rating_value((qualitative.get(item) or {}).get('line_manager_rating'))
+
+    goal_owner = np.asarray(goal_owner, dtype=np.int64)
+    goal_weight = np.asarray(goal_weight, dtype=float)
+    goal_self = np.asarray(goal_self, dtype=float)
+    goal_manager = np.asarray(goal_manager, dtype=float)
+    # Goals without a weighting share the section equally within their appraisal
+    weight_total = np.bincount(goal_owner, weights=goal_weight, minlength=appraisal_count)
+    goal_weight = np.where(weight_total[goal_owner] > 0, goal_weight, 1.0) if len(goal_owner) else goal_weight
+    goal_final = np.where(np.isnan(goal_manager), goal_self, goal_manager)
+    b_final = np.where(np.isnan(b_manager), b_self, b_manager)
+
+    a_self = weighted_section_score(goal_owner, goal_weight, goal_self, appraisal_count, APPRAISAL_SECTION_A_WEIGHT)
+    a_manager = weighted_section_score(goal_owner, goal_weight, goal_manager, appraisal_count, APPRAISAL_SECTION_A_WEIGHT)
+    a_final = weighted_section_score(goal_owner, goal_weight, goal_final, appraisal_count, APPRAISAL_SECTION_A_WEIGHT)
+    b_scores = {}
+    for name, matrix in [('self', b_self), ('manager', b_manager), ('final', b_final)]:
+        rated_count = (~np.isnan(matrix)).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            b_scores[name] = np.where(rated_count > 0, np.nansum(matrix / 5, axis=1) / rated_count * APPRAISAL_SECTION_B_WEIGHT, np.nan)
+
+    def total(section_a, section_b):
+        # A section with nothing rated contributes 0; an appraisal with nothing rated at all has no score
+        return np.where(np.isnan(section_a) & np.isnan(section_b), np.nan, np.nan_to_num(section_a) + np.nan_to_num(section_b))
+
+    final_score = total(a_final, b_scores['final'])
+    manager_rated = np.bincount(goal_owner, weights=(~np.isnan(goal_manager)).astype(float), minlength=appraisal_count) + (~np.isnan(b_manager)).sum(axis=1)
+    items_total = np.bincount(goal_owner, minlength=appraisal_count) + len(APPRAISAL_SECTION_B_ITEMS)
+    rating_points = np.where(np.isnan(final_score), 0, np.digitize(np.nan_to_num(final_score), APPRAISAL_RATING_BANDS) + 1)
+
+    df_scores = pd.DataFrame({
+        "Appraisal ID": [appraisal.get('appraisal_id') for appraisal in appraisals],
+        "Employee Name": [(appraisal.get('employee_data') or {}).get('name', 'N/A') for appraisal in appraisals],
+        "Staff ID": [appraisal.get('staff_id') for appraisal in appraisals],
+        "Department": [
+            staff_id_to_department.get(appraisal.get('staff_id')) or (appraisal.get('employee_data') or {}).get('department', 'N/A')
+            for appraisal in appraisals
+        ],
+        "Period": [appraisal.get('appraisal_period') for appraisal in appraisals],
+        "Goals": np.bincount(goal_owner, minlength=appraisal_count),
+        "Section A Self (/70)": a_self,
+        "Section A Manager (/70)": a_manager,
+        "Section B Self (/30)": b_scores['self'],
+        "Section B Manager (/30)": b_scores['manager'],
+        "Self Score (%)": total(a_self, b_scores['self']),
+        "Manager Score (%)": total(a_manager, b_scores['manager']),
+        "Final Score (%)": final_score,
+        "Rating": rating_points,
+        "Manager Review": np.select([manager_rated == 0, manager_rated < items_total], ["Not Started", "Partial"], "Complete")
+    })
+    df_scores["Rating Description"] = df_scores["Rating"].map(APPRAISAL_RATING_DESCRIPTIONS).fillna("Not Rated")
+    score_columns = [column for column in df_scores.columns if "Score" in column or "Section" in column]
+    df_scores[score_columns] = df_scores[score_columns].round(2)
+    return df_scores
+
+def rank_appraisal_scores(df_scores):
+    df_ranked = df_scores.dropna(subset=["Final Score (%)"]).copy()
+    df_ranked["Company Rank"] = df_ranked.groupby("Period")["Final Score (%)"].rank(method="min", ascending=False).astype(int)
+    df_ranked["Department Rank"] = df_ranked.groupby(["Period", "Department"])["Final Score (%)"].rank(method="min", ascending=False).astype(int)
+    return df_ranked.sort_values(["Period", "Company Rank"], ascending=[False, True])
+
+@st.cache_data(show_spinner="Scoring appraisals...")
+def compute_appraisal_scoreboard(appraisals_version, users_version):
+    # Versions are the cache key; the data is re-read only when appraisals or user profiles change
+    users = load_data(USERS_FILE)
+    staff_id_to_department = {user['profile']['staff_id']: user['profile']['department'] for user in users}
+    df_scores = score_appraisals(load_data(SELF_APPRAISALS_FILE), staff_id_to_department)
+    return rank_appraisal_scores(df_scores), int(df_scores["Final Score (%)"].isna().sum())
+
+def appraisal_scoreboard_page():
+    st.header("Appraisal Scoreboard")
+    df_ranked, unrated_count = compute_appraisal_scoreboard(get_file_version(SELF_APPRAISALS_FILE), get_file_version(USERS_FILE))
+    if df_ranked.empty:
+        st.info("No appraisals have been rated yet.")
+        return
+
+    col_period, col_department = st.columns(2)
+    with col_period:
+        periods = sorted(df_ranked["Period"].dropna().astype(str).unique(), reverse=True)
+        selected_period = st.selectbox("Appraisal Period:", periods)
+    df_period = df_ranked[df_ranked["Period"].astype(str) == selected_period]
+    with col_department:
+        departments = sorted(df_period["Department"].dropna().unique())
+        selected_departments = st.multiselect("Filter by Department:", departments)
+    if selected_departments:
+        df_period = df_period[df_period["Department"].isin(selected_departments)]
+
+    col_count, col_mean, col_complete = st.columns(3)
+    col_count.metric("Appraisals Scored", len(df_period))
+    col_mean.metric("Average Final Score", f"{df_period['Final Score (%)'].mean():.1f}%" if not df_period.empty else "N/A")
+    col_complete.metric("Manager Reviews Complete", int((df_period["Manager Review"] == "Complete").sum()))
+    if unrated_count:
+        st.caption(f"{unrated_count} appraisal(s) have no ratings yet and are not ranked.")
+
+    display_columns = ["Company Rank", "Department Rank", "Employee Name", "Staff ID", "Department", "Final Score (%)", "Rating", "Rating Description",
+                       "Self Score (%)", "Manager Score (%)", "Section A Manager (/70)", "Section B Manager (/30)", "Goals", "Manager Review"]
+    paginated_table("appraisal_scoreboard_table", df_period[display_columns], default_sort="Final Score (%)", filter_columns=("Rating Description", "Manager Review"))
+
+    if not df_period.empty:
+        fig_scores = px.box(df_period, x="Department", y="Final Score (%)", points="all",
+                            title=f"Final Appraisal Scores by Department ({selected_period})",
+                            template="plotly_white")
+        st.plotly_chart(fig_scores, use_container_width=True)
+
+# --- Appraisal Reports ---
+# One PDF per appraisal, kept in APPRAISAL_REPORTS_DIR. APPRAISAL_REPORTS_FILE records the hash of the content
+# each PDF was rendered from (the appraisal plus its computed scores), so a run only re-renders appraisals
+# whose hash changed. Reports are rendered one after another in the calling session: fpdf is pure Python,
+# so worker threads only contend for the GIL, and the Streamlit server can neither fork safely nor spawn
+# workers without re-running this script. The per-employee PDFs are then bundled into a ZIP or one
+# combined PDF for download.
+APPRAISAL_REPORT_LAYOUT_VERSION = 1 # Bump when draw_appraisal_report changes so every report is re-rendered
+APPRAISAL_SECTION_B_LABELS = {
+    'leadership_team_development': "Leadership & Team Development",
+    'coordinate_optimize_resources': "Coordinate and Optimize the Use of Resources",
+    'interpersonal': "Interpersonal"
+}
+
+def format_report_score(value, out_of=100):
+    return f"{value:.2f} / {out_of}" if value is not None else "Not Rated"
+
+def draw_appraisal_report(pdf, report):
+    appraisal, scores = report['appraisal'], report['scores']
+    employee_data = appraisal.get('employee_data') or {}
+    pdf.add_page()
+    pdf.set_font("Arial", "", 10)
+
+    pdf.section_heading("Employee Data")
+    pdf.labelled_text("Employee Name", employee_data.get('name', 'N/A'))
+    pdf.labelled_text("Staff ID", appraisal.get('staff_id') or 'N/A')
+    pdf.labelled_text("Designation", employee_data.get('designation', 'N/A'))
+    pdf.labelled_text("Department", scores.get('Department') or employee_data.get('department', 'N/A'))
+    pdf.labelled_text("Appraisal Period", appraisal.get('appraisal_period') or 'N/A')
+    pdf.labelled_text("Date", employee_data.get('date', 'N/A'))
+    pdf.ln(3)
+
+    pdf.section_heading(f"SECTION A: Performance Goals ({APPRAISAL_SECTION_A_WEIGHT}%)")
+    goals = appraisal.get('section_a_goals') or []
+    if not goals:
+        pdf.labelled_text("Goals", "No goals recorded.")
+    for i, goal in enumerate(goals):
+        pdf.set_font("Arial", "B", 10)
+        pdf.labelled_text(f"Goal {i+1}", goal.get('goal_description', 'N/A'))
+        pdf.set_font("Arial", "", 10)
+        pdf.labelled_text("Status", goal.get('status', 'N/A'))
+        pdf.labelled_text("Employee Remark/Update", goal.get('employee_remark_update') or 'N/A')
+        pdf.labelled_text("Period", f"{goal.get('start_date', 'N/A')} to {goal.get('end_date', 'N/A')} ({goal.get('duration', 'N/A')})")
+        pdf.labelled_text("Weighting (%)", goal.get('weighting_percent', 'N/A'))
+        pdf.labelled_text("Self Rating / Line Manager's Rating", f"{goal.get('self_rating') or 'Not Rated'} / {goal.get('line_manager_rating') or 'Not Rated'}")
+        pdf.ln(2)
+
+    pdf.section_heading(f"SECTION B: Qualitative Assessment ({APPRAISAL_SECTION_B_WEIGHT}%)")
+    qualitative = appraisal.get('section_b_qualitative') or {}
+    for item in APPRAISAL_SECTION_B_ITEMS:
+        entry = qualitative.get(item) or {}
+        pdf.set_font("Arial", "B", 10)
+        pdf.labelled_text(APPRAISAL_SECTION_B_LABELS[item], f"Self {entry.get('self_rating') or 'Not Rated'} / Line Manager {entry.get('line_manager_rating') or 'Not Rated'}")
+        pdf.set_font("Arial", "", 10)
+        pdf.labelled_text("Employee Remark", entry.get('remark') or 'N/A')
+        pdf.ln(2)
+
+    pdf.section_heading("Remarks")
+    pdf.labelled_text("Training Recommendation", appraisal.get('training_recommendation') or 'N/A')
+    pdf.labelled_text("HR's Remark", appraisal.get('hr_remark') or 'N/A')
+    pdf.labelled_text("MD's Remark", appraisal.get('md_remark') or 'N/A')
+    pdf.ln(3)
+
+    pdf.section_heading("Scores")
+    pdf.labelled_text("Section A (Self / Line Manager)", f"{format_report_score(scores.get('Section A Self (/70)'), APPRAISAL_SECTION_A_WEIGHT)} / {format_report_score(scores.get('Section A Manager (/70)'), APPRAISAL_SECTION_A_WEIGHT)}")
+    pdf.labelled_text("Section B (Self / Line Manager)", f"{format_report_score(scores.get('Section B Self (/30)'), APPRAISAL_SECTION_B_WEIGHT)} / {format_report_score(scores.get('Section B Manager (/30)'), APPRAISAL_SECTION_B_WEIGHT)}")
+    pdf.labelled_text("Self Score", format_report_score(scores.get('Self Score (%)')))
+    pdf.labelled_text("Manager Score", format_report_score(scores.get('Manager Score (%)')))
+    pdf.set_font("Arial", "B", 10)
+    pdf.labelled_text("Final Score", f"{format_report_score(scores.get('Final Score (%)'))} - {scores.get('Rating Description', 'Not Rated')}")
+    pdf.set_font("Arial", "", 10)
+    pdf.labelled_text("Manager Review", scores.get('Manager Review', 'N/A'))
+
+def render_appraisal_report(report, pdf_path):
+    pdf = ReportPDF("Employee Performance Appraisal Report")
+    draw_appraisal_report(pdf, report)
+    # Written under a temporary name first so a crashed render never leaves a truncated report behind
+    staging_path = f"{pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pdf.output(staging_path)
+    os.replace(staging_path, pdf_path)
+
+def render_appraisal_reports(jobs):
+    # Returns {appraisal_id: error} for the reports that failed
+    errors = {}
+    for appraisal_id, report, pdf_path in jobs:
+        try:
+            render_appraisal_report(report, pdf_path)
+        except Exception as e:
+            errors[appraisal_id] = str(e)
+    return errors
+
+def get_appraisal_report_path(appraisal_id):
+    return os.path.join(APPRAISAL_REPORTS_DIR, f"{re.sub(r'[^A-Za-z0-9_-]', '_', str(appraisal_id))}.pdf")
+
+@st.cache_resource
+def get_appraisal_report_lock():
+    return threading.Lock()
+
+def build_appraisal_reports(appraisals):
+    # Everything a report shows, with NaN scores as None so the content hashes cleanly
+    users = load_data(USERS_FILE)
+    staff_id_to_department = {user['profile']['staff_id']: user['profile']['department'] for user in users}
+    score_rows = json.loads(score_appraisals(appraisals, staff_id_to_department).to_json(orient='records'))
+    reports = {}
+    for appraisal, scores in zip(appraisals, score_rows):
+        report = {"appraisal": appraisal, "scores": scores}
+        content = json.dumps([APPRAISAL_REPORT_LAYOUT_VERSION, report], sort_keys=True, cls=DateEncoder)
+        reports[appraisal['appraisal_id']] = (report, hashlib.sha256(content.encode('utf-8')).hexdigest())
+    return reports
+
+def get_stale_appraisal_reports(reports, manifest):
+    return [
+        appraisal_id for appraisal_id, (report, content_hash) in reports.items()
+        if manifest.get(appraisal_id, {}).get('content_hash') != content_hash or not os.path.exists(get_appraisal_report_path(appraisal_id))
+    ]
+
+def generate_appraisal_reports(appraisals):
+    # Returns (rendered, reused, errors); only appraisals whose content changed since the last run are rendered
+    with get_appraisal_report_lock():
+        reports = build_appraisal_reports(appraisals)
+        manifest = load_data(APPRAISAL_REPORTS_FILE, {})
+        stale_ids = get_stale_appraisal_reports(reports, manifest)
+        errors = render_appraisal_reports([(appraisal_id, reports[appraisal_id][0], get_appraisal_report_path(appraisal_id)) for appraisal_id in stale_ids])
+        rendered_at = datetime.now().isoformat()
+        for appraisal_id in stale_ids:
+            if appraisal_id not in errors:
+                manifest[appraisal_id] = {"content_hash": reports[appraisal_id][1], "rendered_at": rendered_at}
+        if stale_ids:
+            save_data(manifest, APPRAISAL_REPORTS_FILE)
+    return len(stale_ids) - len(errors), len(reports) - len(stale_ids), errors
+
+def bundle_appraisal_reports(appraisals, bundle_format):
+    # Bundles the rendered reports (see generate_appraisal_reports) in employee-name order
+    ordered = sorted(appraisals, key=lambda appraisal: ((appraisal.get('employee_data') or {}).get('name') or '', appraisal['appraisal_id']))
+    report_paths = [
+        (appraisal, get_appraisal_report_path(appraisal['appraisal_id'])) for appraisal in ordered
+        if os.path.exists(get_appraisal_report_path(appraisal['appraisal_id']))
+    ]
+    bundle_file = new_export_file()
+    if bundle_format == "zip":
+        # PDFs are already compressed, so they are stored as-is
+        with zipfile.ZipFile(bundle_file, "w", compression=zipfile.ZIP_STORED) as bundle:
+            for appraisal, report_path in report_paths:
+                employee_name = (appraisal.get('employee_data') or {}).get('name') or 'Employee'
+                bundle.write(report_path, f"{re.sub(r'[^A-Za-z0-9_-]+', '_', employee_name)}_{appraisal.get('staff_id') or 'NA'}_{os.path.basename(report_path)}".replace('/', '_'))
+    elif pymupdf is not None:
+        # Concatenate the existing per-employee PDFs instead of drawing them again
+        combined = pymupdf.open()
+        for appraisal, report_path in report_paths:
+            with pymupdf.open(report_path) as report_pdf:
+                combined.insert_pdf(report_pdf)
+        bundle_file.write(combined.tobytes())
+        combined.close()
+    else:
+        pdf = ReportPDF("Employee Performance Appraisal Report")
+        reports = build_appraisal_reports([appraisal for appraisal, report_path in report_paths])
+        for appraisal, report_path in report_paths:
+            draw_appraisal_report(pdf, reports[appraisal['appraisal_id']][0])
+        bundle_file.write(pdf.output(dest='S').encode('latin-1'))
+    return bundle_file
+
+def appraisal_reports_page():
+    st.header("Appraisal Reports")
+    appraisals = load_data(SELF_APPRAISALS_FILE)
+    periods = sorted({str(appraisal.get('appraisal_period')) for appraisal in appraisals if appraisal.get('appraisal_period')}, reverse=True)
+    if not periods:
+        st.info("No appraisals have been submitted yet.")
+        return
+
+    col_period, col_format = st.columns(2)
+    with col_period:
+        selected_period = st.selectbox("Appraisal Period:", periods)
+    with col_format:
+        bundle_format = st.radio("Download As:", ["zip", "pdf"], format_func=lambda value: {"zip": "ZIP of individual PDFs", "pdf": "Single combined PDF"}[value], horizontal=True)
+    period_appraisals = [appraisal for appraisal in appraisals if str(appraisal.get('appraisal_period')) == selected_period]
+
+    stale_count = len(get_stale_appraisal_reports(build_appraisal_reports(period_appraisals), load_data(APPRAISAL_REPORTS_FILE, {})))
+    col_total, col_current, col_stale = st.columns(3)
+    col_total.metric("Appraisals", len(period_appraisals))
+    col_current.metric("Reports Up to Date", len(period_appraisals) - stale_count)
+    col_stale.metric("Reports to Render", stale_count)
+
+    if st.button("Generate Reports"):
+        with st.spinner(f"Rendering {stale_count} appraisal report(s)..."):
+            rendered, reused, errors = generate_appraisal_reports(period_appraisals)
+            st.session_state.appraisal_report_bundle = (selected_period, bundle_format, bundle_appraisal_reports(period_appraisals, bundle_format))
+        st.success(f"Rendered {rendered} report(s); {reused} unchanged report(s) reused.")
+        for appraisal_id, error in errors.items():
+            st.error(f"Could not render the report for appraisal {appraisal_id}: {error}")
+
+    bundle = st.session_state.get('appraisal_report_bundle')
+    if bundle and bundle[:2] == (selected_period, bundle_format):
+        st.download_button(
+            "Download Appraisal Reports",
+            data=bundle[2],
+            file_name=f"appraisal_reports_{selected_period}.{bundle_format}",
+            mime="application/zip" if bundle_format == "zip" else "application/pdf",
+            on_click="ignore"
+        )
+
+    st.subheader("Individual Report")
+    appraisal_options = {
+        f"{(appraisal.get('employee_data') or {}).get('name', 'Unknown')} ({appraisal.get('staff_id')})": appraisal
+        for appraisal in period_appraisals
+    }
+    selected_employee = st.selectbox("Select Employee:", [""] + list(appraisal_options.keys()))
+    if selected_employee:
+        selected_appraisal = appraisal_options[selected_employee]
+        rendered, reused, errors = generate_appraisal_reports([selected_appraisal])
+        if errors:
+            st.error(f"Could not render the report: {errors[selected_appraisal['appraisal_id']]}")
+        else:
+            with open(get_appraisal_report_path(selected_appraisal['appraisal_id']), "rb") as report_file:
+                st.download_button(
+                    "Download Report",
+                    data=report_file.read(),
+                    file_name=f"Appraisal_{re.sub(r'[^A-Za-z0-9_-]+', '_', selected_employee)}_{selected_period}.pdf",
+                    mime="application/pdf",
+                    on_click="ignore"
+                )
+
+# --- Chat Store ---
+# Each conversation (the unordered pair of staff IDs) has its own append-only JSON-lines log in CHAT_DIR.
+# Messages are appended in timestamp order under a lock and never rewritten, so opening a conversation
+# reads only that thread. Each reader has a small read state file in CHAT_READ_STATE_DIR holding the
+# timestamp of the last message they have seen per conversation (marking a thread read moves one cursor
+# instead of editing messages) and their materialized unread count per sender (a send increments one
+# counter and marking a thread read resets it, so unread badges never scan message logs). A send or a read
+# rewrites only the one reader's file, however many staff use chat.
+# Broadcasts are one record each in CHAT_BROADCAST_LOG and are fanned out when read: a broadcast appears in
+# every conversation with its sender and counts as read once the reader's cursor for that conversation
+# passes it. Per-sender broadcast timestamps are held in memory, so unread broadcasts are a bisect.
+# Because logs only ever grow, a byte offset is a cursor: read_chat_log_since() returns just the messages
+# appended after it, and costs a single stat when nothing is new. scan_chat_log_reverse() walks a log
+# backwards from the end (or from an earlier offset), which is newest-first order, so the latest page of a
+# thread or the page before a (timestamp, message_id) key is read without touching older history.
+def get_conversation_id(staff_id_a, staff_id_b):
+    participants = sorted([str(staff_id_a), str(staff_id_b)])
+    # Staff IDs contain '/', so the readable part is sanitised and a digest keeps IDs unique
+    digest = hashlib.sha1("\n".join(participants).encode('utf-8')).hexdigest()[:8]
+    return f"{'__'.join(re.sub(r'[^A-Za-z0-9-]', '_', staff_id) for staff_id in participants)}_{digest}"
+
+def get_conversation_path(conversation_id):
+    return os.path.join(CHAT_DIR, f"{conversation_id}.jsonl")
+
+@st.cache_resource
+def get_chat_store_lock():
+    return threading.Lock()
+
+def new_chat_timestamp():
+    return datetime.now().isoformat(timespec='microseconds') # Fixed width, so timestamps sort as text
+
+def register_conversation(conversation_id, participants):
+    conversations = load_data(CHAT_CONVERSATIONS_FILE, {})
+    if conversation_id not in conversations:
+        conversations[conversation_id] = sorted(participants)
+        save_data(conversations, CHAT_CONVERSATIONS_FILE)
+
+def append_chat_log(log_path, messages):
+    # Returns (version replaced, version written) like save_data()
+    previous_version = get_file_version(log_path)
+    with open(log_path, "a", encoding="utf-8") as log_file:
+        log_file.write("".join(json.dumps(message, cls=DateEncoder) + "\n" for message in messages))
+        log_file.flush()
+        log_stat = os.fstat(log_file.fileno())
+    return previous_version, f"{log_stat.st_mtime_ns}-{log_stat.st_size}"
+
+def chat_message_order(message):
+    return (message['timestamp'], message['message_id'])
+
+def send_chat_message(sender_staff_id, receiver_staff_id, text):
+    conversation_id = get_conversation_id(sender_staff_id, receiver_staff_id)
+    with get_chat_store_lock():
+        # Stamped inside the lock so every log stays in timestamp order
+        message = {
+            "message_id": str(uuid.uuid4()),
+            "sender_staff_id": sender_staff_id,
+            "receiver_staff_id": receiver_staff_id,
+            "timestamp": new_chat_timestamp(),
+            "message": text
+        }
+        register_conversation(conversation_id, [sender_staff_id, receiver_staff_id])
+        append_chat_log(get_conversation_path(conversation_id), [message])
+        read_state = load_chat_read_state(receiver_staff_id)
+        read_state['unread'][sender_staff_id] = read_state['unread'].get(sender_staff_id, 0) + 1
+        save_chat_read_state(receiver_staff_id, read_state)
+    update_chat_search_index({get_conversation_path(conversation_id): conversation_id})
+    return message
+
+def send_broadcast_message(sender_staff_id, text):
+    # One record for the whole company, whatever the headcount
+    with get_chat_store_lock():
+        message = {
+            "message_id": str(uuid.uuid4()),
+            "sender_staff_id": sender_staff_id,
+            "receiver_staff_id": None,
+            "broadcast": True,
+            "timestamp": new_chat_timestamp(),
+            "message": text
+        }
+        file_write = append_chat_log(CHAT_BROADCAST_LOG, [message])
+        update_derived_view("chat_broadcasts", CHAT_BROADCAST_LOG, lambda index: add_broadcast_to_index(index, message), file_write)
+    update_chat_search_index({CHAT_BROADCAST_LOG: CHAT_BROADCAST_STREAM})
+    return message
+
+def read_chat_log(log_path):
+    messages = []
+    try:
+        with open(log_path, "r", encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue # A torn final line from an interrupted append
+    except FileNotFoundError:
+        pass
+    return messages
+
+def read_conversation(conversation_id):
+    return read_chat_log(get_conversation_path(conversation_id))
+
+def get_chat_log_size(log_path):
+    try:
+        return os.path.getsize(log_path)
+    except FileNotFoundError:
+        return 0
+
+def read_chat_log_since(log_path, offset):
+    # Returns (messages appended after byte `offset`, offset to resume from); a torn last line is left for next time
+    log_size = get_chat_log_size(log_path)
+    if log_size == offset:
+        return [], offset
+    if log_size < offset:
+        offset = 0 # The log was replaced (e.g. by the legacy migration); callers drop repeats by message ID
+    with open(log_path, "rb") as log_file:
+        log_file.seek(offset)
+        data = log_file.read()
+    end = data.rfind(b"\n") + 1
+    messages = []
+    for line in data[:end].splitlines():
+        try:
+            messages.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return messages, offset + end
+
+def add_broadcast_to_index(index, message):
+    stream = index.setdefault(message['sender_staff_id'], {"timestamps": [], "messages": []})
+    position = bisect.bisect_left(stream['messages'], chat_message_order(message), key=chat_message_order)
+    if position < len(stream['messages']) and stream['messages'][position]['message_id'] == message['message_id']:
+        return # Already picked up by a rebuild
+    stream['messages'].insert(position, message)
+    stream['timestamps'].insert(position, message['timestamp'])
+
+def build_broadcast_index(broadcasts):
+    # {sender staff ID: {"timestamps": [...], "messages": [...]}}, both in time order
+    index = {}
+    for message in sorted(broadcasts, key=chat_message_order):
+        stream = index.setdefault(message['sender_staff_id'], {"timestamps": [], "messages": []})
+        stream['messages'].append(message)
+        stream['timestamps'].append(message['timestamp'])
+    return index
+
+def get_broadcast_index():
+    return get_derived_view("chat_broadcasts", CHAT_BROADCAST_LOG, build_broadcast_index, load_fn=read_chat_log)
+
+def scan_chat_log_reverse(log_path, end=None):
+    # Yields (byte offset of the line, message), newest first, from the lines that finish before byte `end`
+    try:
+        log_file = open(log_path, "rb")
+    except FileNotFoundError:
+        return
+    with log_file:
+        position = log_file.seek(0, os.SEEK_END) if end is None else end
+        tail = b""
+        while position > 0:
+            read_size = min(CHAT_SCAN_BLOCK_BYTES, position)
+            position -= read_size
+            log_file.seek(position)
+            lines = (log_file.read(read_size) + tail).split(b"\n")
+            tail = lines.pop(0) # May be cut by the block boundary; completed by the next block
+            line_end = position + len(tail) + 1 + sum(len(line) + 1 for line in lines)
+            for line in reversed(lines):
+                line_end -= len(line) + 1
+                try:
+                    yield line_end, json.loads(line)
+                except json.JSONDecodeError:
+                    continue # The empty string after the final newline, or a torn last line
+        if tail:
+            try:
+                yield 0, json.loads(tail)
+            except json.JSONDecodeError:
+                pass
+
+def read_chat_thread_page(staff_id, other_staff_id, before=None, direct_end=None, limit=CHAT_PAGE_SIZE):
+    # One page of the thread (the direct conversation merged with both participants' broadcasts) ending
+    # just before the (timestamp, message_id) key `before`. direct_end resumes the direct log scan where the
+    # previous page stopped. Returns (messages in time order, whether older messages exist, next direct_end).
+    direct_stream = (
+        (chat_message_order(message), offset, message)
+        for offset, message in scan_chat_log_reverse(get_conversation_path(get_conversation_id(staff_id, other_staff_id)), direct_end)
+        if before is None or chat_message_order(message) < tuple(before)
+    )
+    streams = [direct_stream]
+    with derived_views_locked():
+        broadcast_index = get_broadcast_index()
+        for sender_staff_id in {staff_id, other_staff_id}:
+            if sender_staff_id in broadcast_index:
+                broadcasts = broadcast_index[sender_staff_id]['messages']
+                stop = len(broadcasts) if before is None else bisect.bisect_left(broadcasts, tuple(before), key=chat_message_order)
+                streams.append((chat_message_order(message), None, message) for message in reversed(broadcasts[:stop])) # The slice is taken now
+    page = list(itertools.islice(heapq.merge(*streams, key=lambda item: item[0], reverse=True), limit + 1))
+    has_older = len(page) > limit
+    page = page[:limit]
+    direct_offsets = [offset for order, offset, message in page if offset is not None]
+    return [message for order, offset, message in reversed(page)], has_older, direct_offsets[-1] if direct_offsets else direct_end
+
+def get_user_conversations(staff_id):
+    # {conversation_id: other participant's staff ID}
+    return {
+        conversation_id: next((participant for participant in participants if participant != staff_id), staff_id)
+        for conversation_id, participants in load_data(CHAT_CONVERSATIONS_FILE, {}).items()
+        if staff_id in participants
+    }
+
+def get_chat_read_state_path(staff_id):
+    # Sanitised like conversation IDs, with a digest so distinct staff IDs never share a file
+    digest = hashlib.sha1(str(staff_id).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(CHAT_READ_STATE_DIR, f"{re.sub(r'[^A-Za-z0-9-]', '_', str(staff_id))}_{digest}.json")
+
+def new_chat_read_state(read_state=None):
+    # {"cursors": {conversation_id: last read timestamp}, "unread": {sender staff ID: unread count}}
+    return {"cursors": {}, "unread": {}, **(read_state or {})}
+
+def load_chat_read_state(staff_id):
+    # For a read-modify-write under get_chat_store_lock()
+    return new_chat_read_state(load_data(get_chat_read_state_path(staff_id), {}))
+
+def save_chat_read_state(staff_id, read_state):
+    read_state_path = get_chat_read_state_path(staff_id)
+    file_write = save_data(read_state, read_state_path)
+    def replace_read_state(view):
+        view.clear()
+        view.update(copy.deepcopy(read_state))
+    update_derived_view(f"chat_read_state:{staff_id}", read_state_path, replace_read_state, file_write)
+
+def get_chat_read_state(staff_id):
+    # Shared between sessions and re-read only when the reader's file changes
+    return get_derived_view(f"chat_read_state:{staff_id}", get_chat_read_state_path(staff_id), new_chat_read_state)
+
+def get_unread_chat_counts(reader_staff_id):
+    # {sender staff ID: unread count}: the materialized direct counters plus the sender's broadcasts past the cursor
+    with derived_views_locked():
+        read_state = get_chat_read_state(reader_staff_id)
+        counts = {sender_staff_id: count for sender_staff_id, count in read_state['unread'].items() if count}
+        reader_cursors = read_state['cursors']
+        for sender_staff_id, stream in get_broadcast_index().items():
+            if sender_staff_id == reader_staff_id:
+                continue
+            last_read = reader_cursors.get(get_conversation_id(reader_staff_id, sender_staff_id), "")
+            unread = len(stream['timestamps']) - bisect.bisect_right(stream['timestamps'], last_read)
+            if unread:
+                counts[sender_staff_id] = counts.get(sender_staff_id, 0) + unread
+    return counts
+
+def count_unread_messages(conversation_id, reader_staff_id, last_read):
+    # Scans back from the newest message only as far as the read cursor
+    unread = 0
+    for offset, message in scan_chat_log_reverse(get_conversation_path(conversation_id)):
+        if message['timestamp'] <= last_read:
+            break
+        if message['receiver_staff_id'] == reader_staff_id:
+            unread += 1
+    return unread
+
+def mark_conversations_read(reader_staff_id, last_seen):
+    # last_seen: {other participant's staff ID: timestamp of the newest message shown}; writes only when a cursor moves
+    with get_chat_store_lock():
+        read_state = load_chat_read_state(reader_staff_id)
+        moved = False
+        for other_staff_id, timestamp in last_seen.items():
+            conversation_id = get_conversation_id(reader_staff_id, other_staff_id)
+            if timestamp and timestamp > read_state['cursors'].get(conversation_id, ""):
+                read_state['cursors'][conversation_id] = timestamp
+                # Messages that arrived after the page was drawn stay unread
+                read_state['unread'][other_staff_id] = count_unread_messages(conversation_id, reader_staff_id, timestamp)
+                moved = True
+        if moved:
+            save_chat_read_state(reader_staff_id, read_state)
+
+def migrate_chat_read_state():
+    # One-time split of the shared cursor and counter files into per-reader files. Unread counts missing
+    # from the counter file (logs written before it existed) are counted from the logs. The files are
+    # written to a staging folder that is renamed into place, so an interrupted migration simply reruns.
+    if os.path.isdir(CHAT_READ_STATE_DIR):
+        return
+    cursors = load_data(CHAT_READ_CURSORS_FILE, {})
+    counters = load_data(CHAT_UNREAD_FILE, {}) if os.path.exists(CHAT_UNREAD_FILE) else None
+    read_states = {reader_staff_id: new_chat_read_state({"cursors": dict(reader_cursors)}) for reader_staff_id, reader_cursors in cursors.items()}
+    for conversation_id, participants in load_data(CHAT_CONVERSATIONS_FILE, {}).items():
+        for reader_staff_id in participants:
+            sender_staff_id = next((participant for participant in participants if participant != reader_staff_id), reader_staff_id)
+            if counters is not None:
+                unread = counters.get(reader_staff_id, {}).get(sender_staff_id, 0)
+            else:
+                unread = count_unread_messages(conversation_id, reader_staff_id, cursors.get(reader_staff_id, {}).get(conversation_id, ""))
+            if unread:
+                read_states.setdefault(reader_staff_id, new_chat_read_state())['unread'][sender_staff_id] = unread
+    staging_dir = tempfile.mkdtemp(dir=CHAT_DIR, prefix=".read_state-")
+    for reader_staff_id, read_state in read_states.items():
+        save_data(read_state, os.path.join(staging_dir, os.path.basename(get_chat_read_state_path(reader_staff_id))))
+    try:
+        os.rename(staging_dir, CHAT_READ_STATE_DIR)
+    except OSError: # Another process migrated first
+        for file_name in os.listdir(staging_dir):
+            os.remove(os.path.join(staging_dir, file_name))
+        os.rmdir(staging_dir)
+        return
+    for legacy_file in [CHAT_READ_CURSORS_FILE, CHAT_UNREAD_FILE]:
+        if os.path.exists(legacy_file):
+            os.replace(legacy_file, legacy_file + ".migrated") # Kept as a backup
+
+def migrate_legacy_chat_messages():
+    # One-time split of chat_messages.json into per-conversation logs; read flags become read cursors
+    if not os.path.exists(CHAT_MESSAGES_FILE):
+        return
+    conversations = {}
+    for message in load_data(CHAT_MESSAGES_FILE):
+        conversation_id = get_conversation_id(message['sender_staff_id'], message['receiver_staff_id'])
+        conversations.setdefault(conversation_id, ([message['sender_staff_id'], message['receiver_staff_id']], []))[1].append(message)
+    cursors = load_data(CHAT_READ_CURSORS_FILE, {})
+    with get_chat_store_lock():
+        for conversation_id, (participants, messages) in conversations.items():
+            # Keyed by message ID so a rerun after an interrupted migration does not duplicate messages
+            messages = {message['message_id']: message for message in read_conversation(conversation_id) + messages}
+            messages = sorted(messages.values(), key=chat_message_order)
+            for message in messages:
+                if message.pop('read', False):
+                    reader_cursors = cursors.setdefault(message['receiver_staff_id'], {})
+                    reader_cursors[conversation_id] = max(reader_cursors.get(conversation_id, ""), message['timestamp'])
+            register_conversation(conversation_id, participants)
+            # Swapped in whole so readers never see a half-written log
+            with tempfile.NamedTemporaryFile("w", dir=CHAT_DIR, prefix=".saving-", suffix=".jsonl", delete=False, encoding="utf-8") as log_file:
+                log_file.write("".join(json.dumps(message, cls=DateEncoder) + "\n" for message in messages))
+            os.replace(log_file.name, get_conversation_path(conversation_id))
+        save_data(cursors, CHAT_READ_CURSORS_FILE)
+        os.replace(CHAT_MESSAGES_FILE, CHAT_MESSAGES_FILE + ".migrated") # Kept as a backup
+
+# --- Chat Search ---
+# One positional index (see search_index) over every chat message, faceted by stream: the conversation ID
+# for direct messages, or CHAT_BROADCAST_STREAM. A search is restricted to the searcher's conversations and
+# the broadcasts through that facet, so broadcasts are indexed once rather than once per reader. The index
+# remembers a byte offset per log and catches up by reading only what was appended since (sends update it
+# straight away), so nothing rescans a whole log after the first search of a process.
+CHAT_BROADCAST_STREAM = "broadcasts"
+
+@st.cache_resource
+def get_chat_search_state():
+    return {"index": new_search_index(facet_fields=("stream",)), "offsets": {}}, threading.Lock()
+
+def update_chat_search_index(log_streams):
+    # log_streams: {log path: stream}
+    state, state_lock = get_chat_search_state()
+    with state_lock:
+        for log_path, stream in log_streams.items():
+            messages, state['offsets'][log_path] = read_chat_log_since(log_path, state['offsets'].get(log_path, 0))
+            for message in messages:
+                index_search_document(state['index'], message['message_id'], message.get('message'), {
+                    "stream": stream,
+                    "timestamp": message['timestamp'],
+                    "sender_staff_id": message['sender_staff_id'],
+                    "receiver_staff_id": message.get('receiver_staff_id'),
+                    "message": message.get('message')
+                })
+
+def search_chat_messages(staff_id, query, k=20):
+    # Returns [(score, message fields)] best first, from conversations the user takes part in and broadcasts
+    log_streams = {get_conversation_path(conversation_id): conversation_id for conversation_id in get_user_conversations(staff_id)}
+    log_streams[CHAT_BROADCAST_LOG] = CHAT_BROADCAST_STREAM
+    update_chat_search_index(log_streams)
+    state, state_lock = get_chat_search_state()
+    with state_lock:
+        results = search_index(state['index'], query, k=k, facet_filters={"stream": list(log_streams.values())}, sort_field="timestamp")
+        return [(score, dict(state['index']['docs'][message_id]['fields'])) for score, message_id in results]
+
+def chat_search_panel(current_user_staff_id, staff_id_to_name):
+    with st.expander("Search Messages"):
+        search_query = st.text_input("Search your conversations and broadcasts", key="chat_search_query", help='Words match by prefix; use "quotes" for an exact phrase.')
+        if not search_query:
+            return
+        results = search_chat_messages(current_user_staff_id, search_query)
+        if not results:
+            st.info("No messages match your search.")
+            return
+        rows = []
+        for score, fields in results:
+            if fields['stream'] == CHAT_BROADCAST_STREAM:
+                conversation = "Broadcast to all staff"
+            else:
+                other_staff_id = fields['receiver_staff_id'] if fields['sender_staff_id'] == current_user_staff_id else fields['sender_staff_id']
+                conversation = f"Chat with {staff_id_to_name.get(other_staff_id, 'Unknown')}"
+            rows.append({
+                "Sent": datetime.fromisoformat(fields['timestamp']).strftime("%Y-%m-%d %H:%M"),
+                "From": "You" if fields['sender_staff_id'] == current_user_staff_id else staff_id_to_name.get(fields['sender_staff_id'], 'Unknown'),
+                "Conversation": conversation,
+                "Message": fields['message'],
+                "Relevance": round(score, 3)
+            })
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
 # --- Chat Feature (Personalized) ---
 def get_unread_messages_with_senders(recipient_staff_id):
-    chat_messages = load_data(CHAT_MESSAGES_FILE)
     unread_info = {} # Dictionary to store sender_name: count
+    unread_counters = get_unread_chat_counts(recipient_staff_id)
+    if not unread_counters:
+        return unread_info
     all_users = load_data(USERS_FILE)
     staff_id_to_name = {user['profile']['staff_id']: user['profile']['name'] for user in all_users}
 
-    for msg in chat_messages:
-        if msg['receiver_staff_id'] == recipient_staff_id and not msg.get('read', False):
-            sender_name = staff_id_to_name.get(msg['sender_staff_id'], 'Unknown Sender')
-            unread_info[sender_name] = unread_info.get(sender_name, 0) + 1
+    for sender_staff_id, count in unread_counters.items():
+        sender_name = staff_id_to_name.get(sender_staff_id, 'Unknown Sender')
+        unread_info[sender_name] = unread_info.get(sender_name, 0) + count
     return unread_info
 
+def open_chat_thread(staff_id, other_staff_id):
+    # Sizes are taken before reading, so anything appended meanwhile is fetched again and dropped as a repeat
+    direct_offset = get_chat_log_size(get_conversation_path(get_conversation_id(staff_id, other_staff_id)))
+    broadcast_offset = get_chat_log_size(CHAT_BROADCAST_LOG)
+    messages, has_older, direct_end = read_chat_thread_page(staff_id, other_staff_id)
+    return {
+        "messages": messages,
+        "message_ids": {message['message_id'] for message in messages},
+        "has_older": has_older,
+        "direct_end": direct_end, # Where the direct log scan for the next older page resumes
+        "direct_offset": direct_offset,
+        "broadcast_offset": broadcast_offset,
+        "read_through": ""
+    }
+
+def load_older_chat_messages(thread, staff_id, other_staff_id):
+    older_messages, thread['has_older'], thread['direct_end'] = read_chat_thread_page(
+        staff_id, other_staff_id, before=chat_message_order(thread['messages'][0]), direct_end=thread['direct_end']
+    )
+    older_messages = [message for message in older_messages if message['message_id'] not in thread['message_ids']]
+    thread['message_ids'].update(message['message_id'] for message in older_messages)
+    thread['messages'][:0] = older_messages
+
+def poll_chat_thread(thread, staff_id, other_staff_id):
+    # Adds messages appended since the thread's offsets; an idle poll is two stat calls
+    direct_messages, thread['direct_offset'] = read_chat_log_since(get_conversation_path(get_conversation_id(staff_id, other_staff_id)), thread['direct_offset'])
+    broadcasts, thread['broadcast_offset'] = read_chat_log_since(CHAT_BROADCAST_LOG, thread['broadcast_offset'])
+    new_messages = [
+        message for message in direct_messages + [broadcast for broadcast in broadcasts if broadcast['sender_staff_id'] in (staff_id, other_staff_id)]
+        if message['message_id'] not in thread['message_ids']
+    ]
+    if not new_messages:
+        return
+    thread['message_ids'].update(message['message_id'] for message in new_messages)
+    thread['messages'].extend(new_messages)
+    thread['messages'].sort(key=chat_message_order) # Nearly sorted already, so this is a linear pass
+
+def get_chat_thread(staff_id, other_staff_id):
+    # Each session keeps its open threads and only polls for what is new
+    chat_threads = st.session_state.setdefault('chat_threads', {})
+    conversation_id = get_conversation_id(staff_id, other_staff_id)
+    if conversation_id not in chat_threads:
+        chat_threads[conversation_id] = open_chat_thread(staff_id, other_staff_id)
+    else:
+        poll_chat_thread(chat_threads[conversation_id], staff_id, other_staff_id)
+    return chat_threads[conversation_id]
+
 def chat_page():
     st.header("Personalized Chat")
     current_user_staff_id = st.session_state.current_user['profile']['staff_id']
     current_user_name = st.session_state.current_user['profile']['name']
     all_users = load_data(USERS_FILE)
-    chat_messages = load_data(CHAT_MESSAGES_FILE)
 
     # Get a list of other users to chat with
     other_users = [user for user in all_users if user['profile']['staff_id'] != current_user_staff_id]
@@ -2145,18 +4999,7 @@ def chat_page():
         broadcast_message = st.text_area("Message to all staff:", key="broadcast_input")
         if st.button("Send Broadcast"):
             if broadcast_message:
-                for user in all_users:
-                    if user['profile']['staff_id'] != current_user_staff_id: # Don't send to self
-                        new_chat_entry = {
-                            "message_id": str(uuid.uuid4()),
-                            "sender_staff_id": current_user_staff_id,
-                            "receiver_staff_id": user['profile']['staff_id'],
-                            "timestamp": datetime.now().isoformat(),
-                            "message": broadcast_message,
-                            "read": False
-                        }
-                        chat_messages.append(new_chat_entry)
-                save_data(chat_messages, CHAT_MESSAGES_FILE)
+                send_broadcast_message(current_user_staff_id, broadcast_message)
                 st.success("Broadcast message sent to all staff!")
                 st.rerun()
             else:
@@ -2164,80 +5007,828 @@ def chat_page():
         st.markdown("---")
 
 
+    chat_search_panel(current_user_staff_id, staff_id_to_name)
+
     # Select recipient for private chat
     recipient_options = {user['profile']['name']: user['profile']['staff_id'] for user in other_users}
     selected_recipient_name = st.selectbox("Chat with:", [""] + list(recipient_options.keys()))
 
-    selected_recipient_staff_id = None
     if selected_recipient_name:
         selected_recipient_staff_id = recipient_options[selected_recipient_name]
         st.subheader(f"Chat with {selected_recipient_name}")
+        live_updates = st.toggle("Live updates", value=True, help=f"Check for new messages every {CHAT_POLL_SECONDS} seconds.")
+
+        # Only this fragment reruns on each poll, and it fetches just the messages appended since the last one
+        @st.fragment(run_every=CHAT_POLL_SECONDS if live_updates else None)
+        def show_chat_thread():
+            thread = get_chat_thread(current_user_staff_id, selected_recipient_staff_id)
+            conversation_messages = thread['messages']
+
+            # Display messages: the latest page, plus any older pages loaded on request
+            chat_container = st.container(height=400, border=True)
+            if thread['has_older']:
+                chat_container.button("Load older messages", key="chat_load_older", on_click=load_older_chat_messages, args=(thread, current_user_staff_id, selected_recipient_staff_id))
+            if conversation_messages:
+                for msg in conversation_messages:
+                    sender_name = staff_id_to_name.get(msg['sender_staff_id'], 'Unknown')
+                    message_time = datetime.fromisoformat(msg['timestamp']).strftime("%Y-%m-%d %H:%M")
+                    if msg.get('broadcast'):
+                        message_time += ", broadcast to all staff"
+
+                    if msg['sender_staff_id'] == current_user_staff_id:
+                        chat_container.markdown(f"**You** ({message_time}): {msg['message']}")
+                    else:
+                        chat_container.markdown(f"**{sender_name}** ({message_time}): {msg['message']}")
+                # Everything shown is now read; the cursor is only written when something new was shown
+                if conversation_messages[-1]['timestamp'] > thread['read_through']:
+                    mark_conversations_read(current_user_staff_id, {selected_recipient_staff_id: conversation_messages[-1]['timestamp']})
+                    thread['read_through'] = conversation_messages[-1]['timestamp']
+            else:
+                chat_container.info("No messages in this conversation yet.")
 
-        # Filter messages between current user and selected recipient
-        # Messages where current user is sender AND selected recipient is receiver
-        # OR messages where selected recipient is sender AND current user is receiver
-        conversation_messages = [
-            msg for msg in chat_messages
-            if (msg['sender_staff_id'] == current_user_staff_id and msg['receiver_staff_id'] == selected_recipient_staff_id) or
-               (msg['sender_staff_id'] == selected_recipient_staff_id and msg['receiver_staff_id'] == current_user_staff_id)
-        ]
-
-        # Sort messages by timestamp
-        conversation_messages.sort(key=lambda x: x['timestamp'])
-
-        # Display messages
-        chat_container = st.container(height=400, border=True)
-        if conversation_messages:
-            for msg in conversation_messages:
-                sender_name = staff_id_to_name.get(msg['sender_staff_id'], 'Unknown')
-                message_time = datetime.fromisoformat(msg['timestamp']).strftime("%Y-%m-%d %H:%M")
-                
-                if msg['sender_staff_id'] == current_user_staff_id:
-                    chat_container.markdown(f"**You** ({message_time}): {msg['message']}")
-                else:
-                    chat_container.markdown(f"**{sender_name}** ({message_time}): {msg['message']}")
-                
-                # Mark message as read if current user is the receiver and it's unread
-                if msg['receiver_staff_id'] == current_user_staff_id and not msg.get('read', False):
-                    msg['read'] = True # Mark as read
-                    # This modification needs to be saved back to the file
-                    # To avoid saving on every message display, we'll save when a new message is sent or page is reloaded.
-                    # For now, let's just update the in-memory object.
-                    # A more robust solution would involve a 'mark all as read' button or saving on page exit.
-        else:
-            chat_container.info("No messages in this conversation yet.")
+        show_chat_thread()
 
         # Message input
         new_message = st.text_input("Type your message here:", key="chat_input")
         if st.button("Send Message"):
             if new_message:
-                new_chat_entry = {
-                    "message_id": str(uuid.uuid4()),
-                    "sender_staff_id": current_user_staff_id,
-                    "receiver_staff_id": selected_recipient_staff_id,
-                    "timestamp": datetime.now().isoformat(),
-                    "message": new_message,
-                    "read": False # Message is unread by recipient initially
-                }
-                chat_messages.append(new_chat_entry)
-                save_data(chat_messages, CHAT_MESSAGES_FILE)
+                send_chat_message(current_user_staff_id, selected_recipient_staff_id, new_message)
                 st.success("Message sent!")
                 st.rerun() # Rerun to clear input and show new message
+    else:
+        # Opening the chat page without picking a conversation counts as seeing every conversation;
+        # only the conversations with unread messages need their cursors moved
+        mark_conversations_read(current_user_staff_id, {
+            sender_staff_id: (read_chat_thread_page(current_user_staff_id, sender_staff_id, limit=1)[0] or [{}])[-1].get('timestamp')
+            for sender_staff_id in get_unread_chat_counts(current_user_staff_id)
+        })
+
+
+# --- Payroll Run Engine ---
+# Monthly pay components per employee are kept in COMPENSATION_FILE. A payroll run computes every
+# employee's payslip at once with array arithmetic: PAYE under the Personal Income Tax Act (consolidated
+# relief allowance, progressive annual bands, 1% minimum tax), the employee's pension contribution,
+# National Housing Fund and other deductions. Each run replaces the period's payslips in one atomic save.
+PAYROLL_EARNING_COMPONENTS = ['basic', 'housing', 'transport', 'other_allowances']
+PAYROLL_COMPONENT_LABELS = {
+    'basic': "Basic", 'housing': "Housing", 'transport': "Transport",
+    'other_allowances': "Other Allowances", 'other_deductions': "Other Deductions"
+}
+# Annual taxable income bands as (band width, rate); the last band is open-ended
+PAYE_TAX_BANDS = [(300_000, 0.07), (300_000, 0.11), (500_000, 0.15), (500_000, 0.19), (1_600_000, 0.21), (np.inf, 0.24)]
+PAYE_CRA_FIXED = 200_000 # Consolidated relief: the higher of NGN 200,000 and 1% of gross, plus 20% of gross
+PAYE_CRA_GROSS_RATE = 0.01
+PAYE_CRA_PERCENT = 0.20
+PAYE_MINIMUM_TAX_RATE = 0.01 # Minimum tax as a share of gross income
+PAYE_EXEMPT_MONTHLY_GROSS = 70_000 # Employees on the national minimum wage pay no PAYE
+PENSION_EMPLOYEE_RATE = 0.08 # Of basic, housing and transport
+PENSION_EMPLOYER_RATE = 0.10
+NHF_RATE = 0.025 # Of basic
+
+def compute_paye(annual_gross, annual_reliefs):
+    # annual_reliefs: tax-exempt deductions (pension, NHF) taken off before the bands apply
+    band_widths = np.array([width for width, rate in PAYE_TAX_BANDS], dtype=float)
+    band_rates = np.array([rate for width, rate in PAYE_TAX_BANDS], dtype=float)
+    band_starts = np.concatenate([[0.0], np.cumsum(band_widths)[:-1]])
+    consolidated_relief = np.maximum(PAYE_CRA_FIXED, PAYE_CRA_GROSS_RATE * annual_gross) + PAYE_CRA_PERCENT * annual_gross
+    taxable_income = np.maximum(annual_gross - consolidated_relief - annual_reliefs, 0.0)
+    # Income falling in each band, one column per band
+    income_in_band = np.clip(taxable_income[:, None] - band_starts[None, :], 0.0, band_widths[None, :])
+    tax = np.maximum(income_in_band @ band_rates, PAYE_MINIMUM_TAX_RATE * annual_gross)
+    return np.where(annual_gross <= PAYE_EXEMPT_MONTHLY_GROSS * 12, 0.0, tax)
+
+def compute_payroll(df_components):
+    # df_components: one row per employee with staff_id and the monthly components; returns the row plus payroll columns
+    df_payroll = df_components.copy()
+    for component in PAYROLL_EARNING_COMPONENTS + ['other_deductions']:
+        df_payroll[component] = pd.to_numeric(df_payroll[component], errors='coerce').fillna(0.0).round(2) if component in df_payroll else 0.0
+    gross_pay = df_payroll[PAYROLL_EARNING_COMPONENTS].to_numpy().sum(axis=1)
+    pensionable_pay = df_payroll[['basic', 'housing', 'transport']].to_numpy().sum(axis=1)
+    pension = PENSION_EMPLOYEE_RATE * pensionable_pay
+    nhf = NHF_RATE * df_payroll['basic'].to_numpy()
+    paye = compute_paye(gross_pay * 12, (pension + nhf) * 12) / 12
+    df_payroll['gross_pay'] = gross_pay.round(2)
+    df_payroll['paye'] = paye.round(2)
+    df_payroll['pension'] = pension.round(2)
+    df_payroll['nhf'] = nhf.round(2)
+    df_payroll['deductions'] = (df_payroll['paye'] + df_payroll['pension'] + df_payroll['nhf'] + df_payroll['other_deductions']).round(2)
+    df_payroll['net_pay'] = (df_payroll['gross_pay'] - df_payroll['deductions']).round(2)
+    df_payroll['employer_pension'] = (PENSION_EMPLOYER_RATE * pensionable_pay).round(2)
+    return df_payroll
+
+def get_payslip_id(pay_period, staff_id):
+    # Stable per (period, employee), so rerunning a period replaces its payslips instead of adding more
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"payslip:{pay_period}:{staff_id}"))
+
+def build_payroll_batch(df_payroll, pay_period, pay_date, payroll_run_id):
+    columns = {column: df_payroll[column].tolist() for column in ['staff_id', 'gross_pay', 'deductions', 'net_pay', 'paye', 'pension', 'nhf', 'employer_pension'] + PAYROLL_EARNING_COMPONENTS + ['other_deductions']}
+    return [
+        {
+            "payslip_id": get_payslip_id(pay_period, columns['staff_id'][i]),
+            "staff_id": columns['staff_id'][i],
+            "pay_period": pay_period,
+            "pay_date": pay_date,
+            "gross_pay": columns['gross_pay'][i],
+            "deductions": columns['deductions'][i],
+            "net_pay": columns['net_pay'][i],
+            "earnings": {component: columns[component][i] for component in PAYROLL_EARNING_COMPONENTS},
+            "deduction_items": {"paye": columns['paye'][i], "pension": columns['pension'][i], "nhf": columns['nhf'][i], "other_deductions": columns['other_deductions'][i]},
+            "employer_pension": columns['employer_pension'][i],
+            "payroll_run_id": payroll_run_id
+        }
+        for i in range(len(df_payroll))
+    ]
+
+def payroll_store_lock():
+    return data_file_lock(PAYROLL_FILE, "payroll store")
+
+def commit_payroll_batch(batch):
+    # Replaces any earlier payslips of the same employees for the batch's periods, in a single atomic write.
+    # Payroll runs and imports can commit at the same time, so the read-modify-write holds the store lock.
+    replaced = {(payslip['pay_period'], payslip['staff_id']) for payslip in batch}
+    with payroll_store_lock():
+        payroll_data, removed_payslip_ids = [], []
+        for payslip in load_data(PAYROLL_FILE):
+            if (payslip.get('pay_period'), payslip.get('staff_id')) in replaced:
+                removed_payslip_ids.append(payslip['payslip_id'])
+            else:
+                payroll_data.append(payslip)
+        file_write = save_data(payroll_data + batch, PAYROLL_FILE)
+        on_payroll_saved(file_write, changed_payslips=batch, removed_payslip_ids=removed_payslip_ids)
+
+def load_compensation_frame(users):
+    compensation = load_data(COMPENSATION_FILE, {})
+    rows = []
+    for user in users:
+        staff_id = user['profile']['staff_id']
+        components = compensation.get(staff_id, {})
+        rows.append({
+            "staff_id": staff_id,
+            "name": user['profile']['name'],
+            "department": user['profile']['department'],
+            **{component: float(components.get(component, 0.0)) for component in PAYROLL_EARNING_COMPONENTS + ['other_deductions']}
+        })
+    return pd.DataFrame(rows, columns=['staff_id', 'name', 'department'] + PAYROLL_EARNING_COMPONENTS + ['other_deductions'])
+
+def payroll_run_page():
+    st.header("Payroll Run")
+    users = load_data(USERS_FILE)
 
-    # After sending a message or selecting a new chat, ensure all displayed messages are marked as read for the current user
-    # This is a simple approach to mark messages as read. A more sophisticated system might involve
-    # a separate 'read status' for each user or a 'mark as read' button.
-    # This block should ideally be outside the selected_recipient_name if condition to mark all received messages as read
-    # when the chat page is generally accessed.
-    for msg in chat_messages:
-        if msg['receiver_staff_id'] == current_user_staff_id and not msg.get('read', False):
-            # Only mark as read if the current chat is with the sender or if no specific chat is selected (general view)
-            if selected_recipient_staff_id and (msg['sender_staff_id'] == selected_recipient_staff_id):
-                msg['read'] = True
-            elif not selected_recipient_staff_id: # If no specific chat selected, but on chat page, mark all as read
-                 msg['read'] = True
-    save_data(chat_messages, CHAT_MESSAGES_FILE) # Save the read status updates
+    st.subheader("Monthly Compensation")
+    df_compensation = load_compensation_frame(users)
+    edited_compensation = st.data_editor(
+        df_compensation,
+        column_config={
+            "staff_id": st.column_config.TextColumn("Staff ID", disabled=True),
+            "name": st.column_config.TextColumn("Name", disabled=True),
+            "department": st.column_config.TextColumn("Department", disabled=True),
+            **{component: st.column_config.NumberColumn(f"{label} (NGN)", min_value=0.0, format="%.2f") for component, label in PAYROLL_COMPONENT_LABELS.items()}
+        },
+        hide_index=True,
+        use_container_width=True,
+        key="compensation_editor"
+    )
+    if st.button("Save Compensation"):
+        compensation = load_data(COMPENSATION_FILE, {})
+        for row in edited_compensation.to_dict('records'):
+            compensation[row['staff_id']] = {component: float(row[component] or 0.0) for component in PAYROLL_EARNING_COMPONENTS + ['other_deductions']}
+        save_data(compensation, COMPENSATION_FILE)
+        st.success("Compensation saved.")
+    # Payroll always runs on saved compensation, never on unsaved edits in the table above
+    df_compensation = load_compensation_frame(users)
+    compensation_columns = PAYROLL_EARNING_COMPONENTS + ['other_deductions']
+    if (edited_compensation[compensation_columns].fillna(0.0).to_numpy() != df_compensation[compensation_columns].to_numpy()).any():
+        st.warning("You have unsaved compensation changes. Save them first to include them in the payroll run.")
 
+    st.markdown("---")
+    st.subheader("Run Payroll")
+    col_month, col_year, col_date = st.columns(3)
+    today = date.today()
+    with col_month:
+        pay_month = st.selectbox("Month", list(range(1, 13)), index=today.month - 1, format_func=lambda month: date(2000, month, 1).strftime("%B"))
+    with col_year:
+        pay_year = st.number_input("Year", min_value=2000, max_value=2100, value=today.year, step=1)
+    with col_date:
+        pay_date = st.date_input("Pay Date", value=date(int(pay_year), pay_month, 25))
+    pay_period = f"{date(2000, pay_month, 1).strftime('%B')} {int(pay_year)}" # Same "July 2024" style as existing payslips
+
+    df_payroll = compute_payroll(df_compensation[df_compensation[PAYROLL_EARNING_COMPONENTS].sum(axis=1) > 0])
+    if df_payroll.empty:
+        st.info("Enter and save monthly compensation to run payroll.")
+        return
+    col_staff, col_gross, col_deductions, col_net = st.columns(4)
+    col_staff.metric("Employees", len(df_payroll))
+    col_gross.metric("Total Gross (NGN)", f"{df_payroll['gross_pay'].sum():,.2f}")
+    col_deductions.metric("Total Deductions (NGN)", f"{df_payroll['deductions'].sum():,.2f}")
+    col_net.metric("Total Net Pay (NGN)", f"{df_payroll['net_pay'].sum():,.2f}")
+    paginated_table("payroll_run_preview_table", df_payroll.rename(columns={
+        "staff_id": "Staff ID", "name": "Name", "department": "Department", **PAYROLL_COMPONENT_LABELS,
+        "gross_pay": "Gross Pay", "paye": "PAYE", "pension": "Pension (Employee)", "nhf": "NHF",
+        "deductions": "Total Deductions", "net_pay": "Net Pay", "employer_pension": "Pension (Employer)"
+    }), default_sort="Name", filter_columns=("Department",))
+
+    existing_count = sum(1 for payslip in load_data(PAYROLL_FILE) if payslip.get('pay_period') == pay_period)
+    if existing_count:
+        st.warning(f"{existing_count} payslip(s) already exist for {pay_period}; running payroll replaces those of the employees above.")
+    if st.button(f"Commit Payroll for {pay_period}"):
+        batch = build_payroll_batch(df_payroll, pay_period, pay_date.isoformat(), str(uuid.uuid4()))
+        commit_payroll_batch(batch)
+        st.success(f"Payroll for {pay_period} committed: {len(batch)} payslip(s).")
+
+# --- Payroll Import ---
+# Bank/ERP payroll exports are streamed in chunks of PAYROLL_IMPORT_CHUNK_ROWS rows, so memory stays
+# bounded by the chunk plus the compact columns of the valid rows. Each chunk is checked with column
+# operations (known staff ID, numeric non-negative amounts, gross - deductions = net, unambiguous pay date,
+# one row per employee and period); failures are reported per CSV line and the valid rows are committed
+# together in a single write through commit_payroll_batch().
+PAYROLL_IMPORT_CHUNK_ROWS = 20_000
+PAYROLL_IMPORT_REQUIRED_COLUMNS = ['staff_id', 'pay_period', 'pay_date', 'gross_pay', 'deductions', 'net_pay']
+PAYROLL_IMPORT_TOLERANCE = 0.01 # Largest rounding difference accepted between gross - deductions and net
+PAYROLL_IMPORT_MAX_ERRORS = 5_000 # Errors listed in detail; the rest are only counted
+# Accepted pay date formats, tried in order per value, each mapped to the month-first reading of the same
+# text (None if there is none). Exports are day-first; a date that reads differently month-first, such as
+# 05/07/2024, is reported as ambiguous instead of guessed.
+PAYROLL_IMPORT_DATE_FORMATS = {
+    "%Y-%m-%d": None,
+    "%d/%m/%Y": "%m/%d/%Y",
+    "%d-%m-%Y": "%m-%d-%Y",
+    "%d.%m.%Y": "%m.%d.%Y"
+}
+
+def build_staff_directory(users):
+    return {
+        user['profile']['staff_id']: {
+            "name": user['profile']['name'],
+            "department": user['profile']['department'],
+            "grade_level": user['profile']['grade_level']
+        }
+        for user in users if user['profile']['staff_id'] != 'N/A'
+    }
+
+def get_staff_directory():
+    # staff_id -> name/department/grade, shared and rebuilt only when USERS_FILE changes
+    return get_derived_view("staff_directory", USERS_FILE, build_staff_directory)
+
+def normalize_import_column(column):
+    return str(column).strip().lower().replace(' ', '_').replace('-', '_')
+
+def parse_import_pay_dates(values):
+    # Returns (parsed dates, mask of ambiguous values); every value is parsed against the explicit formats,
+    # so one chunk can mix them. A time after the date is ignored.
+    values = values.fillna('').str.strip().str.split(r'[ T]', n=1, regex=True).str[0]
+    pay_dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    ambiguous = pd.Series(False, index=values.index)
+    for date_format, month_first_format in PAYROLL_IMPORT_DATE_FORMATS.items():
+        unparsed = pay_dates.isna()
+        parsed = pd.to_datetime(values[unparsed], format=date_format, errors='coerce')
+        pay_dates[unparsed] = parsed
+        if month_first_format:
+            month_first = pd.to_datetime(values[unparsed], format=month_first_format, errors='coerce')
+            ambiguous[unparsed] = parsed.notna() & month_first.notna() & (parsed != month_first)
+    return pay_dates, ambiguous
+
+def validate_payroll_chunk(chunk, first_line, known_staff_ids, seen_key_hashes):
+    # chunk: raw string columns; first_line: CSV line number of the chunk's first row (the header is line 1);
+    # seen_key_hashes: 64-bit hashes of the staff ID/pay period of valid rows in earlier chunks.
+    # Returns (valid rows as a DataFrame, errors as a DataFrame of line/staff_id/error, key hashes of the valid rows).
+    chunk = chunk.reset_index(drop=True)
+    staff_ids = chunk['staff_id'].fillna('').str.strip()
+    pay_periods = chunk['pay_period'].fillna('').str.strip()
+    amounts = {
+        field: pd.to_numeric(chunk[field].fillna('').str.replace(',', '', regex=False).str.strip(), errors='coerce')
+        for field in ['gross_pay', 'deductions', 'net_pay']
+    }
+    pay_dates, ambiguous_dates = parse_import_pay_dates(chunk['pay_date'])
+    key_hashes = pd.util.hash_array((staff_ids + "|" + pay_periods).to_numpy(dtype=object))
+    duplicate_keys = pd.Series(pd.Series(key_hashes).duplicated().to_numpy() | np.isin(key_hashes, seen_key_hashes), index=chunk.index)
+
+    amounts_numeric = amounts['gross_pay'].notna() & amounts['deductions'].notna() & amounts['net_pay'].notna()
+    checks = [
+        (staff_ids == '', "Missing staff ID"),
+        ((staff_ids != '') & ~staff_ids.isin(known_staff_ids), "Unknown staff ID"),
+        (pay_periods == '', "Missing pay period"),
+        (pay_dates.isna(), "Invalid pay date"),
+        (ambiguous_dates, "Ambiguous pay date: day and month could be swapped (use YYYY-MM-DD)"),
+        (~amounts_numeric, "Non-numeric amount"),
+        (amounts_numeric & ((amounts['gross_pay'] < 0) | (amounts['deductions'] < 0) | (amounts['net_pay'] < 0)), "Negative amount"),
+        (amounts_numeric & ((amounts['gross_pay'] - amounts['deductions'] - amounts['net_pay']).abs() > PAYROLL_IMPORT_TOLERANCE), "Gross pay minus deductions does not equal net pay"),
+        ((staff_ids != '') & (pay_periods != '') & duplicate_keys, "Duplicate row for this staff ID and pay period")
+    ]
+    invalid = pd.Series(False, index=chunk.index)
+    error_frames = []
+    for mask, message in checks:
+        invalid |= mask
+        if mask.any():
+            error_frames.append(pd.DataFrame({"line": mask.index[mask] + first_line, "staff_id": staff_ids[mask], "error": message}))
+
+    valid = ~invalid
+    valid_rows = pd.DataFrame({
+        "staff_id": staff_ids[valid],
+        "pay_period": pay_periods[valid],
+        "pay_date": pay_dates[valid].dt.strftime('%Y-%m-%d'),
+        **{field: amounts[field][valid].round(2) for field in amounts}
+    })
+    errors = pd.concat(error_frames, ignore_index=True) if error_frames else pd.DataFrame(columns=["line", "staff_id", "error"])
+    return valid_rows, errors, key_hashes[valid.to_numpy()]
+
+def validate_payroll_csv(csv_file):
+    # Returns (valid rows, errors listed, total error count, rows read); raises ValueError if required columns are missing
+    known_staff_ids = list(get_staff_directory())
+    seen_key_hashes = np.array([], dtype=np.uint64)
+    valid_frames, error_frames = [], []
+    error_count = rows_read = 0
+    for chunk in pd.read_csv(csv_file, dtype=str, chunksize=PAYROLL_IMPORT_CHUNK_ROWS, skipinitialspace=True):
+        chunk.columns = [normalize_import_column(column) for column in chunk.columns]
+        missing_columns = [column for column in PAYROLL_IMPORT_REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing_columns:
+            raise ValueError(f"Missing required column(s): {', '.join(missing_columns)}")
+        valid_rows, errors, valid_key_hashes = validate_payroll_chunk(chunk, rows_read + 2, known_staff_ids, seen_key_hashes)
+        seen_key_hashes = np.concatenate([seen_key_hashes, valid_key_hashes])
+        rows_read += len(chunk)
+        valid_frames.append(valid_rows)
+        error_count += len(errors)
+        listed_errors = sum(len(frame) for frame in error_frames)
+        if listed_errors < PAYROLL_IMPORT_MAX_ERRORS:
+            error_frames.append(errors.head(PAYROLL_IMPORT_MAX_ERRORS - listed_errors))
+    valid_rows = pd.concat(valid_frames, ignore_index=True) if valid_frames else pd.DataFrame(columns=PAYROLL_IMPORT_REQUIRED_COLUMNS)
+    errors = pd.concat(error_frames, ignore_index=True).sort_values(['line', 'error'], kind='stable') if error_frames else pd.DataFrame(columns=["line", "staff_id", "error"])
+    return valid_rows, errors, error_count, rows_read
+
+def build_imported_payroll_batch(valid_rows, import_id):
+    columns = {column: valid_rows[column].tolist() for column in PAYROLL_IMPORT_REQUIRED_COLUMNS}
+    return [
+        {
+            "payslip_id": get_payslip_id(columns['pay_period'][i], columns['staff_id'][i]),
+            "staff_id": columns['staff_id'][i],
+            "pay_period": columns['pay_period'][i],
+            "pay_date": columns['pay_date'][i],
+            "gross_pay": columns['gross_pay'][i],
+            "deductions": columns['deductions'][i],
+            "net_pay": columns['net_pay'][i],
+            "payroll_import_id": import_id
+        }
+        for i in range(len(valid_rows))
+    ]
+
+def payroll_import_page():
+    st.header("Payroll Import")
+    st.write(f"Upload a payroll CSV with the columns: {', '.join(PAYROLL_IMPORT_REQUIRED_COLUMNS)}. "
+             "Amounts may use thousands separators; rows for an employee and pay period that already exist are replaced.")
+    uploaded_file = st.file_uploader("Payroll CSV", type=["csv"], key="payroll_import_file")
+    if uploaded_file is None:
+        return
+
+    # Validate each upload once; reruns reuse the result until another file is chosen
+    validation = st.session_state.get('payroll_import_validation')
+    if validation is None or validation['file_id'] != uploaded_file.file_id:
+        try:
+            valid_rows, errors, error_count, rows_read = validate_payroll_csv(uploaded_file)
+        except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as e:
+            st.error(f"Could not read the CSV file: {e}")
+            return
+        validation = {"file_id": uploaded_file.file_id, "valid_rows": valid_rows, "errors": errors,
+                      "error_count": error_count, "rows_read": rows_read, "imported": False}
+        st.session_state.payroll_import_validation = validation
+
+    valid_rows, errors = validation['valid_rows'], validation['errors']
+    col_rows, col_valid, col_invalid = st.columns(3)
+    col_rows.metric("Rows Read", f"{validation['rows_read']:,}")
+    col_valid.metric("Valid Rows", f"{len(valid_rows):,}")
+    col_invalid.metric("Rows With Errors", f"{validation['rows_read'] - len(valid_rows):,}")
+
+    if validation['error_count']:
+        st.warning(f"{validation['error_count']:,} error(s) found; rows with errors will not be imported.")
+        if validation['error_count'] > len(errors):
+            st.caption(f"Showing the first {len(errors):,} errors.")
+        paginated_table("payroll_import_errors_table", errors.rename(columns={"line": "CSV Line", "staff_id": "Staff ID", "error": "Error"}),
+                        default_sort="CSV Line", filter_columns=("Error",))
+        export_table_buttons("payroll_import_errors", lambda: errors, "payroll_import_errors")
+
+    if validation['imported']:
+        st.success(f"{len(valid_rows):,} payslip(s) imported from this file.")
+    elif not valid_rows.empty:
+        st.markdown(f"**Total Net Pay:** NGN {valid_rows['net_pay'].sum():,.2f} across {valid_rows['pay_period'].nunique()} pay period(s)")
+        if st.button(f"Import {len(valid_rows):,} Valid Payslip(s)"):
+            commit_payroll_batch(build_imported_payroll_batch(valid_rows, str(uuid.uuid4())))
+            validation['imported'] = True
+            st.success(f"{len(valid_rows):,} payslip(s) imported.")
+    else:
+        st.info("No valid rows to import.")
+
+# --- Payslip PDFs ---
+# Every payslip shares one page layout. Its static parts (logo, company heading, field labels, column
+# headings, footnote) are drawn once into a template document that is cached and deep-copied per payslip,
+# so a render only writes the payslip's own values and the logo is decoded once per process.
+# Rendered PDFs are kept in PAYSLIP_PDFS_DIR and PAYSLIP_PDFS_FILE records the content hash each was
+# rendered from, so downloading an unchanged payslip again serves the stored file without taking a lock.
+# A pay period is rendered in batch, one payslip after another (fpdf is pure Python, so threads would only
+# contend for the GIL), and bundled into a ZIP for distribution.
+PAYSLIP_LAYOUT_VERSION = 1 # Bump when the template or draw_payslip changes so every payslip is re-rendered
+PAYSLIP_COMPANY_NAME = "Polaris Digitech Limited"
+PAYSLIP_DETAIL_FIELDS = ["Employee Name", "Staff ID", "Department", "Pay Period", "Pay Date"]
+PAYSLIP_DETAILS_Y = 42
+PAYSLIP_ITEMS_Y = 85 # Column headings; line items start one row below
+PAYSLIP_ITEM_ROWS = 4 # Line items per column
+PAYSLIP_ROW_HEIGHT = 7
+PAYSLIP_TOTALS_Y = PAYSLIP_ITEMS_Y + PAYSLIP_ROW_HEIGHT * (PAYSLIP_ITEM_ROWS + 1) + 3
+PAYSLIP_DEDUCTION_LABELS = {"paye": "PAYE Tax", "pension": "Pension (Employee)", "nhf": "National Housing Fund", "other_deductions": "Other Deductions"}
+
+def build_payslip_template():
+    pdf = ReportPDF("Payslip")
+    pdf.add_page()
+    if os.path.exists(LOGO_PATH):
+        pdf.image(LOGO_PATH, 10, 8, 22)
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 6, PAYSLIP_COMPANY_NAME, 0, 1, "C")
+
+    pdf.set_font("Arial", "B", 10)
+    for i, label in enumerate(PAYSLIP_DETAIL_FIELDS):
+        pdf.set_xy(10, PAYSLIP_DETAILS_Y + i * PAYSLIP_ROW_HEIGHT)
+        pdf.cell(40, PAYSLIP_ROW_HEIGHT, f"{label}:", 0, 0)
+
+    pdf.set_xy(10, PAYSLIP_ITEMS_Y)
+    pdf.set_font("Arial", "B", 11)
+    pdf.cell(60, PAYSLIP_ROW_HEIGHT, "Earnings", "B", 0)
+    pdf.cell(32, PAYSLIP_ROW_HEIGHT, "Amount (NGN)", "B", 0, "R")
+    pdf.cell(6, PAYSLIP_ROW_HEIGHT, "", 0, 0)
+    pdf.cell(60, PAYSLIP_ROW_HEIGHT, "Deductions", "B", 0)
+    pdf.cell(32, PAYSLIP_ROW_HEIGHT, "Amount (NGN)", "B", 0, "R")
+
+    pdf.set_font("Arial", "B", 10)
+    pdf.set_xy(10, PAYSLIP_TOTALS_Y)
+    pdf.cell(60, PAYSLIP_ROW_HEIGHT, "Gross Pay", "T", 0)
+    pdf.set_xy(108, PAYSLIP_TOTALS_Y)
+    pdf.cell(60, PAYSLIP_ROW_HEIGHT, "Total Deductions", "T", 0)
+    pdf.set_xy(10, PAYSLIP_TOTALS_Y + PAYSLIP_ROW_HEIGHT * 2)
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(60, PAYSLIP_ROW_HEIGHT + 2, "Net Pay", 0, 0)
+
+    pdf.set_xy(10, PAYSLIP_TOTALS_Y + PAYSLIP_ROW_HEIGHT * 5)
+    pdf.set_font("Arial", "I", 8)
+    pdf.multi_cell(0, 5, "This payslip is computer generated and does not require a signature. "
+                         "Please report any discrepancy to the HR department.", 0, "L")
+    return pdf
+
+@st.cache_resource
+def get_payslip_template():
+    # Shared read-only; draw_payslip() always works on a deep copy
+    return build_payslip_template()
+
+def format_payslip_amount(value):
+    return f"{safe_float(value):,.2f}"
+
+def get_payslip_line_items(payslip):
+    # Payslips from a payroll run carry their breakdown; imported or hand-entered ones only have totals
+    if payslip.get('earnings'):
+        earnings = [(PAYROLL_COMPONENT_LABELS[component], payslip['earnings'].get(component, 0.0)) for component in PAYROLL_EARNING_COMPONENTS]
+        deductions = [(label, (payslip.get('deduction_items') or {}).get(item, 0.0)) for item, label in PAYSLIP_DEDUCTION_LABELS.items()]
+    else:
+        earnings = [("Gross Pay", payslip.get('gross_pay', 0.0))]
+        deductions = [("Total Deductions", payslip.get('deductions', 0.0))]
+    return earnings[:PAYSLIP_ITEM_ROWS], deductions[:PAYSLIP_ITEM_ROWS]
+
+def draw_payslip(template, document):
+    payslip, employee = document['payslip'], document['employee']
+    pdf = copy.deepcopy(template)
+    pdf.set_font("Arial", "", 10)
+    detail_values = [employee.get('name', 'N/A'), payslip.get('staff_id', 'N/A'), employee.get('department', 'N/A'),
+                     payslip.get('pay_period', 'N/A'), payslip.get('pay_date', 'N/A')]
+    for i, value in enumerate(detail_values):
+        pdf.set_xy(50, PAYSLIP_DETAILS_Y + i * PAYSLIP_ROW_HEIGHT)
+        pdf.cell(0, PAYSLIP_ROW_HEIGHT, pdf_text(value), 0, 0)
+
+    earnings, deductions = get_payslip_line_items(payslip)
+    for column_x, items in [(10, earnings), (108, deductions)]:
+        for i, (label, amount) in enumerate(items):
+            pdf.set_xy(column_x, PAYSLIP_ITEMS_Y + (i + 1) * PAYSLIP_ROW_HEIGHT)
+            pdf.cell(60, PAYSLIP_ROW_HEIGHT, pdf_text(label), 0, 0)
+            pdf.cell(32, PAYSLIP_ROW_HEIGHT, format_payslip_amount(amount), 0, 0, "R")
+
+    pdf.set_font("Arial", "B", 10)
+    pdf.set_xy(70, PAYSLIP_TOTALS_Y)
+    pdf.cell(32, PAYSLIP_ROW_HEIGHT, format_payslip_amount(payslip.get('gross_pay')), "T", 0, "R")
+    pdf.set_xy(168, PAYSLIP_TOTALS_Y)
+    pdf.cell(32, PAYSLIP_ROW_HEIGHT, format_payslip_amount(payslip.get('deductions')), "T", 0, "R")
+    pdf.set_font("Arial", "B", 12)
+    pdf.set_xy(70, PAYSLIP_TOTALS_Y + PAYSLIP_ROW_HEIGHT * 2)
+    pdf.cell(32, PAYSLIP_ROW_HEIGHT + 2, f"NGN {format_payslip_amount(payslip.get('net_pay'))}", 0, 0, "R")
+    if payslip.get('employer_pension') is not None:
+        pdf.set_font("Arial", "", 9)
+        pdf.set_xy(10, PAYSLIP_TOTALS_Y + PAYSLIP_ROW_HEIGHT * 3 + 2)
+        pdf.cell(0, PAYSLIP_ROW_HEIGHT, f"Employer pension contribution (not deducted from pay): NGN {format_payslip_amount(payslip['employer_pension'])}", 0, 0)
+    return pdf
+
+def render_payslip_pdf(template, document, pdf_path):
+    pdf = draw_payslip(template, document)
+    # Written under a temporary name first so a crashed render never leaves a truncated payslip behind
+    staging_path = f"{pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pdf.output(staging_path)
+    os.replace(staging_path, pdf_path)
+
+def render_payslip_pdfs(template, jobs):
+    # Returns {payslip_id: error} for the payslips that failed; draw_payslip() copies the shared template
+    errors = {}
+    for payslip_id, document, pdf_path in jobs:
+        try:
+            render_payslip_pdf(template, document, pdf_path)
+        except Exception as e:
+            errors[payslip_id] = str(e)
+    return errors
+
+def get_payslip_pdf_path(payslip_id):
+    return os.path.join(PAYSLIP_PDFS_DIR, f"{re.sub(r'[^A-Za-z0-9_-]', '_', str(payslip_id))}.pdf")
+
+@st.cache_resource
+def get_payslip_pdf_lock():
+    # Keeps two sessions of this process from rendering the same payslips at once
+    return threading.Lock()
+
+def payslip_manifest_lock():
+    return data_file_lock(PAYSLIP_PDFS_FILE, "payslip PDF manifest")
+
+def build_payslip_documents(payslips):
+    # Everything a payslip PDF shows, keyed by payslip_id with its content hash
+    staff_directory = get_staff_directory()
+    documents = {}
+    for payslip in payslips:
+        document = {"payslip": payslip, "employee": staff_directory.get(payslip.get('staff_id'), {})}
+        content = json.dumps([PAYSLIP_LAYOUT_VERSION, document], sort_keys=True, cls=DateEncoder)
+        documents[payslip['payslip_id']] = (document, hashlib.sha256(content.encode('utf-8')).hexdigest())
+    return documents
+
+def get_stale_payslip_pdfs(documents, manifest):
+    return [
+        payslip_id for payslip_id, (document, content_hash) in documents.items()
+        if manifest.get(payslip_id, {}).get('content_hash') != content_hash or not os.path.exists(get_payslip_pdf_path(payslip_id))
+    ]
+
+def prune_payslip_pdfs(manifest):
+    # Drops manifest entries and PDFs of payslips that are no longer in PAYROLL_FILE (replaced by a re-run
+    # of their period, or deleted). Returns whether the manifest changed. Call under payslip_manifest_lock().
+    payslip_ids = {str(payslip['payslip_id']) for payslip in load_data(PAYROLL_FILE)}
+    removed_ids = [payslip_id for payslip_id in manifest if payslip_id not in payslip_ids]
+    for payslip_id in removed_ids:
+        del manifest[payslip_id]
+    kept_paths = {os.path.normcase(get_payslip_pdf_path(payslip_id)) for payslip_id in payslip_ids}
+    for entry in os.scandir(PAYSLIP_PDFS_DIR):
+        if entry.name.endswith(".pdf") and os.path.normcase(entry.path) not in kept_paths:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return bool(removed_ids)
+
+def generate_payslip_pdfs(payslips, prune=False):
+    # Returns (rendered, reused, errors); only payslips whose content changed since they were last rendered are drawn.
+    # prune=True also clears out PDFs of payslips no longer in PAYROLL_FILE; the batch run on the distribution page
+    # does this, a single download does not.
+    documents = build_payslip_documents(payslips)
+    if not prune and not get_stale_payslip_pdfs(documents, load_data(PAYSLIP_PDFS_FILE, {})):
+        return 0, len(documents), {} # Everything is already rendered: no lock, no render
+    with get_payslip_pdf_lock():
+        stale_ids = get_stale_payslip_pdfs(documents, load_data(PAYSLIP_PDFS_FILE, {})) # May have been rendered while we waited
+        errors = render_payslip_pdfs(get_payslip_template(), [(payslip_id, documents[payslip_id][0], get_payslip_pdf_path(payslip_id)) for payslip_id in stale_ids])
+        rendered_at = datetime.now().isoformat()
+        with payslip_manifest_lock(): # Re-read so entries written by other processes are kept
+            manifest = load_data(PAYSLIP_PDFS_FILE, {})
+            manifest_changed = prune_payslip_pdfs(manifest) if prune else False
+            for payslip_id in stale_ids:
+                if payslip_id not in errors:
+                    manifest[payslip_id] = {"content_hash": documents[payslip_id][1], "rendered_at": rendered_at}
+            if stale_ids or manifest_changed:
+                save_data(manifest, PAYSLIP_PDFS_FILE)
+    return len(stale_ids) - len(errors), len(documents) - len(stale_ids), errors
+
+def get_payslip_file_name(payslip, employee_name):
+    file_stem = f"{employee_name}_{payslip.get('staff_id')}_{payslip.get('pay_period')}"
+    return f"Payslip_{re.sub(r'[^A-Za-z0-9_-]+', '_', file_stem)}.pdf"
+
+def bundle_payslip_pdfs(payslips):
+    # ZIP of the rendered payslips (see generate_payslip_pdfs); PDFs are already compressed, so stored as-is
+    staff_directory = get_staff_directory()
+    bundle_file = new_export_file()
+    used_names = set()
+    with zipfile.ZipFile(bundle_file, "w", compression=zipfile.ZIP_STORED) as bundle:
+        for payslip in payslips:
+            pdf_path = get_payslip_pdf_path(payslip['payslip_id'])
+            if os.path.exists(pdf_path):
+                employee_name = staff_directory.get(payslip.get('staff_id'), {}).get('name', 'Employee')
+                file_name = get_payslip_file_name(payslip, employee_name)
+                if file_name in used_names: # Legacy rows may lack a staff ID; the payslip ID keeps names unique
+                    file_name = f"{file_name[:-4]}_{os.path.basename(pdf_path)}"
+                used_names.add(file_name)
+                bundle.write(pdf_path, file_name)
+    return bundle_file
+
+def payslip_distribution_page():
+    st.header("Payslip Distribution")
+    payroll_data = load_data(PAYROLL_FILE)
+    latest_pay_dates = {}
+    for payslip in payroll_data:
+        if payslip.get('pay_period'):
+            latest_pay_dates[payslip['pay_period']] = max(latest_pay_dates.get(payslip['pay_period'], ''), str(payslip.get('pay_date') or ''))
+    periods = sorted(latest_pay_dates, key=latest_pay_dates.get, reverse=True)
+    if not periods:
+        st.info("No payslips have been issued yet.")
+        return
+
+    selected_period = st.selectbox("Pay Period:", periods)
+    period_payslips = [payslip for payslip in payroll_data if payslip.get('pay_period') == selected_period]
+    stale_count = len(get_stale_payslip_pdfs(build_payslip_documents(period_payslips), load_data(PAYSLIP_PDFS_FILE, {})))
+    col_total, col_current, col_stale = st.columns(3)
+    col_total.metric("Payslips", len(period_payslips))
+    col_current.metric("PDFs Up to Date", len(period_payslips) - stale_count)
+    col_stale.metric("PDFs to Render", stale_count)
+
+    if st.button("Generate Payslip PDFs"):
+        with st.spinner(f"Rendering {stale_count} payslip(s)..."):
+            rendered, reused, errors = generate_payslip_pdfs(period_payslips, prune=True)
+            st.session_state.payslip_pdf_bundle = (selected_period, bundle_payslip_pdfs(period_payslips))
+        st.success(f"Rendered {rendered} payslip(s); {reused} unchanged payslip(s) reused.")
+        for payslip_id, error in errors.items():
+            st.error(f"Could not render payslip {payslip_id}: {error}")
+
+    bundle = st.session_state.get('payslip_pdf_bundle')
+    if bundle and bundle[0] == selected_period:
+        st.download_button(
+            "Download Payslips (ZIP)",
+            data=bundle[1],
+            file_name=f"payslips_{re.sub(r'[^A-Za-z0-9_-]+', '_', selected_period)}.zip",
+            mime="application/zip",
+            on_click="ignore"
+        )
+
+# --- Payroll Cost Cube ---
+# Payslips are pre-aggregated per (department, period) cell with payslip counts and gross, deduction and
+# net totals. Free-text pay periods ("July 2024", "Jan-25") are parsed once per distinct value into a
+# sortable YYYY-MM key, falling back to the pay date's month, and departments come from the staff
+# directory. Like the goal cube, this is a derived view of the payroll file that each payroll commit
+# patches per payslip, rebuilt when user profiles change. Charts and rollups read cells, never payslips.
+PAYROLL_CUBE_DIMENSIONS = ['Department', 'Period']
+PAYROLL_CUBE_MEASURES = ['payslips', 'gross_pay', 'deductions', 'net_pay']
+PAY_PERIOD_FORMATS = ["%B %Y", "%b %Y", "%B-%y", "%b-%y", "%B-%Y", "%b-%Y", "%b %y", "%m/%Y", "%Y-%m"]
+PAY_DATE_FORMATS = ["%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y"]
+PAYROLL_ROLLUP_GRAINS = ["Month", "Quarter", "Half-Year", "Year"]
+
+def parse_pay_period(pay_period, pay_date=None):
+    # Returns the period as "YYYY-MM", or 'N/A' if neither the period nor the pay date can be read
+    for text, formats in [(str(pay_period or '').strip(), PAY_PERIOD_FORMATS), (str(pay_date or '').strip()[:10], PAY_DATE_FORMATS)]:
+        for text_format in formats:
+            try:
+                return datetime.strptime(text, text_format).strftime('%Y-%m')
+            except ValueError:
+                continue
+    return 'N/A'
+
+def rollup_period_key(period_key, grain):
+    if period_key == 'N/A' or grain == "Month":
+        return period_key
+    year, month = period_key.split('-')
+    if grain == "Quarter":
+        return f"{year}-Q{(int(month) - 1) // 3 + 1}"
+    if grain == "Half-Year":
+        return f"{year}-H{1 if int(month) <= 6 else 2}"
+    return year
+
+def remove_payslip_from_cube(cube, payslip_id):
+    contribution = cube['payslip_cell'].pop(payslip_id, None)
+    if contribution is None:
+        return
+    cell_key, gross_pay, deductions, net_pay = contribution
+    cell = cube['cells'][cell_key]
+    cell['payslips'] -= 1
+    cell['gross_pay'] -= gross_pay
+    cell['deductions'] -= deductions
+    cell['net_pay'] -= net_pay
+    if cell['payslips'] <= 0:
+        del cube['cells'][cell_key]
+
+def add_payslip_to_cube(cube, payslip):
+    # Replaces the payslip's previous contribution, so reapplying the same payslip is harmless
+    payslip_id = payslip['payslip_id']
+    remove_payslip_from_cube(cube, payslip_id)
+    cell_key = (cube['departments'].get(payslip.get('staff_id'), 'N/A'), parse_pay_period(payslip.get('pay_period'), payslip.get('pay_date')))
+    amounts = [safe_float(payslip.get(field)) for field in ['gross_pay', 'deductions', 'net_pay']]
+    cell = cube['cells'].setdefault(cell_key, {measure: 0 if measure == 'payslips' else 0.0 for measure in PAYROLL_CUBE_MEASURES})
+    cell['payslips'] += 1
+    cell['gross_pay'] += amounts[0]
+    cell['deductions'] += amounts[1]
+    cell['net_pay'] += amounts[2]
+    cube['payslip_cell'][payslip_id] = (cell_key, *amounts)
+
+def build_payroll_cube(payroll_data):
+    cube = {
+        "users_version": get_file_version(USERS_FILE),
+        "departments": {staff_id: employee['department'] for staff_id, employee in get_staff_directory().items()},
+        "cells": {},
+        "payslip_cell": {}
+    }
+    if not payroll_data:
+        return cube
+    df_payslips = pd.DataFrame(payroll_data, columns=['payslip_id', 'staff_id', 'pay_period', 'pay_date', 'gross_pay', 'deductions', 'net_pay'])
+    df_payslips['Department'] = df_payslips['staff_id'].map(cube['departments']).fillna('N/A')
+    # Few distinct periods, so each (period, pay date) pair is parsed once
+    period_pairs = df_payslips[['pay_period', 'pay_date']].astype(str).drop_duplicates()
+    period_keys = {pair: parse_pay_period(*pair) for pair in period_pairs.itertuples(index=False, name=None)}
+    df_payslips['Period'] = pd.Series(list(zip(df_payslips['pay_period'].astype(str), df_payslips['pay_date'].astype(str))), index=df_payslips.index).map(period_keys)
+    for field in ['gross_pay', 'deductions', 'net_pay']:
+        df_payslips[field] = pd.to_numeric(df_payslips[field], errors='coerce').fillna(0.0)
+    df_cells = df_payslips.groupby(PAYROLL_CUBE_DIMENSIONS).agg(
+        payslips=('payslip_id', 'size'), gross_pay=('gross_pay', 'sum'), deductions=('deductions', 'sum'), net_pay=('net_pay', 'sum')
+    )
+    cube['cells'] = {cell_key: dict(values) for cell_key, values in zip(df_cells.index, df_cells.to_dict('records'))}
+    cube['payslip_cell'] = {
+        payslip_id: ((department, period), gross_pay, deductions, net_pay)
+        for payslip_id, department, period, gross_pay, deductions, net_pay
+        in df_payslips[['payslip_id'] + PAYROLL_CUBE_DIMENSIONS + ['gross_pay', 'deductions', 'net_pay']].itertuples(index=False)
+    }
+    return cube
+
+def get_payroll_cube():
+    cube = get_derived_view("payroll_cube", PAYROLL_FILE, build_payroll_cube)
+    if cube['users_version'] != get_file_version(USERS_FILE):
+        # Departments changed: drop the cube so it is rebuilt against the new profiles
+        views, views_lock = get_derived_views()
+        with views_lock:
+            views.pop("payroll_cube", None)
+        cube = get_derived_view("payroll_cube", PAYROLL_FILE, build_payroll_cube)
+    return cube
+
+def on_payroll_saved(file_write, changed_payslips=(), removed_payslip_ids=()):
+    # Keep the payroll cube in step with a save of PAYROLL_FILE that changed or deleted these payslips
+    def apply_changes(cube):
+        for payslip_id in removed_payslip_ids:
+            remove_payslip_from_cube(cube, payslip_id)
+        for payslip in changed_payslips:
+            add_payslip_to_cube(cube, payslip)
+    update_derived_view("payroll_cube", PAYROLL_FILE, apply_changes, file_write)
+
+def payroll_cube_frame(cube):
+    # One row per cell, with the two dimensions as columns
+    return pd.DataFrame(
+        [dict(zip(PAYROLL_CUBE_DIMENSIONS, cell_key), **cell) for cell_key, cell in cube['cells'].items()],
+        columns=PAYROLL_CUBE_DIMENSIONS + PAYROLL_CUBE_MEASURES
+    )
+
+def rollup_payroll_cube(df_cells, dimensions, grain="Month"):
+    df_cells = df_cells.assign(Period=df_cells['Period'].map(lambda period_key: rollup_period_key(period_key, grain)))
+    df_rollup = df_cells.groupby(dimensions)[PAYROLL_CUBE_MEASURES].sum().reset_index()
+    return df_rollup.sort_values(dimensions).rename(columns={
+        'payslips': 'Payslips', 'gross_pay': 'Gross Pay', 'deductions': 'Deductions', 'net_pay': 'Net Pay'
+    })
+
+def payroll_analytics_page():
+    st.header("Payroll Cost Analytics")
+    with derived_views_locked():
+        df_cells = payroll_cube_frame(get_payroll_cube())
+    if df_cells.empty:
+        st.info("No payslips have been issued yet.")
+        return
+
+    period_keys = sorted(period_key for period_key in df_cells['Period'].unique() if period_key != 'N/A')
+    col_department, col_grain = st.columns(2)
+    with col_department:
+        departments = sorted(df_cells['Department'].unique())
+        selected_departments = st.multiselect("Department:", departments, default=departments)
+    with col_grain:
+        grain = st.radio("Group Periods By:", PAYROLL_ROLLUP_GRAINS, horizontal=True)
+    df_cells = df_cells[df_cells['Department'].isin(selected_departments)]
+    unparsed_payslips = int(df_cells.loc[df_cells['Period'] == 'N/A', 'payslips'].sum())
+    if unparsed_payslips:
+        st.warning(f"{unparsed_payslips} payslip(s) have a pay period and pay date that could not be read and are left out.")
+    if len(period_keys) > 1:
+        start_period, end_period = st.select_slider(
+            "Pay Periods:", options=period_keys, value=(period_keys[0], period_keys[-1]),
+            format_func=lambda period_key: datetime.strptime(period_key, '%Y-%m').strftime('%b %Y')
+        )
+        df_cells = df_cells[(df_cells['Period'] >= start_period) & (df_cells['Period'] <= end_period)]
+    else:
+        df_cells = df_cells[df_cells['Period'].isin(period_keys)]
+    if df_cells.empty:
+        st.info("No payslips match the selected filters.")
+        return
+
+    col_payslips, col_gross, col_deductions, col_net = st.columns(4)
+    col_payslips.metric("Payslips", f"{int(df_cells['payslips'].sum()):,}")
+    col_gross.metric("Total Gross (NGN)", f"{df_cells['gross_pay'].sum():,.2f}")
+    col_deductions.metric("Total Deductions (NGN)", f"{df_cells['deductions'].sum():,.2f}")
+    col_net.metric("Total Net Pay (NGN)", f"{df_cells['net_pay'].sum():,.2f}")
+
+    df_trend = rollup_payroll_cube(df_cells, ['Period'], grain)
+    fig_trend = px.line(
+        df_trend.melt(id_vars='Period', value_vars=['Gross Pay', 'Deductions', 'Net Pay'], var_name='Measure', value_name='Amount (NGN)'),
+        x='Period', y='Amount (NGN)', color='Measure', markers=True, title="Payroll Cost Trend"
+    )
+    st.plotly_chart(fig_trend, use_container_width=True)
+
+    df_department_trend = rollup_payroll_cube(df_cells, ['Period', 'Department'], grain)
+    fig_departments = px.bar(df_department_trend, x='Period', y='Gross Pay', color='Department', title="Gross Pay by Department")
+    st.plotly_chart(fig_departments, use_container_width=True)
+
+    st.subheader("Totals by Department and Period")
+    df_table = df_department_trend[['Department', 'Period', 'Payslips', 'Gross Pay', 'Deductions', 'Net Pay']]
+    st.dataframe(df_table.style.format({'Gross Pay': '{:,.2f}', 'Deductions': '{:,.2f}', 'Net Pay': '{:,.2f}'}), hide_index=True, use_container_width=True)
+    export_table_buttons("payroll_analytics", lambda: df_table, "payroll_costs")
 
 # --- View Payslip (Staff) ---
 def view_payslip_page():
@@ -2273,7 +5864,37 @@ def view_payslip_page():
         st.markdown(f"**Net Pay:** NGN {net_pay:,.2f}")
 
         st.markdown("---")
-        st.write("*(Note: This is a simplified payslip view. A full payslip would include detailed breakdowns of earnings, taxes, and other deductions.)*")
+        if selected_payslip.get('earnings'):
+            # Payslips from a payroll run carry the full breakdown
+            col_earnings, col_deduction_items = st.columns(2)
+            with col_earnings:
+                st.markdown("**Earnings**")
+                st.dataframe(pd.DataFrame([
+                    {"Item": PAYROLL_COMPONENT_LABELS[component], "Amount (NGN)": selected_payslip['earnings'].get(component, 0.0)}
+                    for component in PAYROLL_EARNING_COMPONENTS
+                ]), hide_index=True, use_container_width=True)
+            with col_deduction_items:
+                st.markdown("**Deductions**")
+                st.dataframe(pd.DataFrame([
+                    {"Item": label, "Amount (NGN)": (selected_payslip.get('deduction_items') or {}).get(item, 0.0)}
+                    for item, label in PAYSLIP_DEDUCTION_LABELS.items()
+                ]), hide_index=True, use_container_width=True)
+        else:
+            st.write("*(Note: This is a simplified payslip view. A full payslip would include detailed breakdowns of earnings, taxes, and other deductions.)*")
+
+        # Rendered on first request and served from PAYSLIP_PDFS_DIR afterwards while the payslip is unchanged
+        rendered, reused, errors = generate_payslip_pdfs([selected_payslip])
+        if errors:
+            st.error(f"Could not generate the payslip PDF: {errors[selected_payslip['payslip_id']]}")
+        else:
+            with open(get_payslip_pdf_path(selected_payslip['payslip_id']), "rb") as payslip_file:
+                st.download_button(
+                    "Download Payslip (PDF)",
+                    data=payslip_file.read(),
+                    file_name=get_payslip_file_name(selected_payslip, st.session_state.current_user['profile']['name']),
+                    mime="application/pdf",
+                    on_click="ignore"
+                )
 
         # Add a simple bar chart for gross vs net pay
         payslip_data = pd.DataFrame({
@@ -2394,9 +6015,20 @@ def admin_manage_disciplinary_records():
 
     st.subheader("Existing Disciplinary Records")
     if disciplinary_records:
-        df_records = pd.DataFrame(disciplinary_records)
-        df_records['Employee Name'] = df_records['staff_id'].map(staff_id_to_name)
-        st.dataframe(df_records[['Employee Name', 'staff_id', 'incident_date', 'incident_type', 'action_taken', 'status']])
+        disciplinary_columns = {
+            "Employee Name": lambda record: staff_id_to_name.get(record.get('staff_id')),
+            "Staff ID": 'staff_id',
+            "Incident Date": 'incident_date',
+            "Incident Type": 'incident_type',
+            "Action Taken": 'action_taken',
+            "Status": 'status'
+        }
+        paginated_table(
+            "disciplinary_records_table",
+            project_records(disciplinary_records, disciplinary_columns),
+            default_sort="Incident Date",
+            filter_columns=("Status", "Incident Type")
+        )
     else:
         st.info("No disciplinary records found.")
 
@@ -2574,7 +6206,9 @@ def admin_manage_attendance():
         filtered_df['clock_in_time_display'] = filtered_df['clock_in_time'].apply(lambda x: datetime.fromisoformat(x).strftime('%H:%M:%S') if x else 'N/A')
         filtered_df['clock_out_time_display'] = filtered_df['clock_out_time'].apply(lambda x: datetime.fromisoformat(x).strftime('%H:%M:%S') if x else 'N/A')
         
-        st.dataframe(filtered_df[['Employee Name', 'staff_id', 'date', 'clock_in_time_display', 'clock_out_time_display', 'duration_hours']].sort_values(by='date', ascending=False), use_container_width=True)
+        df_attendance_display = filtered_df[['Employee Name', 'staff_id', 'date', 'clock_in_time_display', 'clock_out_time_display', 'duration_hours']].sort_values(by='date', ascending=False)
+        st.dataframe(df_attendance_display, use_container_width=True)
+        export_table_buttons("attendance_records", lambda: df_attendance_display, "attendance_records")
 
         total_hours = filtered_df['duration_hours'].sum()
         st.markdown(f"**Total Hours Worked in Filtered Period:** {total_hours:.2f} hours")
@@ -2878,11 +6512,12 @@ def admin_view_task_analytics():
                 return 'background-color: #CCFFCC' # Light Green
             return ''
 
+        df_tasks_display = filtered_tasks_df[['task_details', 'Assignee Name', 'objective', 'start_date', 'end_date', 'status', 'Created By Name', 'created_date']]
         st.dataframe(
-            filtered_tasks_df[['task_details', 'Assignee Name', 'objective', 'start_date', 'end_date', 'status', 'Created By Name', 'created_date']]
-            .style.applymap(color_status, subset=['status']),
+            df_tasks_display.style.applymap(color_status, subset=['status']),
             use_container_width=True
         )
+        export_table_buttons("daily_tasks", lambda: df_tasks_display, "daily_tasks")
     else:
         st.info("No tasks match the selected filters.")
 
@@ -2988,14 +6623,24 @@ def main():
         # Add admin-specific menu options
         if user_role == "admin":
             menu_options["Manage Users"] = "admin_manage_users"
+            menu_options["Document Storage"] = "document_storage" # Blob store usage and clean-up
             menu_options["Manage Leave (HR)"] = "admin_manage_leave"
             menu_options["Manage OPEX/CAPEX Approvals"] = "manage_opex_capex_approvals"
             menu_options["View All Performance Goals"] = "admin_view_performance_goals"
             menu_options["Manage Appraisals"] = "admin_manage_appraisals" # New admin appraisal management
+            menu_options["Appraisal Scoreboard"] = "appraisal_scoreboard" # NEW: Company-wide appraisal scores
+            menu_options["Appraisal Reports"] = "appraisal_reports" # NEW: Batch appraisal report PDFs
             menu_options["Manage HR Policies"] = "admin_manage_policies" # New admin policy management
             menu_options["Manage Disciplinary Records"] = "admin_manage_disciplinary_records" # New disciplinary records
             menu_options["Manage Attendance"] = "admin_manage_attendance" # New admin attendance management
             menu_options["Task People Analytics"] = "admin_view_task_analytics" # NEW: Admin/HR Task Analytics
+            menu_options["Vendor Registry"] = "vendor_registry" # NEW: Vendor registry and spend
+            menu_options["Budget Burn Forecast"] = "budget_burn_forecast" # NEW: Expense line burn rate
+            menu_options["Approval SLA Analytics"] = "approval_sla_analytics" # NEW: Approval turnaround analytics
+            menu_options["Payroll Run"] = "payroll_run" # NEW: Monthly payroll computation
+            menu_options["Payroll Import"] = "payroll_import" # NEW: Bulk payslip import from CSV
+            menu_options["Payslip Distribution"] = "payslip_distribution" # NEW: Batch payslip PDFs per pay period
+            menu_options["Payroll Analytics"] = "payroll_analytics" # NEW: Payroll cost by department and period
 
         # Add approver-specific menu option for OPEX/CAPEX
         is_approver = False
@@ -3006,19 +6651,37 @@ def main():
                 break
         if is_approver and user_role != "admin": # Non-admin approvers
             menu_options["Manage OPEX/CAPEX Approvals"] = "manage_opex_capex_approvals"
+            menu_options["Approval SLA Analytics"] = "approval_sla_analytics"
         
         # HR Manager also manages leave
         if user_department == "HR" and user_grade == "Manager" and user_role != "admin":
             menu_options["Manage Leave (HR)"] = "admin_manage_leave"
             menu_options["Manage Appraisals"] = "admin_manage_appraisals"
+            menu_options["Appraisal Scoreboard"] = "appraisal_scoreboard"
+            menu_options["Appraisal Reports"] = "appraisal_reports"
             menu_options["Manage HR Policies"] = "admin_manage_policies"
             menu_options["Manage Disciplinary Records"] = "admin_manage_disciplinary_records"
             menu_options["Manage Attendance"] = "admin_manage_attendance"
             menu_options["Task People Analytics"] = "admin_view_task_analytics" # NEW: Admin/HR Task Analytics
+            menu_options["Payroll Run"] = "payroll_run"
+            menu_options["Payroll Import"] = "payroll_import"
+            menu_options["Payslip Distribution"] = "payslip_distribution"
+            menu_options["Payroll Analytics"] = "payroll_analytics"
+
+        # Finance Manager maintains the vendor registry and watches budget burn
+        if user_department == "Finance" and user_grade == "Manager" and user_role != "admin":
+            menu_options["Vendor Registry"] = "vendor_registry"
+            menu_options["Budget Burn Forecast"] = "budget_burn_forecast"
+            menu_options["Payroll Run"] = "payroll_run"
+            menu_options["Payroll Import"] = "payroll_import"
+            menu_options["Payslip Distribution"] = "payslip_distribution"
+            menu_options["Payroll Analytics"] = "payroll_analytics"
 
         # MD also manages appraisals
         if user_grade == "MD" and user_role != "admin":
             menu_options["Manage Appraisals"] = "admin_manage_appraisals"
+            menu_options["Appraisal Scoreboard"] = "appraisal_scoreboard"
+            menu_options["Appraisal Reports"] = "appraisal_reports"
 
         selected_page_name = st.sidebar.radio(
             "Go to",
@@ -3060,6 +6723,8 @@ def main():
         elif st.session_state.current_page == "view_company_policy":
             view_company_policy_page()
         # Admin/Approver pages
+        elif st.session_state.current_page == "document_storage" and user_role == "admin":
+            document_storage_page()
         elif st.session_state.current_page == "admin_manage_users" and user_role == "admin":
             admin_manage_users()
         elif st.session_state.current_page == "admin_manage_leave" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager")):
@@ -3070,6 +6735,10 @@ def main():
             admin_view_performance_goals()
         elif st.session_state.current_page == "admin_manage_appraisals" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager") or user_grade == "MD"):
             admin_manage_appraisals()
+        elif st.session_state.current_page == "appraisal_scoreboard" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager") or user_grade == "MD"):
+            appraisal_scoreboard_page()
+        elif st.session_state.current_page == "appraisal_reports" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager") or user_grade == "MD"):
+            appraisal_reports_page()
         elif st.session_state.current_page == "admin_manage_policies" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager")):
             admin_manage_policies()
         elif st.session_state.current_page == "admin_manage_disciplinary_records" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager")):
@@ -3078,6 +6747,20 @@ def main():
             admin_manage_attendance()
         elif st.session_state.current_page == "admin_view_task_analytics" and (user_role == "admin" or (user_department == "HR" and user_grade == "Manager")): # NEW: Admin/HR Task Analytics route
             admin_view_task_analytics()
+        elif st.session_state.current_page == "vendor_registry" and (user_role == "admin" or (user_department == "Finance" and user_grade == "Manager")):
+            vendor_registry_page()
+        elif st.session_state.current_page == "budget_burn_forecast" and (user_role == "admin" or (user_department == "Finance" and user_grade == "Manager")):
+            budget_burn_forecast_page()
+        elif st.session_state.current_page == "approval_sla_analytics" and (user_role == "admin" or is_approver):
+            approval_sla_analytics_page()
+        elif st.session_state.current_page == "payroll_run" and (user_role == "admin" or (user_department in ["HR", "Finance"] and user_grade == "Manager")):
+            payroll_run_page()
+        elif st.session_state.current_page == "payroll_import" and (user_role == "admin" or (user_department in ["HR", "Finance"] and user_grade == "Manager")):
+            payroll_import_page()
+        elif st.session_state.current_page == "payslip_distribution" and (user_role == "admin" or (user_department in ["HR", "Finance"] and user_grade == "Manager")):
+            payslip_distribution_page()
+        elif st.session_state.current_page == "payroll_analytics" and (user_role == "admin" or (user_department in ["HR", "Finance"] and user_grade == "Manager")):
+            payroll_analytics_page()
         else:
             st.error("Access Denied: Page not found or you do not have permission to view this page.")
             st.session_state.current_page = "dashboard" # Redirect to dashboard
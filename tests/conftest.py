@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def hr_app(tmp_path_factory):
+    # hr_app keeps its data in folders relative to the working directory, so the tests run in a scratch one
+    os.chdir(tmp_path_factory.mktemp("hr_app"))
+    sys.path.insert(0, REPO_DIR)
+    import hr_app
+    return hr_app
+
+
+@pytest.fixture
+def staff(hr_app):
+    # Three employees in two departments; returns their staff IDs
+    profiles = [
+        ("POL/2024/001", "Ada Ama", "HR", "Manager"),
+        ("POL/2024/002", "Udu Aka", "Finance", "Manager"),
+        ("POL/2024/003", "Abdulahi Ibrahim", "Finance", "Officer"),
+    ]
+    hr_app.save_data([
+        {"username": name.lower().replace(" ", "_"), "role": "staff",
+         "profile": {"staff_id": staff_id, "name": name, "department": department, "grade_level": grade}}
+        for staff_id, name, department, grade in profiles
+    ], hr_app.USERS_FILE)
+    return [profile[0] for profile in profiles]
@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+
+
+def make_appraisal(appraisal_id, staff_id, goals, section_b, period="2026"):
+    return {
+        "appraisal_id": appraisal_id,
+        "staff_id": staff_id,
+        "appraisal_period": period,
+        "employee_data": {"name": appraisal_id},
+        "section_a_goals": [
+            {"weighting_percent": weight, "self_rating": self_rating, "line_manager_rating": manager_rating}
+            for weight, self_rating, manager_rating in goals
+        ],
+        "section_b_qualitative": {
+            item: {"self_rating": self_rating, "line_manager_rating": manager_rating}
+            for item, (self_rating, manager_rating) in section_b.items()
+        },
+    }
+
+
+@pytest.fixture
+def appraisals(staff):
+    return [
+        make_appraisal("a1", staff[0], [(60, 4, 5), (40, 3, None)], {
+            'leadership_team_development': (4, 4), 'coordinate_optimize_resources': (5, None), 'interpersonal': (3, 2),
+        }),
+        make_appraisal("a2", staff[1], [(None, 0, None)], {}), # Nothing rated yet
+        make_appraisal("a3", staff[2], [(None, 5, 5), ("", 1, 3)], { # No weightings: the goals share Section A equally
+            'leadership_team_development': (5, 5), 'coordinate_optimize_resources': (5, 5), 'interpersonal': (5, 5),
+        }),
+        make_appraisal("a4", staff[2], [(100, 2, 2)], {'interpersonal': (2, 2)}, period="2025"),
+    ]
+
+
+def test_score_appraisals_weights_sections_and_falls_back_to_self_ratings(hr_app, appraisals):
+    scores = hr_app.score_appraisals(appraisals).set_index("Appraisal ID")
+    # Section A: (60 x 4/5 + 40 x 3/5) / 100 x 70; Section B: (4 + 5 + 3) / 15 x 30
+    assert scores.loc["a1", "Section A Self (/70)"] == pytest.approx(50.4)
+    assert scores.loc["a1", "Section B Self (/30)"] == pytest.approx(24.0)
+    # The manager has rated one goal and two Section B items
+    assert scores.loc["a1", "Manager Score (%)"] == pytest.approx(70 + 18)
+    assert scores.loc["a1", "Manager Review"] == "Partial"
+    # Final: manager ratings 5 and 4, 2 with the self ratings 3 and 5 filling the gaps
+    assert scores.loc["a1", "Final Score (%)"] == pytest.approx(58.8 + 22)
+    assert scores.loc["a1", "Rating Description"] == "Meet Expectations"
+    assert pd.isna(scores.loc["a2", "Final Score (%)"])
+    assert scores.loc["a2", "Rating Description"] == "Not Rated"
+    assert scores.loc["a2", "Manager Review"] == "Not Started"
+    assert scores.loc["a3", "Final Score (%)"] == pytest.approx((5 + 3) / 10 * 70 + 30)
+    assert scores.loc["a3", "Manager Review"] == "Complete"
+
+
+def test_scoring_the_whole_company_at_once_matches_scoring_each_appraisal(hr_app, appraisals):
+    together = hr_app.score_appraisals(appraisals)
+    one_by_one = pd.concat([hr_app.score_appraisals([appraisal]) for appraisal in appraisals], ignore_index=True)
+    pd.testing.assert_frame_equal(together, one_by_one, check_dtype=False)
+
+
+def test_scoreboard_after_an_update_matches_a_rebuild(hr_app, staff, appraisals):
+    hr_app.save_data(appraisals, hr_app.SELF_APPRAISALS_FILE)
+    hr_app.compute_appraisal_scoreboard(hr_app.get_file_version(hr_app.SELF_APPRAISALS_FILE), hr_app.get_file_version(hr_app.USERS_FILE))
+
+    # A line manager finishes a2, which moves it onto the scoreboard
+    appraisals[1]['section_a_goals'][0]['line_manager_rating'] = 4
+    hr_app.save_data(appraisals, hr_app.SELF_APPRAISALS_FILE)
+    df_ranked, unrated_count = hr_app.compute_appraisal_scoreboard(hr_app.get_file_version(hr_app.SELF_APPRAISALS_FILE), hr_app.get_file_version(hr_app.USERS_FILE))
+
+    staff_id_to_department = {user['profile']['staff_id']: user['profile']['department'] for user in hr_app.load_data(hr_app.USERS_FILE)}
+    rebuilt = hr_app.rank_appraisal_scores(hr_app.score_appraisals(hr_app.load_data(hr_app.SELF_APPRAISALS_FILE), staff_id_to_department))
+    pd.testing.assert_frame_equal(df_ranked, rebuilt)
+    assert unrated_count == 0
+    ranks = df_ranked.set_index("Appraisal ID")
+    assert ranks.loc["a3", "Company Rank"] == 1 and ranks.loc["a4", "Company Rank"] == 1 # Ranked within each period
+    assert ranks.loc["a1", "Department Rank"] == 1
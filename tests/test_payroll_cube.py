@@ -0,0 +1,33 @@
+import pandas as pd
+
+
+def cube_cells(hr_app, cube):
+    frame = hr_app.payroll_cube_frame(cube)
+    return frame.sort_values(hr_app.PAYROLL_CUBE_DIMENSIONS).reset_index(drop=True)
+
+
+def run_payroll(hr_app, staff_ids, basic, pay_period, pay_date):
+    df_components = pd.DataFrame({"staff_id": staff_ids, "basic": basic, "housing": 100_000.0, "transport": 50_000.0})
+    return hr_app.build_payroll_batch(hr_app.compute_payroll(df_components), pay_period, pay_date, f"run-{pay_period}")
+
+
+def test_payroll_runs_keep_the_cached_cube_equal_to_a_rebuild(hr_app, staff):
+    legacy_payslips = [
+        # Older rows: a free-text period read from its pay date, and a staff ID no longer in the directory
+        {"payslip_id": 1, "staff_id": staff[0], "pay_period": "Q3 bonus", "pay_date": "2026-09-30", "gross_pay": "250000", "deductions": 20_000, "net_pay": 230_000},
+        {"payslip_id": 2, "staff_id": "POL/2019/099", "pay_period": "September 2026", "pay_date": None, "gross_pay": 90_000, "deductions": None, "net_pay": 90_000},
+    ]
+    hr_app.save_data(legacy_payslips + run_payroll(hr_app, staff, 300_000.0, "October 2026", "2026-10-25"), hr_app.PAYROLL_FILE)
+    hr_app.get_payroll_cube() # Built and cached, as opening the payroll analytics page does
+
+    # Re-run October with new pay for two employees, then run November for everyone
+    hr_app.commit_payroll_batch(run_payroll(hr_app, staff[1:], 450_000.0, "October 2026", "2026-10-27"))
+    hr_app.commit_payroll_batch(run_payroll(hr_app, staff, 320_000.0, "November 2026", "2026-11-25"))
+
+    with hr_app.derived_views_locked():
+        incremental = cube_cells(hr_app, hr_app.get_payroll_cube())
+    payroll_data = hr_app.load_data(hr_app.PAYROLL_FILE)
+    rebuilt = cube_cells(hr_app, hr_app.build_payroll_cube(payroll_data))
+    pd.testing.assert_frame_equal(incremental, rebuilt, check_dtype=False)
+    assert incremental['payslips'].sum() == len(payroll_data) == 2 + 3 + 3
+    assert set(incremental['Period']) == {"2026-09", "2026-10", "2026-11"}
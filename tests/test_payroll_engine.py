@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize("annual_gross, annual_reliefs, expected_tax", [
+    # At or below the minimum wage: exempt
+    (840_000, 0, 0.0),
+    # Relief is NGN 200,000 + 20% of gross = 380,000, leaving 20,000 taxable (1,400 by band); 1% of gross is higher
+    (900_000, 500_000, 9_000.0),
+    # Relief 800,000, taxable 1,900,000: the first four bands in full, 300,000 in the 21% band
+    (3_000_000, 300_000, 21_000 + 33_000 + 75_000 + 95_000 + 63_000),
+    # 1% of gross (300,000) replaces the fixed relief; taxable 23,700,000 reaches the open-ended 24% band
+    (30_000_000, 0, 21_000 + 33_000 + 75_000 + 95_000 + 336_000 + 20_500_000 * 0.24),
+])
+def test_compute_paye_applies_relief_bands_and_minimum_tax(hr_app, annual_gross, annual_reliefs, expected_tax):
+    tax = hr_app.compute_paye(np.array([annual_gross], dtype=float), np.array([annual_reliefs], dtype=float))
+    assert tax[0] == pytest.approx(expected_tax)
+
+
+def test_compute_payroll_breaks_down_a_monthly_payslip(hr_app):
+    df_components = pd.DataFrame([{"staff_id": "POL/2024/001", "basic": 400_000, "housing": 100_000, "transport": 50_000, "other_allowances": 0, "other_deductions": 5_000}])
+    payslip = hr_app.compute_payroll(df_components).iloc[0]
+    # Pension 8% of 550,000 and NHF 2.5% of basic; annual taxable income is 6,600,000 - 1,520,000 relief - 648,000
+    assert payslip['gross_pay'] == pytest.approx(550_000)
+    assert payslip['pension'] == pytest.approx(44_000)
+    assert payslip['nhf'] == pytest.approx(10_000)
+    assert payslip['paye'] == pytest.approx(round((560_000 + 1_232_000 * 0.24) / 12, 2))
+    assert payslip['deductions'] == pytest.approx(payslip['paye'] + 44_000 + 10_000 + 5_000)
+    assert payslip['net_pay'] == pytest.approx(550_000 - payslip['deductions'])
+    assert payslip['employer_pension'] == pytest.approx(55_000)
@@ -0,0 +1,32 @@
+import pandas as pd
+
+
+def cube_cells(hr_app, cube):
+    frame = hr_app.goal_cube_frame(cube)
+    return frame.sort_values(hr_app.GOAL_CUBE_DIMENSIONS).reset_index(drop=True)
+
+
+def test_goal_writes_keep_the_cached_cube_equal_to_a_rebuild(hr_app, staff):
+    goals = [
+        {"goal_id": "g1", "staff_id": staff[0], "status": "Not Started", "start_date": "2026-01-01", "self_rating": 4},
+        {"goal_id": "g2", "staff_id": staff[1], "status": "In Progress", "start_date": "2026-01-01", "line_manager_rating": "3"},
+        {"goal_id": "g3", "staff_id": staff[2], "status": "Completed", "start_date": "2025-06-01"},
+    ]
+    file_write = hr_app.save_data(goals, hr_app.PERFORMANCE_GOALS_FILE)
+    hr_app.get_performance_goal_cube() # Built and cached, as opening the admin goals page does
+
+    # Update, add and delete goals the way the goal, appraisal and review pages do
+    goals[0].update(status="Completed", line_manager_rating=5)
+    new_goal = {"goal_id": "g4", "staff_id": staff[2], "status": "Not Started", "start_date": "2026-03-01", "self_rating": 2}
+    goals.append(new_goal)
+    file_write = hr_app.save_data(goals, hr_app.PERFORMANCE_GOALS_FILE)
+    hr_app.on_performance_goals_saved(file_write, [goals[0], new_goal])
+    del goals[1]
+    file_write = hr_app.save_data(goals, hr_app.PERFORMANCE_GOALS_FILE)
+    hr_app.on_performance_goals_saved(file_write, removed_goal_ids=["g2"])
+
+    with hr_app.derived_views_locked():
+        incremental = cube_cells(hr_app, hr_app.get_performance_goal_cube())
+    rebuilt = cube_cells(hr_app, hr_app.build_performance_goal_cube(hr_app.load_data(hr_app.PERFORMANCE_GOALS_FILE)))
+    pd.testing.assert_frame_equal(incremental, rebuilt, check_dtype=False)
+    assert incremental['goals'].sum() == 3